@@ -1,8 +1,18 @@
 # Imports
+import os
+import time
+import multiprocessing
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
 from get_S2_points_OpenEO import authenticate_OEO, get_s2_points_OEO
 from calculate_features import calculate_feature
-from get_meteo import getHistoricalMeteoData, getPredictedMeteoData
+from get_meteo import getHistoricalMeteoData, getHistoricalMeteoDataBatch, getPredictedMeteoData, \
+    getPredictedMeteoDataBatch
 from data_imputation import data_imputation
+from db_pool import set_pool_config, get_pool_stats, reset_pool_stats, dispose_engines
+from oeo_session import close_session
 
 class AIHABs:
 
@@ -28,6 +38,20 @@ class AIHABs:
         - freq: the frequency of the analysis: W - weekly, D - daily, M - monthly (default: "W")
         - t_shift: the time shift (default: 1)
         - forecast_days: the number of forecast days (weeks or months) (default: 16)
+        - chunksize: the number of rows read and predicted at once during WQ feature calculation (default: 100000)
+        - n_jobs_imputation: the number of processes for the SVR imputation in run_analyse, -1 for all CPU cores (default: -1)
+        - incremental_imputation: reuse the stored imputation state and update only the new periods (default: False)
+        - aggregate_in_db: compute the medians of the periods (freq) in the database instead of pandas (default: False)
+        - db_table_imputation_state: the name of the table for the stored imputation states (default: "imputation_state")
+        - pool_size: the number of pooled database connections (default: 5)
+        - max_overflow: the number of database connections opened above the pool size (default: 10)
+        - max_oeo_jobs: the number of OpenEO batch jobs (time windows) running at once for one reservoir (default: 4)
+        - db_table_job_ledger: the name of the table for the ledger of the OpenEO jobs (default: "s2_job_ledger")
+        - n_fetch_workers: the number of parallel I/O bound fetches (S2 and meteo data) in the batch mode (default: 8)
+        - n_cpu_workers: the number of processes for CPU bound stages (WQ features, imputation) in the batch mode (default: number of CPU cores)
+        - meteo_batch_size: the number of reservoirs in one request for meteo data in the batch mode (default: 50)
+        - meteo_grid_resolution: the resolution of the meteo grid in degrees; the historical meteo data are stored once for each grid cell shared by the reservoirs (default: None - for each reservoir)
+        - db_table_meteo_cells: the name of the table for the grid cells of the reservoirs (default: "meteo_cells")
         """
 
         # Authenticate after starting the program
@@ -43,7 +67,7 @@ class AIHABs:
         self.db_table_forecast = "meteo_forecast"
         self.db_table_history = "meteo_history"
 
-        self.model_name = None,
+        self.model_name = None
         self.default_model = False
 
         self.osm_id: str = "123456"
@@ -55,26 +79,245 @@ class AIHABs:
         self.freq = 'W'
         self.t_shift = 1
         self.forecast_days = 16
+        self.chunksize = 100000
+        self.n_jobs_imputation = -1
+        self.incremental_imputation = False
+        self.db_table_imputation_state = "imputation_state"
+        self.aggregate_in_db = False
+
+        self.pool_size = 5
+        self.max_overflow = 10
+
+        self.max_oeo_jobs = 4
+        self.db_table_job_ledger = "s2_job_ledger"
+        self.n_fetch_workers = 8
+        self.n_cpu_workers = os.cpu_count()
+        self.meteo_batch_size = 50
+        self.meteo_grid_resolution = None
+        self.db_table_meteo_cells = "meteo_cells"
 
 
     def run_analyse(self):
 
+        # Set the shared database connection pool and reset its counters
+        set_pool_config(pool_size=self.pool_size, max_overflow=self.max_overflow)
+        reset_pool_stats()
+
         # get Sentinel-2 data
-        get_s2_points_OEO(self.osm_id, self.db_name, self.user, self.db_table_reservoirs, self.db_table_points, self.db_table_S2_points_data)
+        get_s2_points_OEO(self.osm_id, self.db_name, self.user, self.db_table_reservoirs, self.db_table_points, self.db_table_S2_points_data, max_jobs=self.max_oeo_jobs, ledger_table=self.db_table_job_ledger)
 
         # calculate WQ features --> new AI models
-        model_id = calculate_feature(self.feature, self.osm_id, self.db_name, self.user, self.db_table_S2_points_data, self.db_features_table, self.db_models, model_name=self.model_name, default=self.default_model)[1]
+        model_id = calculate_feature(self.feature, self.osm_id, self.db_name, self.user, self.db_table_S2_points_data, self.db_features_table, self.db_models, model_name=self.model_name, default=self.default_model, chunksize=self.chunksize)[1]
 
         # get meteodata
         # get historical meteodata
-        getHistoricalMeteoData(self.osm_id, self.meteo_features, self.user, self.db_name, self.db_table_history, self.db_table_reservoirs)
+        if self.meteo_grid_resolution is None:
+            getHistoricalMeteoData(self.osm_id, self.meteo_features, self.user, self.db_name, self.db_table_history, self.db_table_reservoirs)
+        else:
+            getHistoricalMeteoDataBatch([self.osm_id], self.meteo_features, self.user, self.db_name, self.db_table_history, self.db_table_reservoirs, grid_resolution=self.meteo_grid_resolution, db_table_cells=self.db_table_meteo_cells)
         # get predicted meteodata
         getPredictedMeteoData(self.osm_id, self.meteo_features, self.user, self.db_name, self.db_table_forecast, self.db_table_reservoirs, self.forecast_days)
 
         # imputation of missing values (based on SVR model)
-        gdf_imputed, gdf_smooth = data_imputation(self.db_name, self.user, self.osm_id, self.feature, model_id, self.db_features_table, self.db_table_history, freq=self.freq, t_shift=self.t_shift)
+        gdf_imputed, gdf_smooth = data_imputation(self.db_name, self.user, self.osm_id, self.feature, model_id, self.db_features_table, self.db_table_history, freq=self.freq, t_shift=self.t_shift, n_jobs=self.n_jobs_imputation, incremental=self.incremental_imputation, db_table_state=self.db_table_imputation_state, aggregate_in_db=self.aggregate_in_db, db_table_meteo_cells=self._meteo_cells_table())
 
         # run AI time series analysis
 
+        # Report the database connections opened and reused during the run
+        for (user, db_name), stats in get_pool_stats().items():
+            print(f"DB connections {user}@{db_name}: opened {stats['opened']}, reused {stats['reused']}")
+
         return gdf_imputed, gdf_smooth
 
+    def run_batch(self, osm_ids):
+        """
+        Runs the analysis for a list of water reservoirs. The Sentinel-2 and meteo data are fetched in a thread pool
+        (n_fetch_workers), the WQ features calculation and the imputation run in a process pool (n_cpu_workers). The
+        analysis of the reservoir starts as soon as its data are fetched. The historical meteo data and the forecast of
+        all reservoirs are fetched at first by the multi-location requests (meteo_batch_size reservoirs in one request).
+
+        :param osm_ids: List of OSM object ids
+        :return: Dictionary {osm_id: (gdf_imputed, gdf_smooth)}; DataFrame with the report for each reservoir (status,
+                 failed stage, error and stage timings)
+        """
+
+        # The fetch threads share the connection pool of the main process
+        set_pool_config(pool_size=max(self.pool_size, self.n_fetch_workers), max_overflow=self.max_overflow)
+        reset_pool_stats()
+
+        config = self._batch_config()
+
+        # Historical meteo data for all reservoirs at once; the reservoirs are fetched one by one if it fails
+        try:
+            getHistoricalMeteoDataBatch(osm_ids, self.meteo_features, self.user, self.db_name, self.db_table_history,
+                                        self.db_table_reservoirs, batch_size=self.meteo_batch_size,
+                                        grid_resolution=self.meteo_grid_resolution,
+                                        db_table_cells=self.db_table_meteo_cells)
+            config['history_fetched'] = True
+        except Exception as e:
+            print(f"Batch fetching of historical meteo data failed, the data will be fetched for each reservoir. Error: {e}")
+            config['history_fetched'] = False
+
+        # Forecast for all reservoirs is replaced at once
+        try:
+            getPredictedMeteoDataBatch(osm_ids, self.meteo_features, self.user, self.db_name, self.db_table_forecast,
+                                       self.db_table_reservoirs, self.forecast_days, batch_size=self.meteo_batch_size)
+            config['forecast_fetched'] = True
+        except Exception as e:
+            print(f"Batch fetching of meteo forecast failed, the forecast will be fetched for each reservoir. Error: {e}")
+            config['forecast_fetched'] = False
+
+        report = {str(osm_id): {'osm_id': str(osm_id), 'status': 'ok', 'failed_stage': None, 'error': None,
+                                't_fetch': None, 't_analyse': None, 't_total': None} for osm_id in osm_ids}
+        results = {}
+        pool_stats = []
+
+        t_start = time.time()
+        fetch_pool = ThreadPoolExecutor(max_workers=self.n_fetch_workers)
+        cpu_pool = ProcessPoolExecutor(max_workers=self.n_cpu_workers, mp_context=multiprocessing.get_context('spawn'))
+
+        try:
+            fetch_futures = {fetch_pool.submit(_batch_fetch, config, str(osm_id)): str(osm_id) for osm_id in osm_ids}
+            analyse_futures = {}
+
+            # Start the analysis for reservoirs with fetched data
+            for future in as_completed(fetch_futures):
+                osm_id = fetch_futures[future]
+                try:
+                    report[osm_id]['t_fetch'] = future.result()
+                except Exception as e:
+                    report[osm_id].update(status='failed', failed_stage='fetch', error=repr(e))
+                    print(f"Fetching data for OSM_ID: {osm_id} failed. Error: {e}")
+                    continue
+
+                analyse_futures[cpu_pool.submit(_batch_analyse, config, osm_id)] = osm_id
+
+            for future in as_completed(analyse_futures):
+                osm_id = analyse_futures[future]
+                try:
+                    gdf_imputed, gdf_smooth, t_analyse, worker_stats = future.result()
+                    pool_stats.append(worker_stats)
+                    results[osm_id] = (gdf_imputed, gdf_smooth)
+                    report[osm_id]['t_analyse'] = t_analyse
+                except Exception as e:
+                    report[osm_id].update(status='failed', failed_stage='analyse', error=repr(e))
+                    print(f"Analysis for OSM_ID: {osm_id} failed. Error: {e}")
+
+        finally:
+            fetch_pool.shutdown()
+            cpu_pool.shutdown()
+
+        df_report = pd.DataFrame(list(report.values()))
+        df_report['t_total'] = df_report[['t_fetch', 't_analyse']].sum(axis=1, min_count=1)
+
+        n_ok = (df_report['status'] == 'ok').sum()
+        print(f"Batch finished in {time.time() - t_start:.4f} seconds: {n_ok} of {len(df_report)} reservoirs processed")
+
+        # Connections of the main process (fetch threads) and of the analysis worker processes
+        pool_stats.append(get_pool_stats())
+        totals = {}
+        for stats in pool_stats:
+            for key, counts in stats.items():
+                total = totals.setdefault(key, {'opened': 0, 'reused': 0})
+                total['opened'] += counts['opened']
+                total['reused'] += counts['reused']
+        for (user, db_name), stats in totals.items():
+            print(f"DB connections {user}@{db_name} (all processes): opened {stats['opened']}, reused {stats['reused']}")
+
+        return results, df_report
+
+    def _batch_config(self):
+        """
+        Returns the attributes needed by the batch workers as a picklable dictionary.
+        """
+
+        keys = ['db_name', 'user', 'db_table_reservoirs', 'db_table_points', 'db_table_S2_points_data',
+                'db_features_table', 'db_models', 'db_table_forecast', 'db_table_history', 'model_name',
+                'default_model', 'feature', 'meteo_features', 'freq', 't_shift', 'forecast_days', 'chunksize',
+                'max_oeo_jobs', 'db_table_job_ledger', 'incremental_imputation', 'db_table_imputation_state',
+                'aggregate_in_db', 'pool_size', 'max_overflow', 'meteo_grid_resolution', 'db_table_meteo_cells']
+
+        return {key: getattr(self, key) for key in keys}
+
+    def _meteo_cells_table(self):
+        """
+        Returns the table with the grid cells of the reservoirs if the meteo data are stored for the grid cells.
+        """
+
+        return self.db_table_meteo_cells if self.meteo_grid_resolution is not None else None
+
+    def close(self):
+        """
+        Closes all pooled database connections and the OpenEO session of the process.
+        """
+
+        dispose_engines()
+        close_session()
+
+
+def _batch_fetch(config, osm_id):
+    """
+    Batch worker for the I/O bound stage: fetches Sentinel-2 data and historical and predicted meteo data (if they
+    were not fetched for the whole batch) for the reservoir.
+
+    :param config: Dictionary with the AIHABs attributes
+    :param osm_id: OSM object id
+    :return: Duration of the stage in seconds
+    """
+
+    t0 = time.time()
+
+    get_s2_points_OEO(osm_id, config['db_name'], config['user'], config['db_table_reservoirs'],
+                      config['db_table_points'], config['db_table_S2_points_data'], max_jobs=config['max_oeo_jobs'],
+                      ledger_table=config['db_table_job_ledger'])
+    if not config.get('history_fetched'):
+        if config['meteo_grid_resolution'] is None:
+            getHistoricalMeteoData(osm_id, config['meteo_features'], config['user'], config['db_name'],
+                                   config['db_table_history'], config['db_table_reservoirs'])
+        else:
+            getHistoricalMeteoDataBatch([osm_id], config['meteo_features'], config['user'], config['db_name'],
+                                        config['db_table_history'], config['db_table_reservoirs'],
+                                        grid_resolution=config['meteo_grid_resolution'],
+                                        db_table_cells=config['db_table_meteo_cells'])
+    if not config.get('forecast_fetched'):
+        getPredictedMeteoData(osm_id, config['meteo_features'], config['user'], config['db_name'],
+                              config['db_table_forecast'], config['db_table_reservoirs'], config['forecast_days'])
+
+    return time.time() - t0
+
+
+def _batch_analyse(config, osm_id):
+    """
+    Batch worker for the CPU bound stage: calculates WQ feature and imputes the missing values for the reservoir. It
+    runs in a separate process.
+
+    :param config: Dictionary with the AIHABs attributes
+    :param osm_id: OSM object id
+    :return: GeoDataFrame with imputed data; GeoDataFrame with smoothed data; Duration of the stage in seconds;
+             Connection pool statistics of the worker process for the reservoir
+    """
+
+    t0 = time.time()
+    set_pool_config(pool_size=config['pool_size'], max_overflow=config['max_overflow'])
+    reset_pool_stats()
+
+    wq_results = calculate_feature(config['feature'], osm_id, config['db_name'], config['user'],
+                                   config['db_table_S2_points_data'], config['db_features_table'], config['db_models'],
+                                   model_name=config['model_name'], default_model=config['default_model'],
+                                   chunksize=config['chunksize'])
+    if wq_results is None:
+        raise ValueError(f"The WQ feature {config['feature']} was not calculated for OSM_ID: {osm_id}")
+
+    model_id = wq_results[1]
+
+    # The batch process pool already uses all CPU cores, so the imputation runs serially in the worker
+    gdf_imputed, gdf_smooth = data_imputation(config['db_name'], config['user'], osm_id, config['feature'], model_id,
+                                              config['db_features_table'], config['db_table_history'],
+                                              freq=config['freq'], t_shift=config['t_shift'], n_jobs=1,
+                                              incremental=config['incremental_imputation'],
+                                              db_table_state=config['db_table_imputation_state'],
+                                              aggregate_in_db=config['aggregate_in_db'],
+                                              db_table_meteo_cells=config['db_table_meteo_cells']
+                                              if config['meteo_grid_resolution'] is not None else None)
+
+    return gdf_imputed, gdf_smooth, time.time() - t0, get_pool_stats()
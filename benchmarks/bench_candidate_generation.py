@@ -0,0 +1,87 @@
+import time
+
+import numpy as np
+import geopandas as gpd
+
+from scipy.spatial import Delaunay, Voronoi
+from shapely.geometry import Polygon, Point
+
+from get_random_points import get_vertices, delaunay_centroid_coords, voronoi_centroid_coords, point_mesh_coords, \
+    in_polygon
+from benchmarks.bench_point_clipping import synthetic_lake
+
+
+def candidates_geometry(polygon, buffer):
+    """
+    Reference candidate generation (the previous generate_points_in_polygon): the triangles, Voronoi polygons and
+    the full bounding box mesh are created as shapely geometries and the centroids are computed by shapely.
+
+    :param polygon: Polygon geometry
+    :param buffer: Buffer polygon geometry
+    :return: Clipped candidate points (GeoDataFrame)
+    """
+
+    vertices = get_vertices(polygon)
+
+    tri = Delaunay(vertices)
+    triangles = gpd.GeoDataFrame(geometry=[Polygon(vertices[simplex]) for simplex in tri.simplices])
+
+    vor = Voronoi(vertices)
+    regions = [region for region in vor.regions if -1 not in region and len(region) > 0]
+    vor_polygons = gpd.GeoDataFrame(geometry=[Polygon(vor.vertices[region]) for region in regions])
+
+    minx, miny, maxx, maxy = polygon.bounds
+    latitudes = np.linspace(miny, maxy, int((maxy - miny) / 0.01))
+    longitudes = np.linspace(minx, maxx, int((maxx - minx) / 0.01))
+    mesh = gpd.GeoDataFrame(geometry=[Point(lon, lat) for lat in latitudes for lon in longitudes])
+
+    points = gpd.GeoDataFrame(geometry=gpd.pd.concat([triangles.centroid, vor_polygons.centroid, mesh.geometry],
+                                                     ignore_index=True))
+    if len(points) > 10000:
+        points = points.sample(10000, random_state=0)
+
+    return points[points.intersects(buffer)]
+
+
+def candidates_array(polygon, buffer):
+    """
+    Array-native candidate generation (generate_points_in_polygon): the centroids are computed from the coordinate
+    arrays and the point geometries are created for the clipped points only.
+
+    :param polygon: Polygon geometry
+    :param buffer: Buffer polygon geometry
+    :return: Clipped candidate points (GeoDataFrame)
+    """
+
+    vertices = get_vertices(polygon)
+    coords = np.vstack([delaunay_centroid_coords(vertices), voronoi_centroid_coords(vertices),
+                        point_mesh_coords(polygon)])
+    if len(coords) > 10000:
+        coords = coords[np.random.default_rng(0).choice(len(coords), 10000, replace=False)]
+
+    coords = coords[in_polygon(coords[:, 0], coords[:, 1], buffer)]
+
+    return gpd.GeoDataFrame(geometry=gpd.points_from_xy(coords[:, 0], coords[:, 1]), crs='epsg:4326')
+
+
+if __name__ == '__main__':
+
+    lakes = {
+        'small lake (~1 km2)': synthetic_lake(14.5, 49.2, 0.004, 200),
+        'large lake (~300 km2)': synthetic_lake(14.0, 49.0, 0.12, 5000),
+        'very large lake (~5000 km2)': synthetic_lake(13.5, 58.9, 0.5, 20000, seed=1),
+    }
+
+    for name, lake in lakes.items():
+        buffer = lake.buffer(-0.0003)
+
+        t0 = time.time()
+        reference = candidates_geometry(lake, buffer)
+        t_geometry = time.time() - t0
+
+        t0 = time.time()
+        points = candidates_array(lake, buffer)
+        t_array = time.time() - t0
+
+        print(f"{name}: {len(lake.exterior.coords)} vertices; geometry {t_geometry:.3f} s, array {t_array:.3f} s "
+              f"({t_geometry / t_array:.1f}x); {len(reference)} / {len(points)} clipped candidates")
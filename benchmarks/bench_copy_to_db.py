@@ -0,0 +1,78 @@
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from sqlalchemy import text
+
+from db_pool import get_engine
+from db_copy import copy_to_db
+from calculate_features import S2_BANDS
+
+
+def synthetic_s2_points(n_rows, n_points=1000):
+    """
+    Create synthetic Sentinel-2 point data with the same columns as the s2_points_eo_data table.
+
+    :param n_rows: Number of rows
+    :param n_points: Number of points (PIDs)
+    :return: GeoDataFrame
+    """
+
+    rng = np.random.default_rng(0)
+    pid = np.arange(n_rows) % n_points
+    dates = pd.Timestamp('2015-06-01') + pd.to_timedelta(np.arange(n_rows) // n_points, unit='D')
+
+    df = pd.DataFrame(rng.integers(0, 10000, size=(n_rows, len(S2_BANDS))).astype(float), columns=S2_BANDS)
+    df['date'] = dates.date
+    df['PID'] = pid
+    df['osm_id'] = '123456'
+
+    lon = 14.0 + (pid % 100) * 0.001
+    lat = 49.0 + (pid // 100) * 0.001
+
+    return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(lon, lat), crs='epsg:4326')
+
+
+def bench_write(gdf, db_table, engine):
+    """
+    Compare rows/sec of GeoDataFrame.to_postgis (row-wise INSERTs) and copy_to_db (COPY FROM STDIN).
+
+    :param gdf: GeoDataFrame to write
+    :param db_table: Name of the benchmark table (it is dropped before each run)
+    :param engine: SQLAlchemy engine
+    :return: Dictionary with rows/sec for both methods
+    """
+
+    results = {}
+
+    for method in ['to_postgis', 'copy_to_db']:
+        with engine.begin() as connection:
+            connection.execute(text("DROP TABLE IF EXISTS {db_table}".format(db_table=db_table)))
+
+        t0 = time.time()
+        if method == 'to_postgis':
+            gdf.to_postgis(db_table, con=engine, if_exists='append', index=False)
+        else:
+            copy_to_db(gdf, db_table, engine)
+        results[method] = len(gdf) / (time.time() - t0)
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS {db_table}".format(db_table=db_table)))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    db_name = "postgres"
+    user = "postgres"
+    db_table = "bench_copy_to_db"
+
+    engine = get_engine(user, db_name)
+
+    for n_rows in [10000, 100000, 1000000]:
+        rows_sec = bench_write(synthetic_s2_points(n_rows), db_table, engine)
+        print(f"{n_rows} rows: to_postgis {rows_sec['to_postgis']:.0f} rows/s, copy_to_db {rows_sec['copy_to_db']:.0f} "
+              f"rows/s ({rows_sec['copy_to_db'] / rows_sec['to_postgis']:.1f}x)")
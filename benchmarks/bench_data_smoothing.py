@@ -0,0 +1,60 @@
+import time
+
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+
+from data_imputation import data_smoothing
+
+
+def data_smoothing_per_column(df, frac=0.02):
+    """
+    Reference smoothing: statsmodels lowess called for each column separately (the previous data_smoothing).
+
+    :param df: The dataframe to be smoothed.
+    :param frac: The fraction of the data used when estimating each value.
+    :return: Smoothed dataframe.
+    """
+
+    x = np.asarray(df.index, dtype=float)
+    lowess_results = {i: sm.nonparametric.lowess(df[i], x, frac=frac, return_sorted=False) for i in df.columns}
+
+    return pd.DataFrame(lowess_results, index=df.index)
+
+
+def synthetic_series(n_dates, n_columns, freq='W'):
+    """
+    Create synthetic imputed time series (dates x PIDs) with a seasonal signal and noise.
+
+    :param n_dates: Number of dates
+    :param n_columns: Number of time series (PIDs)
+    :param freq: Time scale
+    :return: DataFrame
+    """
+
+    rng = np.random.default_rng(0)
+    index = pd.date_range('2015-06-07', periods=n_dates, freq=freq, name='date')
+    season = 10 + 5 * np.sin(2 * np.pi * np.arange(n_dates) / 52)[:, None]
+
+    return pd.DataFrame(season + rng.gamma(2.0, 2.0, size=(n_dates, n_columns)), index=index)
+
+
+if __name__ == '__main__':
+
+    n_dates = 520           # ten years of weekly data
+    n_columns = 5000
+
+    df = synthetic_series(n_dates, n_columns)
+
+    t0 = time.time()
+    df_reference = data_smoothing_per_column(df)
+    t_reference = time.time() - t0
+
+    t0 = time.time()
+    df_smooth = data_smoothing(df)
+    t_smooth = time.time() - t0
+
+    max_diff = np.max(np.abs(df_reference.values - df_smooth.values))
+
+    print(f"{n_dates} dates x {n_columns} columns: per-column lowess {t_reference:.2f} s, data_smoothing "
+          f"{t_smooth:.2f} s ({t_reference / t_smooth:.1f}x), max abs difference {max_diff:.2e}")
@@ -0,0 +1,88 @@
+import time
+
+import numpy as np
+import geopandas as gpd
+
+from sqlalchemy import text
+
+from db_pool import get_engine
+from oeo_session import set_connection
+from fake_backends import FakeOpenEOConnection
+from get_S2_points_OpenEO import OEOJobManager
+
+
+def synthetic_point_layer(n_points, osm_id='123456'):
+    """
+    Create synthetic sampling points of the reservoir (the same columns as get_sampling_points).
+
+    :param n_points: Number of points
+    :param osm_id: OSM object id
+    :return: GeoDataFrame
+    """
+
+    rng = np.random.default_rng(0)
+    lon = 14.0 + rng.random(n_points) * 0.01
+    lat = 49.0 + rng.random(n_points) * 0.01
+
+    return gpd.GeoDataFrame({'PID': np.arange(n_points), 'osm_id': osm_id}, geometry=gpd.points_from_xy(lon, lat),
+                            crs='epsg:4326')
+
+
+def monthly_slots(start_year, end_year):
+    """
+    Time slots of one month.
+    """
+
+    return [(f"{year}-{month:02d}-01", f"{year}-{month:02d}-28") for year in range(start_year, end_year + 1)
+            for month in range(1, 13)]
+
+
+def bench_fetch(point_layer, slots, db_table, user, db_name, max_jobs, **backend):
+    """
+    Runs the OpenEO job manager against the fake backend and measures the wall time, the number of jobs running at
+    once and the written rows.
+
+    :param point_layer: Sampling points
+    :param slots: Time slots
+    :param db_table: Name of the benchmark table (it is dropped before the run)
+    :param user: Database user
+    :param db_name: Database name
+    :param max_jobs: Maximum number of jobs running at once
+    :param backend: Parameters of the FakeOpenEOConnection
+    :return: Dictionary with the results
+    """
+
+    engine = get_engine(user, db_name)
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS {db_table}".format(db_table=db_table)))
+
+    connection = FakeOpenEOConnection(**backend)
+    set_connection(connection)
+
+    manager = OEOJobManager(point_layer['osm_id'].iloc[0], point_layer, db_name, user, db_table, max_jobs=max_jobs,
+                            poll_interval=0.1, ledger_table=None, retry_delay=1)
+
+    t0 = time.time()
+    results = manager.run(slots)
+    duration = time.time() - t0
+
+    return {'time': duration, 'max_running': connection.max_running, 'jobs': connection.calls.get('create_job', 0),
+            'rows': sum(result['rows'] or 0 for result in results),
+            'failed': sum(result['status'] == 'failed' for result in results)}
+
+
+if __name__ == '__main__':
+
+    db_name = "postgres"
+    user = "postgres"
+    db_table = "bench_fetch"
+
+    point_layer = synthetic_point_layer(200)
+    slots = monthly_slots(2020, 2021)
+
+    for failure_rate in [0.0, 0.2]:
+        for max_jobs in [1, 4, 12]:
+            result = bench_fetch(point_layer, slots, db_table, user, db_name, max_jobs, job_duration=(1.0, 3.0),
+                                 failure_rate=failure_rate, no_data_rate=0.05)
+            print(f"failure rate {failure_rate}, max_jobs {max_jobs}: {result['time']:.1f} s, {result['jobs']} jobs "
+                  f"({result['max_running']} at once), {result['rows']} rows, {result['failed']} failed windows")
@@ -0,0 +1,105 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from multiprocessing import Pool
+from shapely.geometry import Polygon
+
+from get_random_points import points_clip, get_vertices, delaunay_centroids, voronoi_centroids, point_mesh
+
+
+def points_clip_intersects(points, polygon):
+    """
+    Reference clipping by GeoSeries.intersects (the previous points_clip).
+    """
+
+    return points[points.intersects(polygon)]
+
+
+def points_clip_pool(points, polygon):
+    """
+    Reference clipping: the points are split to os.cpu_count() chunks clipped in a multiprocessing Pool (the previous
+    generate_points_in_polygon). The remainder rows of the division are not clipped.
+
+    :param points: GeoDataFrame with points
+    :param polygon: Polygon geometry
+    :return: Clipped points (GeoDataFrame)
+    """
+
+    num_processes = os.cpu_count()
+    chunk_size = len(points) // num_processes
+    points_subsets = [points.iloc[i * chunk_size: (i + 1) * chunk_size] for i in range(num_processes)]
+
+    with Pool(num_processes) as pool:
+        results = pool.starmap(points_clip_intersects, [(subset, polygon) for subset in points_subsets])
+
+    return gpd.GeoDataFrame(pd.concat(results))
+
+
+def synthetic_lake(lon, lat, radius, n_vertices, roughness=0.3, seed=0):
+    """
+    Create a synthetic lake polygon with an irregular shore line.
+
+    :param lon: Longitude of the centre
+    :param lat: Latitude of the centre
+    :param radius: Mean radius in degrees
+    :param n_vertices: Number of vertices of the shore line
+    :param roughness: Relative amplitude of the shore line irregularity
+    :param seed: Seed of the random generator
+    :return: Polygon
+    """
+
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+
+    # Sum of harmonics with decreasing amplitude (bays and peninsulas)
+    r = np.ones(n_vertices)
+    for k in range(2, 60):
+        r += roughness / k * np.sin(k * angles + rng.uniform(0, 2 * np.pi))
+
+    return Polygon(np.column_stack([lon + radius * r * np.cos(angles) * 1.6, lat + radius * r * np.sin(angles)]))
+
+
+def candidates(polygon):
+    """
+    Candidate points for the polygon as in generate_points_in_polygon (at most 10000 points).
+    """
+
+    vertices = get_vertices(polygon)
+    gdf = pd.concat([delaunay_centroids(vertices), voronoi_centroids(vertices),
+                     point_mesh(gpd.GeoDataFrame(geometry=[polygon]))], ignore_index=True)
+
+    if len(gdf) > 10000:
+        gdf = gdf.sample(10000, random_state=0)
+
+    return gpd.GeoDataFrame(gdf, geometry='geometry', crs='epsg:4326')
+
+
+if __name__ == '__main__':
+
+    lakes = {
+        'small lake (~1 km2)': synthetic_lake(14.5, 49.2, 0.004, 200),
+        'very large lake (~5000 km2)': synthetic_lake(13.5, 58.9, 0.5, 20000, seed=1),
+    }
+
+    for name, lake in lakes.items():
+        buffer = lake.buffer(-0.0003)
+        points = candidates(lake)
+
+        t0 = time.time()
+        clipped_pool = points_clip_pool(points, buffer)
+        t_pool = time.time() - t0
+
+        t0 = time.time()
+        clipped = points_clip(points, buffer)
+        t_vector = time.time() - t0
+
+        n_dropped = len(points) % os.cpu_count()
+        same = clipped_pool.index.equals(clipped.index[clipped.index.isin(points.index[:len(points) - n_dropped])])
+
+        print(f"{name}: {len(points)} candidates, {len(lake.exterior.coords)} vertices; Pool ({os.cpu_count()} "
+              f"processes) {t_pool:.3f} s, vectorized {t_vector:.4f} s ({t_pool / t_vector:.0f}x); "
+              f"{len(clipped)} points kept, the Pool path skipped {n_dropped} candidates; same result: {same}")
@@ -5,13 +5,25 @@ import geopandas as gpd
 import numpy as np
 import dill
 import base64
+import threading
 
-from sqlalchemy import create_engine, exc, text
+from collections import OrderedDict
+from sqlalchemy import exc, text
 import datetime
 from AIHABs_wrappers import measure_execution_time
+from db_pool import get_engine
+from db_copy import copy_to_db
 from warnings import warn
 
 
+# Sentinel 2 L2A bands used as the input of the models
+S2_BANDS = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B11', 'B12']
+
+# In-process LRU cache of the loaded models {(model_id, pkl_hash): (model, size)}
+_model_cache = OrderedDict()
+_model_cache_limits = {'max_items': 8, 'max_bytes': 512 * 1024 * 1024}
+_model_cache_lock = threading.Lock()
+
 def get_wq_db_last_date(osm_id, feature, db_name, user, db_table, model_id=None):
     """
     Get last date db table for particular OSM id and water quality feature
@@ -25,7 +37,7 @@ def get_wq_db_last_date(osm_id, feature, db_name, user, db_table, model_id=None)
     """
 
     # Connect to PostGIS
-    engine = create_engine('postgresql://{}@/{}'.format(user, db_name))
+    engine = get_engine(user, db_name)
 
 
     # Test the table existence in the DB
@@ -63,7 +75,6 @@ def get_wq_db_last_date(osm_id, feature, db_name, user, db_table, model_id=None)
         last_date = df.iloc[0,0]
 
     connection.close()
-    engine.dispose()
 
     return last_date
 
@@ -82,37 +93,128 @@ def execute_query(connection, query):
     return result.scalar()
 
 
-def get_model_query(db_table, feature, variable=None, osm_id=None, model_name=None, is_default=False):
+def get_model_query(db_table, feature, osm_id=None, model_name=None, is_default=False):
     """
-    The set of SQL queries for choosing the requested model for a WQ feature calculation.
+    SQL query for choosing the requested model for a WQ feature calculation. The fallback cascade (default model,
+    model for OSM object and name, model name, OSM object, default model, last model) is resolved by ranking of the
+    models in one query. The query returns model ID, MD5 hash of the Pickle file and the rank of the selected model.
 
     :param db_table: Name of the db table wth AI models
     :param feature: Water quality feature (e.g. ChlA, PC, TSS...)
-    :param variable: Variable name in the table for data selection
     :param osm_id: OSM object id
     :param model_name: Name of the model
     :param is_default: Is the model default
+    :return: SQL query and its parameters
+    """
+
+    query = text("SELECT model_id, md5(pkl_file) AS pkl_hash, rank FROM ("
+                 "SELECT id, model_id, pkl_file, CASE "
+                 "WHEN :is_default AND is_default THEN 1 "
+                 "WHEN osm_id = :osm_id AND model_name = :model_name THEN 2 "
+                 "WHEN model_name = :model_name THEN 3 "
+                 "WHEN osm_id = :osm_id THEN 4 "
+                 "WHEN is_default THEN 5 "
+                 "ELSE 6 END AS rank "
+                 "FROM {db_table} WHERE feature = :feature) AS ranked "
+                 "ORDER BY rank, id DESC LIMIT 1".format(db_table=db_table))
+
+    params = {
+        'feature': feature,
+        'osm_id': str(osm_id) if osm_id else None,
+        'model_name': str(model_name) if model_name else None,
+        'is_default': bool(is_default),
+    }
+
+    return query, params
+
+
+def set_model_cache_limits(max_items=None, max_bytes=None):
+    """
+    Set the limits of the in-process cache of the loaded models. The least recently used models are evicted when
+    any of the limits is exceeded.
+
+    :param max_items: Maximum number of cached models
+    :param max_bytes: Maximum size of the cached models (size of the serialized models)
     :return:
     """
 
-    if is_default:
-        return text(f"SELECT {variable} FROM {db_table} WHERE is_default = true AND feature = '{feature}' ORDER BY id "
-                    f"DESC LIMIT 1")
-    elif osm_id and model_name:
-        return text(f"SELECT {variable} FROM {db_table} WHERE osm_id = '{osm_id}' AND model_name = '{model_name}' AND "
-                    f"feature = '{feature}' ORDER BY id DESC LIMIT 1")
-    elif osm_id:
-        return text(f"SELECT {variable} FROM {db_table} WHERE osm_id = '{osm_id}' AND feature = '{feature}' ORDER BY id DESC LIMIT 1")
-    elif model_name:
-        return text(f"SELECT {variable} FROM {db_table} WHERE model_name = '{model_name}' AND feature = '{feature}' "
-                    f"ORDER BY id DESC LIMIT 1")
-    else:
-        return text(f"SELECT {variable} FROM {db_table} WHERE feature = '{feature}' ORDER BY id DESC LIMIT 1")
+    with _model_cache_lock:
+        if max_items is not None:
+            _model_cache_limits['max_items'] = int(max_items)
+        if max_bytes is not None:
+            _model_cache_limits['max_bytes'] = int(max_bytes)
+        _evict_models()
+
+    return
+
+
+def clear_model_cache():
+    """
+    Remove all models from the in-process cache. It is called when the models table is changed.
+
+    :return:
+    """
+
+    with _model_cache_lock:
+        _model_cache.clear()
+
+    return
+
+
+def _evict_models():
+    """
+    Evict the least recently used models until the cache is within its limits.
+
+    :return:
+    """
+
+    while _model_cache and (len(_model_cache) > _model_cache_limits['max_items'] or
+                            sum(size for model, size in _model_cache.values()) > _model_cache_limits['max_bytes']):
+        _model_cache.popitem(last=False)
+
+    return
+
+
+def load_model(connection, db_models, model_id, pkl_hash):
+    """
+    Load the model from the in-process LRU cache. The model is read from the database and deserialized only if it is
+    not cached. The cache key is the model ID and the hash of the Pickle file, so the changed model is loaded again.
+
+    :param connection: connection to Postgres engine
+    :param db_models: Database table with AI models
+    :param model_id: Model ID
+    :param pkl_hash: MD5 hash of the Pickle file
+    :return: Model object
+    """
+
+    key = (model_id, pkl_hash)
+
+    with _model_cache_lock:
+        if key in _model_cache:
+            _model_cache.move_to_end(key)
+            return _model_cache[key][0]
+
+    query = text(f"SELECT pkl_file FROM {db_models} WHERE model_id = :model_id AND md5(pkl_file) = :pkl_hash LIMIT 1")
+    result = connection.execute(query, {'model_id': model_id, 'pkl_hash': pkl_hash}).scalar()
+
+    if not result:
+        return None
+
+    result = base64.b64decode(result)
+    model = dill.loads(result)
+
+    with _model_cache_lock:
+        _model_cache[key] = (model, len(result))
+        _model_cache.move_to_end(key)
+        _evict_models()
+
+    return model
 
 
 def select_model(db_name, user, db_models, feature='ChlA', osm_id=None, model_name=None, default=True):
     """
-    Function for selecting model for a particular feature from the database.
+    Function for selecting model for a particular feature from the database. The model is selected by one ranked
+    query and the loaded models are cached in the process.
 
     :param db_name: Database name
     :param user: Database user
@@ -124,76 +226,86 @@ def select_model(db_name, user, db_models, feature='ChlA', osm_id=None, model_na
     :return:
     """
 
-    engine = create_engine(f'postgresql://{user}@/{db_name}')
-    connection = engine.connect()
+    engine = get_engine(user, db_name)
 
-    # 1. test if the model for particular feature is available
-    test_feature_query = text(f"SELECT 1 FROM {db_models} WHERE feature = '{feature}' LIMIT 1")
-    feature_exists = execute_query(connection, test_feature_query)
+    # Select the model ID by the fallback cascade
+    model_query, params = get_model_query(db_models, feature, osm_id=osm_id, model_name=model_name, is_default=default)
 
-    if not feature_exists:
-        warn(f"The water quality feature {feature} does not exist in the database. The analysis will be stopped.", stacklevel=2)
-        return None
+    with engine.connect() as connection:
+        selected = connection.execute(model_query, params).first()
 
-    # 2. select by default, osm_id and name
-    model_query = None
-    model_id = None
-
-    if default:
-        test_default_query = text(f"SELECT 1 FROM {db_models} WHERE is_default = true AND feature = '{feature}' LIMIT 1")
-        if execute_query(connection, test_default_query):
-            model_query = get_model_query(db_models, feature, variable='pkl_file', is_default=True)
-            model_id = get_model_query(db_models, feature, variable='model_id', is_default=True)
-
-    if model_query is None and osm_id and model_name:
-        test_osmid_name_query = text(f"SELECT 1 FROM {db_models} WHERE osm_id = '{osm_id}' AND model_name = '{model_name}' AND feature = '{feature}' LIMIT 1")
-        if execute_query(connection, test_osmid_name_query):
-            model_query = get_model_query(db_models, feature, variable='pkl_file', osm_id=osm_id, model_name=model_name)
-            model_id = get_model_query(db_models, feature, variable='model_id', osm_id=osm_id, model_name=model_name)
-
-    if model_query is None and model_name:
-        test_model_name_query = text(f"SELECT 1 FROM {db_models} WHERE model_name = '{model_name}' AND feature = '{feature}' LIMIT 1")
-        if execute_query(connection, test_model_name_query):
-            model_query = get_model_query(db_models, feature, variable='pkl_file', model_name=model_name)
-            model_id = get_model_query(db_models, feature, variable='model_id', model_name=model_name)
-
-    if model_query is None and osm_id:
-        test_osmid_query = text(f"SELECT 1 FROM {db_models} WHERE osm_id = '{osm_id}' AND feature = '{feature}' LIMIT 1")
-        if execute_query(connection, test_osmid_query):
-            model_query = get_model_query(db_models, feature, variable='pkl_file', osm_id=osm_id)
-            model_id = get_model_query(db_models, feature, variable='model_id', osm_id=osm_id)
-
-    if model_query is None:
-        # In that case select default model
-        test_default_query = text(
-            f"SELECT 1 FROM {db_models} WHERE is_default = true AND feature = '{feature}' LIMIT 1")
-        if execute_query(connection, test_default_query):
+        # Test if the model for particular feature is available
+        if selected is None:
+            warn(f"The water quality feature {feature} does not exist in the database. The analysis will be stopped.", stacklevel=2)
+            return None
+
+        m_id, pkl_hash, rank = selected
+
+        if rank == 5:
             warn(f"The requested model does not exist in the database. The default model will be used.",
                  stacklevel=2)
-            model_query = get_model_query(db_models, feature, variable='pkl_file', is_default=True)
-            model_id = get_model_query(db_models, feature, variable='model_id', is_default=True)
-        else:
-            # Select the last model if default does not exist
+        elif rank == 6:
             warn(f"The requested model does not exist in the database. The last available model will be used.",
                  stacklevel=2)
-            model_query = get_model_query(db_models, feature, variable='pkl_file')
-            model_id = get_model_query(db_models, feature, variable='model_id')
 
-    # Get prediction model from DB and model ID
-    result = execute_query(connection, model_query)
-    m_id = execute_query(connection, model_id)
-    connection.close()
-    engine.dispose()
+        # Get prediction model from cache or DB
+        model = load_model(connection, db_models, m_id, pkl_hash)
 
-    if result:
-        result = base64.b64decode(result)
-        return dill.loads(result), m_id
+    if model is not None:
+        return model, m_id
 
     return None
 
+
+def get_band_block(gdf_data):
+    """
+    Build the input data for the prediction model as one contiguous float32 array (n, 12) of Sentinel 2 L2A surface
+    reflectances. The missing values are replaced by 1.0.
+
+    :param gdf_data: GeoDataFrame with Sentinel 2 L2A bands data
+    :return: Array of the band values (rows - samples, columns - bands)
+    """
+
+    band_block = gdf_data[S2_BANDS].to_numpy(dtype=np.float32, copy=True)
+    band_block *= np.float32(0.0001)
+    np.nan_to_num(band_block, copy=False, nan=1.0)
+
+    return band_block
+
+
+def predict_feature(gdf_data, prediction_model, feature, model_id):
+    """
+    Calculate water quality feature for the Sentinel 2 L2A bands data.
+
+    :param gdf_data: GeoDataFrame with Sentinel 2 L2A bands data
+    :param prediction_model: AI model for the feature
+    :param feature: Water quality feature
+    :param model_id: Model ID
+    :return: GeoDataFrame with water quality feature values
+    """
+
+    # Define input parameters for the model. The model gets the bands in the order B01, ..., B12 (transposed view
+    # of the band block).
+    band_block = get_band_block(gdf_data)
+
+    # Calculate WQ feature values
+    wq_values = prediction_model.predict(band_block.T)
+
+    selected_columns = ['osm_id', 'date', 'PID', 'geometry']
+    gdf_out = gdf_data[selected_columns].copy()
+    gdf_out['feature_value'] = wq_values
+    gdf_out['feature'] = feature
+    gdf_out['model_id'] = model_id
+
+    # Set CRS of the output GeoDataFrame geometry
+    gdf_out = gdf_out.set_crs("EPSG:4326", allow_override=True)
+
+    return gdf_out
+
+
 @measure_execution_time
 def calculate_feature(feature, osm_id, db_name, user, db_bands_table, db_features_table, db_models, model_name=None,
-                      default_model=False, **kwargs):
+                      default_model=False, chunksize=None, **kwargs):
     """
     Function for calculating water quality feature for a particular OSM object from the Sentinel 2 L2A bands.
 
@@ -206,12 +318,14 @@ def calculate_feature(feature, osm_id, db_name, user, db_bands_table, db_feature
     :param db_models: DB table with AI models (stored as Pickle object)
     :param model_name: Name of the model
     :param default_model: Is the model default
+    :param chunksize: Number of rows read, predicted and stored at once (streaming mode). Default None - all the data
+        are read at once
     :param kwargs: Additional parameters
-    :return: Output water quality dataset; Model ID
+    :return: Output water quality dataset (number of stored rows in the streaming mode); Model ID
     """
 
     # Connect to PostGIS
-    engine = create_engine('postgresql://{}@/{}'.format(user, db_name))
+    engine = get_engine(user, db_name)
     connection = engine.connect()
 
     ## Get Pickle model and its ID from the database
@@ -234,58 +348,60 @@ def calculate_feature(feature, osm_id, db_name, user, db_bands_table, db_feature
         start_date = '2015-06-01'
         start_date = datetime.datetime.strptime(start_date, "%Y-%m-%d").date() + datetime.timedelta(days=1)
 
-    # Get data for calculation from the bands DB table
-    sql_query = text("SELECT * FROM {db_bands_table} WHERE osm_id = '{osm_id}' and date > '{start_date}'".format(
-        osm_id=str(osm_id), start_date=start_date, db_bands_table=db_bands_table))
-    gdf_data = gpd.read_postgis(sql_query, connection, geom_col='geometry')
-
-    # Calculate the wq feature
-    if gdf_data.empty:
-        warn("The data are not available in the database. The result is None.", stacklevel=2)
-
+    # Run the prediction model
+    if prediction_model is None:
         connection.close()
-        engine.dispose()
-
         return None
 
-    else:
-        # Define input parameters for the model
-        B01 = np.nan_to_num(gdf_data['B01'].values * 0.0001, nan=1.0)
-        B02 = np.nan_to_num(gdf_data['B02'].values * 0.0001, nan=1.0)
-        B03 = np.nan_to_num(gdf_data['B03'].values * 0.0001, nan=1.0)
-        B04 = np.nan_to_num(gdf_data['B04'].values * 0.0001, nan=1.0)
-        B05 = np.nan_to_num(gdf_data['B05'].values * 0.0001, nan=1.0)
-        B06 = np.nan_to_num(gdf_data['B06'].values * 0.0001, nan=1.0)
-        B07 = np.nan_to_num(gdf_data['B07'].values * 0.0001, nan=1.0)
-        B08 = np.nan_to_num(gdf_data['B08'].values * 0.0001, nan=1.0)
-        B8A = np.nan_to_num(gdf_data['B8A'].values * 0.0001, nan=1.0)
-        B09 = np.nan_to_num(gdf_data['B09'].values * 0.0001, nan=1.0)
-        B11 = np.nan_to_num(gdf_data['B11'].values * 0.0001, nan=1.0)
-        B12 = np.nan_to_num(gdf_data['B12'].values * 0.0001, nan=1.0)
-
-        input_data = [B01, B02, B03, B04, B05, B06, B07, B08, B8A, B09, B11, B12]
-
-        # Run the prediction model
-        if prediction_model is None:
-            return None
-
-        # Calculate WQ feature values
-        wq_values = prediction_model.predict(input_data)
+    # Get data for calculation from the bands DB table (only the columns needed for the prediction)
+    columns = ', '.join(['osm_id', 'date', '"PID"', 'geometry'] + ['"{}"'.format(band) for band in S2_BANDS])
+    # The rows are ordered by date: the results are resumed from the last stored date (see get_wq_db_last_date)
+    sql_query = text("SELECT {columns} FROM {db_bands_table} WHERE osm_id = '{osm_id}' and date > '{start_date}' "
+                     "ORDER BY date, \"PID\"".format(columns=columns, osm_id=str(osm_id), start_date=start_date,
+                                                    db_bands_table=db_bands_table))
 
-        # Save the results to the database
-        selected_columns = ['osm_id', 'date', 'PID', 'geometry']
-        gdf_out = gdf_data[selected_columns].copy()
-        gdf_out['feature_value'] = wq_values
-        gdf_out['feature'] = feature
-        gdf_out['model_id'] = model_id
+    if chunksize is None:
+        chunks = [gpd.read_postgis(sql_query, connection, geom_col='geometry')]
+    else:
+        # Streaming mode: the rows are read by the server-side cursor in chunks
+        stream_connection = connection.execution_options(stream_results=True, max_row_buffer=chunksize)
+        chunks = gpd.read_postgis(sql_query, stream_connection, geom_col='geometry', chunksize=chunksize)
+
+    # Calculate the wq feature and save the results to the database chunk by chunk. Each chunk is committed
+    # separately, so the rows of the last date of the chunk are held back to the next chunk: only the complete dates
+    # are stored and the interrupted run is resumed from the last stored date without gaps.
+    gdf_out = None
+    n_rows = 0
+    gdf_carry = None
+    for gdf_data in chunks:
+        if gdf_carry is not None:
+            gdf_data = pd.concat([gdf_carry, gdf_data], ignore_index=True)
+            gdf_carry = None
+
+        if chunksize is not None and not gdf_data.empty:
+            last_date = gdf_data['date'].iloc[-1]
+            gdf_carry = gdf_data[gdf_data['date'] == last_date]
+            gdf_data = gdf_data[gdf_data['date'] != last_date]
+
+        if gdf_data.empty:
+            continue
+
+        gdf_out = predict_feature(gdf_data, prediction_model, feature, model_id)
+        copy_to_db(gdf_out, db_features_table, engine)
+        n_rows += len(gdf_out)
+
+    if gdf_carry is not None and not gdf_carry.empty:
+        gdf_out = predict_feature(gdf_carry, prediction_model, feature, model_id)
+        copy_to_db(gdf_out, db_features_table, engine)
+        n_rows += len(gdf_out)
 
-        # Set CRS of the output GeoDataFrame geometry
-        gdf_out.set_crs("EPSG:4326")
+    connection.close()
 
-        # Save the results to the database
-        gdf_out.to_postgis(db_features_table, con=engine, if_exists='append', index=False)
+    if n_rows == 0:
+        warn("The data are not available in the database. The result is None.", stacklevel=2)
+        return None
 
-        connection.close()
-        engine.dispose()
+    if chunksize is not None:
+        return n_rows, model_id
 
-        return gdf_out, model_id
+    return gdf_out, model_id
@@ -2,19 +2,51 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np
 import statsmodels.api as sm
+import dill
 
-from sqlalchemy import create_engine, text
+from warnings import warn
+from pandas.tseries.frequencies import to_offset
+from datetime import datetime
+from sqlalchemy import text
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.svm import SVR
 from sklearn.impute import SimpleImputer
+from sklearn.metrics.pairwise import rbf_kernel
+from joblib import Parallel, delayed, effective_n_jobs
 
 from AIHABs_wrappers import measure_execution_time
+from db_pool import get_engine
 
 
-def create_dataset(db_name, user, osm_id, feature, model_id, db_wq_results, db_table_history, freq='W'):
+# Parameters of the SVR models used for the imputation
+SVR_C = 100
+SVR_GAMMA = 0.1
+SVR_EPSILON = 0.1
+
+
+# Labels of the aggregated periods (the same as pandas resample: end of the week (Sunday) or the month)
+SQL_PERIODS = {
+    'D': "date::date",
+    'W': "(date_trunc('week', date) + interval '6 days')::date",
+    'M': "(date_trunc('month', date) + interval '1 month - 1 day')::date",
+    'ME': "(date_trunc('month', date) + interval '1 month - 1 day')::date",
+}
+
+
+def create_dataset(db_name, user, osm_id, feature, model_id, db_wq_results, db_table_history, freq='W',
+                   aggregate_in_db=False, db_table_meteo_cells=None, start_date=None, bounds=None, return_bounds=False):
     """
     Creates a dataset with time series of water quality feature and meteo data, along with the geometry and prepare it for missing data imputation.
 
+    With start_date only the data from the date are read. The outliers of such a partial dataset should be detected by
+    the bounds of the whole history (see outlier_bounds), otherwise they are computed from the read data.
+
+    With aggregate_in_db the medians of the periods are computed in the database (see query_aggregated_dataset), so
+    only the aggregated data are transferred. Otherwise, the daily data are aggregated by pandas.
+
+    With db_table_meteo_cells the meteo data are stored for the grid cells (cell_id) and read through the mapping of
+    the reservoirs to the cells (see get_meteo.getMeteoCells).
+
     :param db_name: Database name
     :param user: Database user
     :param osm_id: OSM object id
@@ -23,18 +55,122 @@ def create_dataset(db_name, user, osm_id, feature, model_id, db_wq_results, db_t
     :param db_wq_results: Water quality results PostGIS table
     :param db_table_history: Historical meteo data PostGIS table
     :param freq: Time scale (W - weekly, D - daily, M - monthly)
-    :return: Dataset with time series of water quality feature and meteo data; Geometry GeoDataFrame
+    :param aggregate_in_db: Compute the medians of the periods in the database. Default False
+    :param db_table_meteo_cells: Table with the grid cells of the reservoirs. Default None - the meteo data are stored
+                                 for each reservoir
+    :param start_date: First date of the read data. Default None - the whole history
+    :param bounds: Outlier bounds (see outlier_bounds). Default None - computed from the read data
+    :param return_bounds: Return also the outlier bounds. Default False
+    :return: Dataset with time series of water quality feature and meteo data; Geometry GeoDataFrame; Outlier bounds
+             (only with return_bounds)
     """
 
     # Connect to PostGIS
-    engine = create_engine('postgresql://{user}@/{db_name}'.format(user=user, db_name=db_name))
+    engine = get_engine(user, db_name)
+
+    if aggregate_in_db and freq not in SQL_PERIODS:
+        warn(f"The aggregation for the frequency {freq} is not available in the database. The data will be "
+             f"aggregated by pandas.", stacklevel=2)
+        aggregate_in_db = False
+
+    if aggregate_in_db:
+        df_full, df_geo = query_aggregated_dataset(engine, osm_id, feature, model_id, db_wq_results, db_table_history,
+                                                   freq=freq, db_table_meteo_cells=db_table_meteo_cells,
+                                                   start_date=start_date)
+    else:
+        df_full, df_geo = query_daily_dataset(engine, osm_id, feature, model_id, db_wq_results, db_table_history,
+                                              freq=freq, db_table_meteo_cells=db_table_meteo_cells,
+                                              start_date=start_date)
+
+    if bounds is None:
+        bounds = outlier_bounds(df_full)
+
+    # Outliers detection and replacing
+    # Replacing outliers occurred in the winter months
+    winter_months_mask = df_full.index.month.isin([11, 12, 1, 2])
+    df_full.loc[winter_months_mask] = df_full.loc[winter_months_mask].where(
+        df_full.loc[winter_months_mask] <= bounds['mean'], np.nan)
+
+    # Detection and replacing outliers in the dataset
+    for col in df_full.columns[1:]:
+        df_full[col] = df_full[col].where((df_full[col] >= bounds['lower'].get(col, -np.inf)) &
+                                          (df_full[col] <= bounds['upper'].get(col, np.inf)), np.nan)
+
+    if return_bounds:
+        return df_full, df_geo, bounds
+
+    return df_full, df_geo
+
+
+def outlier_bounds(df_full):
+    """
+    Computes the bounds used by the outlier detection of create_dataset: the means of the columns (the winter values
+    above the mean are outliers) and the interquartile range bounds of the columns after the winter outliers are
+    replaced (see detect_and_replace_outliers).
+
+    :param df_full: Dataset with time series of water quality feature and meteo data
+    :return: Dictionary {'mean': Series, 'lower': Series, 'upper': Series}
+    """
+
+    means = df_full.mean()
+
+    winter_months_mask = df_full.index.month.isin([11, 12, 1, 2])
+    df = df_full.copy()
+    df.loc[winter_months_mask] = df.loc[winter_months_mask].where(df.loc[winter_months_mask] <= means, np.nan)
+
+    Q1 = df.quantile(0.25)
+    Q3 = df.quantile(0.75)
+    IQR = Q3 - Q1
+
+    return {'mean': means, 'lower': Q1 - 1.5 * IQR, 'upper': Q3 + 1.5 * IQR}
+
+
+def _meteo_source(db_table_history, db_table_meteo_cells=None):
+    """
+    FROM clause of the meteo data of the reservoir (filtered by osm_id). The meteo data of the grid cells are joined
+    with the mapping of the reservoirs to the cells.
+
+    :param db_table_history: Historical meteo data PostGIS table
+    :param db_table_meteo_cells: Table with the grid cells of the reservoirs (None - the meteo data of the reservoirs)
+    :return: FROM clause
+    """
+
+    if db_table_meteo_cells is None:
+        return db_table_history
+
+    return "{db_table} JOIN (SELECT osm_id, cell_id FROM {db_table_cells}) AS cells USING (cell_id)".format(
+        db_table=db_table_history, db_table_cells=db_table_meteo_cells)
+
+
+def query_daily_dataset(engine, osm_id, feature, model_id, db_wq_results, db_table_history, freq='W',
+                        db_table_meteo_cells=None, start_date=None):
+    """
+    Reads the daily water quality feature and meteo data from the database and aggregates them to the periods by
+    pandas.
+
+    :param engine: SQLAlchemy engine
+    :param osm_id: OSM object id
+    :param feature: Water quality feature
+    :param model_id: Quality feature model ID
+    :param db_wq_results: Water quality results PostGIS table
+    :param db_table_history: Historical meteo data PostGIS table
+    :param freq: Time scale (W - weekly, D - daily, M - monthly)
+    :param db_table_meteo_cells: Table with the grid cells of the reservoirs. Default None
+    :param start_date: First date of the read data. Default None - the whole history
+    :return: Dataset with medians of the periods (periods x PIDs and meteo variables); Geometry GeoDataFrame
+    """
+
+    date_filter = "" if start_date is None else " AND date >= '{start_date}'".format(
+        start_date=pd.Timestamp(start_date).date())
 
     # Define SQL queries for features, history and forecast
     query_feature = text(
-        "SELECT * FROM {db_table} WHERE osm_id = '{osm_id}' AND feature = '{feature}' AND model_id = '{model_id}'".format(
-            db_table=db_wq_results, osm_id=osm_id, feature=feature, model_id=model_id))
+        "SELECT * FROM {db_table} WHERE osm_id = '{osm_id}' AND feature = '{feature}' AND model_id = '{model_id}'{date_filter}".format(
+            db_table=db_wq_results, osm_id=osm_id, feature=feature, model_id=model_id, date_filter=date_filter))
     query_history = text(
-        "SELECT * FROM {db_table} WHERE osm_id = '{osm_id}'".format(db_table=db_table_history, osm_id=osm_id))
+        "SELECT {db_table}.* FROM {source} WHERE osm_id = '{osm_id}'{date_filter}".format(
+            db_table=db_table_history, source=_meteo_source(db_table_history, db_table_meteo_cells), osm_id=osm_id,
+            date_filter=date_filter))
 
     # Get feature data from PostGIS
     df_feature = gpd.read_postgis(query_feature, engine, geom_col='geometry')
@@ -44,7 +180,6 @@ def create_dataset(db_name, user, osm_id, feature, model_id, db_wq_results, db_t
 
     # Get meteo data from PostGIS
     df_meteo = pd.read_sql(query_history, engine)
-    engine.dispose()
 
     # Convert fetaure data to matrix
     df = df_feature.pivot(index='date', columns='PID', values='feature_value')
@@ -62,29 +197,103 @@ def create_dataset(db_name, user, osm_id, feature, model_id, db_wq_results, db_t
     df_full = df_full.join(df_meteo, how='left')
 
     # Drop unnecessary columns
-    df_full.drop(columns=['osm_id'], inplace=True)
+    df_full.drop(columns=['osm_id', 'cell_id'], inplace=True, errors='ignore')
 
     # Rescale daily data to weekly data
     df_full = df_full.resample(freq).median()
 
-    # Outliers detection and replacing
-    # Replacing outliers occurred in the winter months
-    winter_months_mask = df_full.index.month.isin([11, 12, 1, 2])
-    df_full.loc[winter_months_mask] = df_full.loc[winter_months_mask].where(
-        df_full.loc[winter_months_mask] <= df_full.mean(), np.nan)
+    return df_full, df_geo
 
-    # Detection and replacing outliers in the dataset
-    for col in df_full.columns[1:]:
-        df_full[col] = detect_and_replace_outliers(df_full[col])
+
+def query_aggregated_dataset(engine, osm_id, feature, model_id, db_wq_results, db_table_history, freq='W',
+                             db_table_meteo_cells=None, start_date=None):
+    """
+    Computes the medians of the water quality feature (for each PID) and of the meteo data for the periods in the
+    database (date_trunc and percentile_cont). The meteo data are limited to the dates of the feature data. The
+    geometry is read once for each PID. The result is the same as for query_daily_dataset.
+
+    :param engine: SQLAlchemy engine
+    :param osm_id: OSM object id
+    :param feature: Water quality feature
+    :param model_id: Quality feature model ID
+    :param db_wq_results: Water quality results PostGIS table
+    :param db_table_history: Historical meteo data PostGIS table
+    :param freq: Time scale (W - weekly, D - daily, M - monthly)
+    :param db_table_meteo_cells: Table with the grid cells of the reservoirs. Default None
+    :param start_date: First date of the read data. Default None - the whole history
+    :return: Dataset with medians of the periods (periods x PIDs and meteo variables); Geometry GeoDataFrame
+    """
+
+    period = SQL_PERIODS[freq]
+    params = {'osm_id': str(osm_id), 'feature': feature, 'model_id': str(model_id)}
+    feature_filter = "osm_id = :osm_id AND feature = :feature AND model_id = :model_id"
+    if start_date is not None:
+        params['start_date'] = pd.Timestamp(start_date).date()
+        feature_filter += " AND date >= :start_date"
+
+    # Meteo variables (all columns of the table except of the keys)
+    query_columns = text(
+        "SELECT column_name FROM information_schema.columns WHERE table_schema = 'public' AND table_name = :db_table "
+        "AND column_name NOT IN ('osm_id', 'cell_id', 'date') ORDER BY ordinal_position")
+
+    query_feature = text(
+        "SELECT \"PID\", {period} AS period, percentile_cont(0.5) WITHIN GROUP (ORDER BY feature_value) AS feature_value "
+        "FROM {db_table} WHERE {feature_filter} GROUP BY \"PID\", period".format(
+            period=period, db_table=db_wq_results, feature_filter=feature_filter))
+
+    query_geometry = text(
+        "SELECT DISTINCT ON (\"PID\") \"PID\", geometry FROM {db_table} WHERE {feature_filter} ORDER BY \"PID\"".format(
+            db_table=db_wq_results, feature_filter=feature_filter))
+
+    with engine.connect() as connection:
+        meteo_columns = connection.execute(query_columns, {'db_table': db_table_history}).scalars().all()
+
+        medians = ", ".join('percentile_cont(0.5) WITHIN GROUP (ORDER BY "{col}") AS "{col}"'.format(col=col)
+                            for col in meteo_columns)
+        query_meteo = text(
+            "WITH bounds AS (SELECT MIN(date) AS start_date, MAX(date) AS end_date FROM {db_wq_results} "
+            "WHERE {feature_filter}) "
+            "SELECT {period} AS period, {medians} FROM {source}, bounds WHERE osm_id = :osm_id "
+            "AND date BETWEEN bounds.start_date AND bounds.end_date GROUP BY period".format(
+                db_wq_results=db_wq_results, feature_filter=feature_filter, period=period, medians=medians,
+                source=_meteo_source(db_table_history, db_table_meteo_cells)))
+
+        df_feature = pd.read_sql(query_feature, connection, params=params)
+        df_meteo = pd.read_sql(query_meteo, connection, params=params)
+        df_geo = gpd.read_postgis(query_geometry, connection, geom_col='geometry', params=params)
+
+    # Convert feature data to matrix (periods x PIDs)
+    df = df_feature.pivot(index='period', columns='PID', values='feature_value')
+    df.index = pd.to_datetime(df.index)
+
+    # Add meteo data to the dataset (also for the periods without feature data)
+    df_meteo['period'] = pd.to_datetime(df_meteo['period'])
+    df_full = df.join(df_meteo.set_index('period'), how='outer')
+
+    # Complete time series of the periods (the periods without data are NaN)
+    df_full = df_full.resample(freq).median()
+    df_full.index.name = None
+    df_full.columns.name = None
 
     return df_full, df_geo
 
 
 @measure_execution_time
-def data_imputation(db_name, user, osm_id, feature, model_id, db_wq_results, db_table_history, freq='W', t_shift=1):
+def data_imputation(db_name, user, osm_id, feature, model_id, db_wq_results, db_table_history, freq='W', t_shift=1,
+                    n_jobs=1, incremental=False, db_table_state='imputation_state', max_age_days=90,
+                    drift_threshold=0.2, aggregate_in_db=False, db_table_meteo_cells=None):
     """
     Imputes missing values in a dataset using a combination of simple imputation, data normalization, and support vector regression.
 
+    In the incremental mode the fitted state (imputer, scalers, SVR models, imputed and smoothed series and the last
+    processed period) is stored in the database for (osm_id, feature, model_id, freq). The next run imputes only the
+    periods from the last processed period by the stored models and recomputes the smoothing only for the trailing
+    window affected by the new data. The full refit is done when the state is older than max_age_days, the stored
+    models drift from the new data (RMSE of the scaled values is higher than drift_threshold) or the points changed.
+    The incremental run reads only the data from the last processed period (and t_shift periods before it) and
+    replaces the outliers by the bounds computed from the whole history at the last full read (stored in the state),
+    so the bounds are refreshed only by the full refit.
+
     :param db_name: Database name
     :param user: Database user
     :param osm_id: OSM object id
@@ -94,11 +303,96 @@ def data_imputation(db_name, user, osm_id, feature, model_id, db_wq_results, db_
     :param db_table_history: Historical meteo data PostGIS table
     :param freq: Time scale (W - weekly, D - daily, M - monthly)
     :param t_shift: Time shift in days for predictors (for weekly time scale is recommended to use t_shift = 1, for daily time scale is recommended to use t_shift = 7)
+    :param n_jobs: Number of worker processes for SVR fitting (-1 - all CPU cores). Default 1
+    :param incremental: Use the incremental mode. Default False
+    :param db_table_state: Database table with the stored imputation states
+    :param max_age_days: Maximum age of the state in days (full refit after that)
+    :param drift_threshold: Maximum RMSE of the stored models on the new scaled data (full refit above that)
+    :param aggregate_in_db: Compute the medians of the periods in the database. Default False
+    :param db_table_meteo_cells: Table with the grid cells of the reservoirs. Default None - the meteo data are stored
+                                 for each reservoir
     :return: GeoDataFrame with imputed data; GeoDataFrame with data smoothed with lowess method
     """
 
-    # Get datasets and geometry
-    df_full, df_geometry = create_dataset(db_name, user, osm_id, feature, model_id, db_wq_results, db_table_history, freq=freq)
+    state = None
+    if incremental:
+        engine = get_engine(user, db_name)
+        state = load_imputation_state(engine, db_table_state, osm_id, feature, model_id, freq)
+
+        if state is not None and (datetime.now() - state['fitted_at']).days > max_age_days:
+            print(f"The imputation state is older than {max_age_days} days. The models will be refitted.")
+            state = None
+
+    result = None
+    if state is not None and 'outlier_bounds' in state:
+        # Only the periods from the last processed period (and t_shift periods before it for the shifted predictors)
+        # are read; the outliers are detected by the bounds of the whole history stored in the state
+        start_date = incremental_start_date(state['last_period'], freq, t_shift)
+        df_full, _ = create_dataset(db_name, user, osm_id, feature, model_id, db_wq_results, db_table_history,
+                                    freq=freq, aggregate_in_db=aggregate_in_db,
+                                    db_table_meteo_cells=db_table_meteo_cells, start_date=start_date,
+                                    bounds=state['outlier_bounds'])
+        df_geometry = state['geometry']
+
+        X = y = None
+        if state['last_period'] in df_full.index:
+            df_full = df_full.reindex(pd.date_range(start_date, df_full.index.max(), freq=freq).union(df_full.index))
+            X, y = split_dataset(df_full, t_shift)
+
+        if y is not None and set(y.columns) <= set(state['columns']):
+            result = impute_incremental(state, X, y.reindex(columns=state['columns']), drift_threshold)
+            if result is None:
+                # The models are refitted on the whole history
+                state = None
+
+    if result is None:
+        # Get datasets and geometry of the whole history
+        df_full, df_geometry, bounds = create_dataset(db_name, user, osm_id, feature, model_id, db_wq_results,
+                                                      db_table_history, freq=freq, aggregate_in_db=aggregate_in_db,
+                                                      db_table_meteo_cells=db_table_meteo_cells, return_bounds=True)
+        X, y = split_dataset(df_full, t_shift)
+
+        if state is not None:
+            # New points of the reservoir, no data of the last processed period or a state stored without the outlier
+            # bounds
+            result = impute_incremental(state, X, y, drift_threshold)
+            if result is not None:
+                state['outlier_bounds'] = bounds
+                state['geometry'] = df_geometry
+
+    if result is None:
+        # Full refit of the imputation models
+        df_filled, df_lowess, state = impute_full(X, y, n_jobs=n_jobs)
+        state['outlier_bounds'] = bounds
+        state['geometry'] = df_geometry
+    else:
+        df_filled, df_lowess, smooth_medians = result
+        if smooth_medians is not None:
+            # The whole series was smoothed again
+            state['smooth_medians'] = smooth_medians
+            state['smooth_periods'] = len(df_filled)
+        state['df_filled'] = df_filled
+        state['df_smooth'] = df_lowess
+        state['last_period'] = df_filled.index.max()
+
+    if incremental:
+        save_imputation_state(engine, db_table_state, osm_id, feature, model_id, freq, state)
+
+    # Melting data to the original shape (for both filled data and lowess smoothing)
+    df_filled_melt = data_melting_2_gdf(df_filled, df_geometry)
+    df_lowess_melt = data_melting_2_gdf(df_lowess, df_geometry)
+
+    return df_filled_melt, df_lowess_melt
+
+
+def split_dataset(df_full, t_shift=1):
+    """
+    Splits the dataset to the predictors (meteo data shifted by t_shift periods) and the target (feature values).
+
+    :param df_full: Dataset with time series of water quality feature and meteo data
+    :param t_shift: Time shift in periods for predictors
+    :return: Predictors (Numpy array); DataFrame with feature values (dates x PIDs)
+    """
 
     # Splitting data to predictors (X) and target (y)
     X = df_full[[
@@ -118,9 +412,39 @@ def data_imputation(db_name, user, osm_id, feature, model_id, db_wq_results, db_
         'wind_direction_10m_dominant',
         'shortwave_radiation_sum'])
 
+    # Renaming columns
+    y.index.name = 'date'
+
+    return X, y
+
+
+def incremental_start_date(last_period, freq='W', t_shift=1):
+    """
+    First date read by the incremental imputation: the start of the period t_shift periods before the last processed
+    period (the last processed period is recomputed and the predictors are shifted by t_shift periods).
+
+    :param last_period: Label of the last processed period (end of the period)
+    :param freq: Time scale (W - weekly, D - daily, M - monthly)
+    :param t_shift: Time shift in periods for predictors
+    :return: Timestamp
+    """
+
+    return pd.Timestamp(last_period) - (t_shift + 1) * to_offset(freq) + pd.Timedelta(days=1)
+
+
+def impute_full(X, y, n_jobs=1):
+    """
+    Imputes missing values of all periods. The imputer, scalers and SVR models are fitted on the whole dataset.
+
+    :param X: Predictors (environmental variables)
+    :param y: DataFrame with feature values (dates x PIDs)
+    :param n_jobs: Number of worker processes for SVR fitting (-1 - all CPU cores)
+    :return: DataFrame with imputed data; DataFrame with smoothed data; Imputation state
+    """
+
     # Make a copy of y for next step
-    y_original = y.copy()
-    y = y.values  # convert y to Numpy array
+    y_original = y
+    y = y.values.copy()  # convert y to Numpy array
 
     # Mask and imputation of missing values
     # Imputation of missing values
@@ -135,7 +459,7 @@ def data_imputation(db_name, user, osm_id, feature, model_id, db_wq_results, db_
     y_scaled = scaler_y.fit_transform(y)
 
     # Predictions of the missing values using SVR
-    y_predicted_scaled = train_and_predict_svr(X_scaled, y_scaled)
+    y_predicted_scaled, models = train_and_predict_svr(X_scaled, y_scaled, n_jobs=n_jobs, return_models=True)
 
     # Inverting results to the original scale of the target variable
     y_predicted = scaler_y.inverse_transform(y_predicted_scaled)
@@ -145,21 +469,187 @@ def data_imputation(db_name, user, osm_id, feature, model_id, db_wq_results, db_
     for i in range(y.shape[1]):
         y[:, i][np.isnan(y[:, i])] = y_predicted[:, i][np.isnan(y[:, i])]
 
-    # Renaming columns
-    y_original.index.name = 'date'
-    col_names = y_original.columns
-
     # Converting back to DataFrame
-    df_filled = pd.DataFrame(y, index=y_original.index, columns=col_names)
+    df_filled = pd.DataFrame(y, index=y_original.index, columns=y_original.columns)
 
     # Using lowess smoothing
-    df_lowess = data_smoothing(df_filled)
+    df_lowess, smooth_medians = data_smoothing(df_filled, return_medians=True)
+
+    state = {
+        'imputer': imputer,
+        'scaler_X': scaler_X,
+        'scaler_y': scaler_y,
+        'X_fit': X_scaled,
+        'models': models,
+        'columns': list(y_original.columns),
+        'df_filled': df_filled,
+        'df_smooth': df_lowess,
+        'smooth_medians': smooth_medians,
+        'smooth_periods': len(df_filled),
+        'last_period': df_filled.index.max(),
+        'fitted_at': datetime.now(),
+    }
+
+    return df_filled, df_lowess, state
+
+
+def impute_incremental(state, X, y, drift_threshold=0.2, frac=0.02):
+    """
+    Imputes missing values of the periods from the last processed period by the stored models. The smoothing is
+    recomputed only for the trailing window affected by the new data and by the LOWESS span (see update_smoothing).
+    The whole series is smoothed again (and the medians of the residuals are refreshed) when the series has grown by
+    more than the LOWESS span since the last smoothing of the whole series or when the span has changed.
+
+    :param state: Imputation state
+    :param X: Predictors (environmental variables)
+    :param y: DataFrame with feature values (dates x PIDs)
+    :param drift_threshold: Maximum RMSE of the stored models on the new scaled data
+    :param frac: The fraction of the data used by LOWESS
+    :return: DataFrame with imputed data; DataFrame with smoothed data; Medians of the absolute residuals if the
+             whole series was smoothed, otherwise None. None if the full refit is needed.
+    """
 
-    # Melting data to the original shape (for both filled data and lowess smoothing)
-    df_filled_melt = data_melting_2_gdf(df_filled, df_geometry)
-    df_lowess_melt = data_melting_2_gdf(df_lowess, df_geometry)
+    last_period = state['last_period']
 
-    return df_filled_melt, df_lowess_melt
+    if list(y.columns) != state['columns'] or last_period not in state['df_filled'].index:
+        print("The points of the reservoir have changed. The models will be refitted.")
+        return None
+
+    # Periods to be recomputed (the last processed period can be incomplete)
+    new_mask = y.index >= last_period
+
+    X_scaled = state['scaler_X'].transform(state['imputer'].transform(X[new_mask]))
+    y_new = y.values[new_mask]
+    y_new_scaled = state['scaler_y'].transform(y_new)
+
+    # Predictions of the stored models and their drift from the new data
+    y_predicted_scaled = predict_svr_models(X_scaled, state['models'], state['X_fit'])
+
+    observed = ~np.isnan(y_new_scaled)
+    if observed.any():
+        drift = np.sqrt(np.mean((y_predicted_scaled[observed] - y_new_scaled[observed]) ** 2))
+        if drift > drift_threshold:
+            print(f"The drift of the imputation models is {drift:.3f}. The models will be refitted.")
+            return None
+
+    y_predicted = state['scaler_y'].inverse_transform(y_predicted_scaled)
+    y_predicted = np.where(y_predicted < 0, 0, y_predicted)
+
+    # Replacing NaNs by the predicted values
+    y_filled = np.where(np.isnan(y_new), y_predicted, y_new)
+    df_new = pd.DataFrame(y_filled, index=y.index[new_mask], columns=y.columns)
+
+    df_old = state['df_filled']
+    df_filled = pd.concat([df_old[df_old.index < last_period], df_new])
+
+    # Smoothing of the trailing window or of the whole series (a state without smooth_periods was smoothed whole)
+    n_smoothed = state.get('smooth_periods', len(df_old))
+    k = lowess_span(len(df_filled), frac)
+
+    if lowess_span(n_smoothed, frac) != k or len(df_filled) - n_smoothed > k:
+        df_lowess, smooth_medians = data_smoothing(df_filled, frac=frac, return_medians=True)
+        return df_filled, df_lowess, smooth_medians
+
+    df_lowess = update_smoothing(df_filled, state['df_smooth'], int((df_old.index < last_period).sum()), frac,
+                                 state['smooth_medians'])
+
+    return df_filled, df_lowess, None
+
+
+def update_smoothing(df_filled, df_smooth, start, frac=0.02, resid_medians=None):
+    """
+    Recomputes the LOWESS smoothing only for the trailing window of the series. The values before the window are
+    taken from the previous smoothing. The window covers the neighbourhoods of the changed periods for all robustness
+    iterations and the residual weights use the medians of the previous smoothing of the whole series, so the result
+    is close to the smoothing of the whole series. It is not equal: the medians of the whole series (and so the
+    residual weights of all periods) change with the new data. The difference grows with the number of the new
+    periods, so the whole series should be smoothed again after the LOWESS span (see impute_incremental).
+
+    :param df_filled: DataFrame with imputed data (dates x PIDs)
+    :param df_smooth: DataFrame with the previous smoothed data
+    :param start: Position of the first changed period in df_filled
+    :param frac: The fraction of the data used by LOWESS
+    :param resid_medians: Medians of the absolute residuals of the previous smoothing
+    :return: DataFrame with smoothed data
+    """
+
+    n = len(df_filled)
+    k = lowess_span(n, frac)
+
+    # The changed periods affect the fits within k periods in each of the 4 LOWESS iterations
+    replace_start = max(start - 4 * k, 0)
+    segment_start = max(replace_start - 4 * k, 0)
+
+    if segment_start == 0:
+        return data_smoothing(df_filled, frac=frac)
+
+    segment = df_filled.iloc[segment_start:]
+    segment_smooth = data_smoothing(segment, frac=(k + 0.5) / len(segment), resid_medians=resid_medians)
+
+    return pd.concat([df_smooth.iloc[:replace_start], segment_smooth.iloc[replace_start - segment_start:]])
+
+
+def load_imputation_state(engine, db_table, osm_id, feature, model_id, freq):
+    """
+    Loads the stored imputation state from the database.
+
+    :param engine: SQLAlchemy engine
+    :param db_table: Database table with the imputation states
+    :param osm_id: OSM object id
+    :param feature: Water quality feature
+    :param model_id: Quality feature model ID
+    :param freq: Time scale
+    :return: Imputation state (dictionary) or None if it does not exist
+    """
+
+    query = text("SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema = 'public' AND table_name = '{tab_name}')".format(tab_name=db_table))
+    query_state = text("SELECT state FROM {db_table} WHERE osm_id = :osm_id AND feature = :feature AND model_id = "
+                       ":model_id AND freq = :freq ORDER BY id DESC LIMIT 1".format(db_table=db_table))
+
+    with engine.connect() as connection:
+        if not connection.execute(query).scalar():
+            return None
+
+        result = connection.execute(query_state, {'osm_id': str(osm_id), 'feature': feature,
+                                                  'model_id': str(model_id), 'freq': freq}).scalar()
+
+    if result is None:
+        return None
+
+    return dill.loads(bytes(result))
+
+
+def save_imputation_state(engine, db_table, osm_id, feature, model_id, freq, state):
+    """
+    Saves the imputation state to the database (the previous state is replaced).
+
+    :param engine: SQLAlchemy engine
+    :param db_table: Database table with the imputation states
+    :param osm_id: OSM object id
+    :param feature: Water quality feature
+    :param model_id: Quality feature model ID
+    :param freq: Time scale
+    :param state: Imputation state (dictionary)
+    :return:
+    """
+
+    create_query = text("CREATE TABLE IF NOT EXISTS {db_table} (id serial PRIMARY KEY, osm_id text, feature varchar(50), "
+                        "model_id varchar(50), freq varchar(10), last_period date, fitted_at timestamp, "
+                        "state bytea)".format(db_table=db_table))
+    delete_query = text("DELETE FROM {db_table} WHERE osm_id = :osm_id AND feature = :feature AND model_id = :model_id "
+                        "AND freq = :freq".format(db_table=db_table))
+    insert_query = text("INSERT INTO {db_table} (osm_id, feature, model_id, freq, last_period, fitted_at, state) VALUES "
+                        "(:osm_id, :feature, :model_id, :freq, :last_period, :fitted_at, :state)".format(db_table=db_table))
+
+    params = {'osm_id': str(osm_id), 'feature': feature, 'model_id': str(model_id), 'freq': freq}
+
+    with engine.begin() as connection:
+        connection.execute(create_query)
+        connection.execute(delete_query, params)
+        connection.execute(insert_query, dict(params, last_period=pd.Timestamp(state['last_period']).date(),
+                                              fitted_at=state['fitted_at'], state=dill.dumps(state)))
+
+    return
 
 
 def detect_and_replace_outliers(series):
@@ -178,50 +668,278 @@ def detect_and_replace_outliers(series):
     return series.where((series >= lower_bound) & (series <= upper_bound), np.nan)
 
 
-def train_and_predict_svr(X, y):
+def group_columns_by_mask(y, columns=None):
     """
-    Trains a Support Vector Regression (SVR) model and predicts the missing values in the dataset.
+    Groups the columns with identical masks of the missing values. The columns of one group share the training
+    samples, so the kernel sub-matrix is selected only once for the whole group.
+
+    :param y: Feature values with missing values (NaN).
+    :param columns: Indices of the columns of y to be grouped. Default None - all columns.
+    :return: List of arrays with column indices (one array for each group).
+    """
+
+    if columns is None:
+        columns = np.arange(y.shape[1])
+
+    groups = {}
+    for i in columns:
+        groups.setdefault(np.isnan(y[:, i]).tobytes(), []).append(i)
+
+    return [np.array(group) for group in groups.values()]
+
+
+def fit_predict_svr_columns(X, y, columns, K=None):
+    """
+    Trains a Support Vector Regression (SVR) model for each of the selected columns and predicts the missing values.
+
+    :param X: Scaled environmental variables. Each row represents a sample and each column represents a feature.
+    :param y: Scaled feature values. The target variable, where each row represents a sample and each column represents a feature.
+    :param columns: Indices of the columns of y to be predicted.
+    :param K: Precomputed RBF kernel (Gram) matrix of X. Default None - the kernel is computed by each SVR.
+    :return: Matrix of predictions for the selected columns; List of the fitted models for the selected columns
+             (indices of the support vectors in X, dual coefficients, intercept)
+    """
+
+    predictions = np.zeros((y.shape[0], len(columns)))
+    models = [None] * len(columns)
+    position = {i: j for j, i in enumerate(columns)}
+
+    for group in group_columns_by_mask(y, columns):
+        mask = ~np.isnan(y[:, group[0]])  # Masking of the missing values (the same for the whole group)
+        rows = np.flatnonzero(mask)
+
+        if K is not None:
+            X_train = K[np.ix_(mask, mask)]
+            X_predict = K[:, mask]
+        else:
+            X_train = X[mask]
+            X_predict = X
+
+        for i in group:
+            # Model training using SVR
+            if K is not None:
+                svr = SVR(kernel='precomputed', C=SVR_C, epsilon=SVR_EPSILON)
+            else:
+                svr = SVR(kernel='rbf', C=SVR_C, gamma=SVR_GAMMA, epsilon=SVR_EPSILON)
+            svr.fit(X_train, y[mask, i])
+
+            # Prediction for each column
+            predictions[:, position[i]] = svr.predict(X_predict)
+            models[position[i]] = (rows[svr.support_], svr.dual_coef_[0].copy(), svr.intercept_[0])
+    return predictions, models
+
+
+def train_and_predict_svr(X, y, n_jobs=1, precomputed_kernel=True, return_models=False):
+    """
+    Trains a Support Vector Regression (SVR) model and predicts the missing values in the dataset. All columns share
+    the predictors X, so the RBF kernel matrix is computed only once and the SVRs are trained on its sub-matrices
+    (columns with identical masks of missing values share the sub-matrix). The columns are fitted in parallel when
+    n_jobs != 1. X, y and the kernel are passed to the worker processes as memory mapped files (not pickled for each
+    task), the results are the same as for the serial run.
 
     :param X: Scaled environmental variables. Each row represents a sample and each column represents a feature.
     :param y: Scaled feature values. The target variable, where each row represents a sample and each column represents a feature.
+    :param n_jobs: Number of worker processes (-1 - all CPU cores). Default 1 - serial run
+    :param precomputed_kernel: Use the shared precomputed RBF kernel. Default True
+    :param return_models: Return also the fitted models (see predict_svr_models). Default False
     :return: Matrix of predictions. Each row represents a sample and each column represents a feature.
     """
 
+    K = rbf_kernel(X, gamma=SVR_GAMMA) if precomputed_kernel else None
+
+    # Columns ordered by the groups of masks, so the chunks contain the columns with the same mask
+    columns = np.concatenate(group_columns_by_mask(y))
+    n_workers = effective_n_jobs(n_jobs)
+
+    if n_workers == 1 or len(columns) < 2:
+        column_chunks = [columns]
+        results = [fit_predict_svr_columns(X, y, columns, K)]
+
+    else:
+        # Several chunks of columns per worker for load balancing
+        column_chunks = [chunk for chunk in np.array_split(columns, n_workers * 4) if len(chunk) > 0]
+
+        results = Parallel(n_jobs=n_workers, max_nbytes=0)(
+            delayed(fit_predict_svr_columns)(X, y, chunk, K) for chunk in column_chunks)
+
     predictions = np.zeros(y.shape)
-    for i in range(y.shape[1]):
-        y_column = y[:, i]
-        mask = ~np.isnan(y_column)  # Masking of the missing values
+    models = [None] * y.shape[1]
+    for chunk, (chunk_predictions, chunk_models) in zip(column_chunks, results):
+        predictions[:, chunk] = chunk_predictions
+        for i, model in zip(chunk, chunk_models):
+            models[i] = model
+
+    if return_models:
+        return predictions, models
+    return predictions
+
 
-        # Model training using SVR
-        svr = SVR(kernel='rbf', C=100, gamma=0.1, epsilon=0.1)
-        svr.fit(X[mask], y_column[mask])
+def predict_svr_models(X, models, X_fit):
+    """
+    Predicts the values by the fitted SVR models (stored as support vectors and dual coefficients) for new samples.
 
-        # Prediction for each column
-        predictions[:, i] = svr.predict(X)
+    :param X: Scaled environmental variables of the new samples.
+    :param models: List of the fitted models (indices of the support vectors in X_fit, dual coefficients, intercept).
+    :param X_fit: Scaled environmental variables used for the models fitting.
+    :return: Matrix of predictions. Each row represents a sample and each column represents a model.
+    """
+
+    K = rbf_kernel(X, X_fit, gamma=SVR_GAMMA)
+
+    predictions = np.zeros((X.shape[0], len(models)))
+    for j, (sv_rows, dual_coef, intercept) in enumerate(models):
+        predictions[:, j] = K[:, sv_rows] @ dual_coef + intercept
     return predictions
 
 
-def data_smoothing(df):
+def lowess_span(n, frac=0.02):
+    """
+    Number of the points in the LOWESS neighbourhood (the same as in the statsmodels lowess function).
+
+    :param n: Number of the points
+    :param frac: The fraction of the data used when estimating each value.
+    :return: Number of the points in the neighbourhood
+    """
+
+    return min(max(int(frac * n + 1e-10), 2), n)
+
+
+def lowess_neighborhoods(x, frac=0.02):
+    """
+    Finds the LOWESS neighbourhood (k nearest points) of each point and its tricube weights. The neighbourhoods depend
+    only on x, so they are shared by all time series with the same dates. The neighbourhoods are the same as in the
+    statsmodels lowess function.
+
+    :param x: Sorted x values (1D array of unique values).
+    :param frac: The fraction of the data used when estimating each value.
+    :return: Indices of the neighbours (n, k); Tricube weights of the neighbours (n, k)
+    """
+
+    n = len(x)
+    k = lowess_span(n, frac)
+
+    left_ends = np.empty(n, dtype=np.intp)
+    left_end = 0
+    right_end = k
+    for i in range(n):
+        while right_end < n and x[i] > (x[left_end] + x[right_end]) / 2.0:
+            left_end += 1
+            right_end += 1
+        left_ends[i] = left_end
+
+    idx = left_ends[:, None] + np.arange(k)
+    radius = np.fmax(x - x[left_ends], x[left_ends + k - 1] - x)
+
+    weights = np.abs(x[idx] - x[:, None]) / radius[:, None]
+    weights = (1.0 - weights ** 3) ** 3
+
+    return idx, weights
+
+
+def lowess_matrix(Y, x, frac=0.02, it=3, block_size=None, resid_medians=None, return_medians=False):
+    """
+    LOWESS smoothing of all columns of the matrix at once. The neighbourhoods and tricube weights are computed once
+    and the local linear regressions are solved for a block of columns with NumPy operations. The results are
+    numerically equivalent to the statsmodels lowess function (with delta=0) applied to each column.
+
+    :param Y: Matrix of values without missing values (n, number of time series).
+    :param x: Sorted x values (1D array of unique values).
+    :param frac: The fraction of the data used when estimating each value.
+    :param it: The number of residual-based reweightings.
+    :param block_size: Number of columns solved at once. Default None - derived from the size of the neighbourhoods.
+    :param resid_medians: Medians of the absolute residuals (it, number of time series) used for the residual
+        weights instead of the medians of the data (e.g. from the previous smoothing of the whole series). NaN values
+        are computed from the data.
+    :param return_medians: Return also the medians of the absolute residuals. Default False
+    :return: Matrix of smoothed values (n, number of time series).
+    """
+
+    x = np.asarray(x, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    n, n_cols = Y.shape
+
+    idx, tricube = lowess_neighborhoods(x, frac)
+    k = idx.shape[1]
+    x_nb = x[idx][:, :, None]
+    x_i = x[:, None]
+
+    if block_size is None:
+        block_size = max(1, 2 ** 22 // (n * k))
+
+    Y_fit = np.empty_like(Y)
+    medians = np.full((it, n_cols), np.nan)
+
+    for start in range(0, n_cols, block_size):
+        y = Y[:, start:start + block_size]
+        y_nb = y[idx]
+        resid_weights = np.ones_like(y)
+
+        for robiter in range(it + 1):
+            # Weights of the neighbours for each point and column
+            w = tricube[:, :, None] * resid_weights[idx]
+            reg_ok = np.count_nonzero(w > 1e-12, axis=1) >= 2
+            # The rows with all weights zero (no regression, see reg_ok) keep zero weights
+            w_sum = w.sum(axis=1, keepdims=True)
+            w = np.divide(w, w_sum, out=np.zeros_like(w), where=w_sum > 0)
+
+            # Local linear regression by the projection vector
+            sum_weighted_x = np.einsum('ikc,ikc->ic', w, x_nb)
+            x_dev = x_nb - sum_weighted_x[:, None, :]
+            weighted_sqdev_x = np.fmax(np.einsum('ikc,ikc->ic', w, x_dev ** 2), 1e-12)
+            p = w * (1.0 + (x_i - sum_weighted_x)[:, None, :] * x_dev / weighted_sqdev_x[:, None, :])
+            y_fit = np.einsum('ikc,ikc->ic', p, y_nb)
+            y_fit = np.where(reg_ok, y_fit, y)
+
+            # Bisquare weights of the residuals for the next iteration
+            if robiter < it:
+                resid = np.abs(y - y_fit)
+                median = np.median(resid, axis=0)
+                if resid_medians is not None:
+                    stored = resid_medians[robiter, start:start + block_size]
+                    median = np.where(np.isnan(stored), median, stored)
+                medians[robiter, start:start + block_size] = median
+                std_resid = np.where(median == 0, (resid > 0).astype(float),
+                                     resid / np.where(median == 0, 1.0, 6.0 * median))
+                std_resid = np.fmin(std_resid, 1.0)
+                resid_weights = (1.0 - std_resid ** 2) ** 2
+
+        Y_fit[:, start:start + block_size] = y_fit
+
+    if return_medians:
+        return Y_fit, medians
+    return Y_fit
+
+
+def data_smoothing(df, frac=0.02, resid_medians=None, return_medians=False):
     """
-    Smoothes all time series in the given DataFrame using the local regression Lowess method.
+    Smoothes all time series in the given DataFrame using the local regression Lowess method. The time series share
+    the dates, so they are smoothed together by the lowess_matrix function. The series with missing values are
+    smoothed one by one by statsmodels lowess.
 
     :param df: The dataframe to be smoothed.
+    :param frac: The fraction of the data used when estimating each value.
+    :param resid_medians: Medians of the absolute residuals for the residual weights (see lowess_matrix).
+    :param return_medians: Return also the medians of the absolute residuals. Default False
     :return: Smoothed dataframe.
     """
 
-    lowess_results = []
+    x = np.asarray(df.index, dtype=float)
+    complete = df.notna().all(axis=0).values
 
-    for i in df.columns:
-        lowess = sm.nonparametric.lowess(df[i], df.index, frac=0.02)
-        lowess_df = pd.DataFrame(lowess, columns=['date', i])
-        lowess_df['date'] = pd.to_datetime(lowess_df['date'])
-        lowess_df.set_index('date', inplace=True)
+    df_smooth = pd.DataFrame(np.nan, index=pd.DatetimeIndex(df.index, name='date'), columns=df.columns)
+    medians = np.full((3, df.shape[1]), np.nan)
 
-        lowess_results.append(lowess_df[i])
+    df_smooth.loc[:, complete], medians[:, complete] = lowess_matrix(
+        df.loc[:, complete].values, x, frac=frac, resid_medians=None if resid_medians is None else resid_medians[:, complete],
+        return_medians=True)
 
-    lowess_df_all = pd.concat(lowess_results, axis=1)
+    for i in df.columns[~complete]:
+        lowess = sm.nonparametric.lowess(df[i], x, frac=frac, return_sorted=False)
+        df_smooth[i] = lowess
 
-    return lowess_df_all
+    if return_medians:
+        return df_smooth, medians
+    return df_smooth
 
 
 def data_melting_2_gdf(df1, df2):
@@ -0,0 +1,271 @@
+import io
+import hashlib
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from sqlalchemy import inspect, text, types
+
+
+def _create_table(df, db_table, engine, geom_col=None, srid=4326):
+    """
+    Create the database table for the DataFrame if it does not exist. The table is created by pandas/GeoPandas from
+    the empty DataFrame, so the table schema is the same as for the to_sql/to_postgis path.
+
+    :param df: DataFrame or GeoDataFrame
+    :param db_table: Database table
+    :param engine: SQLAlchemy engine
+    :param geom_col: Name of the geometry column (None for DataFrame)
+    :param srid: SRID of the geometry
+    :return:
+    """
+
+    if inspect(engine).has_table(db_table):
+        return
+
+    # Types of the object columns are inferred from the data (the empty DataFrame would give text columns)
+    dtype = {}
+    sql_types = {'date': types.Date, 'datetime': types.DateTime, 'boolean': types.Boolean}
+    for col in df.columns:
+        if col != geom_col and df[col].dtype == object:
+            inferred = pd.api.types.infer_dtype(df[col], skipna=True)
+            if inferred in sql_types:
+                dtype[col] = sql_types[inferred]
+
+    if geom_col is None:
+        df.iloc[:0].to_sql(db_table, con=engine, if_exists='append', index=False, dtype=dtype)
+
+    else:
+        from geoalchemy2 import Geometry
+
+        for col in [geom_col] + _other_geometry_columns(df, geom_col):
+            geom_types = df[col].geom_type.dropna().unique()
+            geom_type = geom_types[0].upper() if len(geom_types) == 1 else 'GEOMETRY'
+            dtype[col] = Geometry(geometry_type=geom_type, srid=srid)
+
+        df.iloc[:0].to_postgis(db_table, con=engine, if_exists='append', index=False, dtype=dtype)
+
+    return
+
+
+def _other_geometry_columns(df, geom_col=None):
+    """
+    Geometry columns of the GeoDataFrame other than the active geometry (e.g. centroid or buffer).
+
+    :param df: DataFrame or GeoDataFrame
+    :param geom_col: Name of the active geometry column
+    :return: List of the column names
+    """
+
+    return [col for col in df.columns if col != geom_col and isinstance(df[col].dtype, gpd.array.GeometryDtype)]
+
+
+def _to_csv_frame(df, geom_col=None, srid=4326):
+    """
+    Prepare the DataFrame for COPY. The geometry (and other geometry columns) is encoded as hex EWKB, which PostGIS
+    reads directly.
+
+    :param df: DataFrame or GeoDataFrame
+    :param geom_col: Name of the geometry column (None for DataFrame)
+    :param srid: SRID of the geometry
+    :return: DataFrame
+    """
+
+    df_out = pd.DataFrame(df, copy=False)
+
+    if geom_col is not None:
+        geoms = shapely.set_srid(np.asarray(df[geom_col].values), srid)
+        df_out = df_out.drop(columns=[geom_col])
+        df_out[geom_col] = shapely.to_wkb(geoms, hex=True, include_srid=True)
+
+        for col in _other_geometry_columns(df, geom_col):
+            geoms = shapely.set_srid(np.asarray(df[col].values), srid)
+            df_out[col] = shapely.to_wkb(geoms, hex=True, include_srid=True)
+
+    return df_out
+
+
+def _copy_chunk(cursor, sql, data):
+    """
+    Run COPY ... FROM STDIN for one chunk of CSV data. Both psycopg2 and psycopg (3) drivers are supported.
+
+    :param cursor: DBAPI cursor
+    :param sql: COPY statement
+    :param data: CSV data (string)
+    :return:
+    """
+
+    if hasattr(cursor, 'copy_expert'):
+        cursor.copy_expert(sql, io.StringIO(data))
+    else:
+        with cursor.copy(sql) as copy:
+            copy.write(data)
+
+    return
+
+
+def copy_to_db(df, db_table, engine, chunksize=50000):
+    """
+    Bulk write of a DataFrame or GeoDataFrame to the database table using PostgreSQL COPY ... FROM STDIN (CSV). The
+    geometry is written as EWKB. The rows are streamed in chunks and all chunks are written in one transaction. The
+    table is created if it does not exist.
+
+    :param df: DataFrame or GeoDataFrame
+    :param db_table: Database table
+    :param engine: SQLAlchemy engine
+    :param chunksize: Number of rows sent to the database at once
+    :return: Number of written rows
+    """
+
+    if df is None or df.empty:
+        return 0
+
+    if isinstance(df, gpd.GeoDataFrame):
+        geom_col = df.geometry.name
+        srid = df.crs.to_epsg() if df.crs is not None else 4326
+    else:
+        geom_col = None
+        srid = None
+
+    _create_table(df, db_table, engine, geom_col, srid)
+
+    df_csv = _to_csv_frame(df, geom_col, srid)
+    columns = ', '.join('"{}"'.format(col) for col in df_csv.columns)
+    sql = "COPY {db_table} ({columns}) FROM STDIN WITH (FORMAT csv)".format(db_table=db_table, columns=columns)
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for i in range(0, len(df_csv), chunksize):
+            buffer = io.StringIO()
+            df_csv.iloc[i:i + chunksize].to_csv(buffer, header=False, index=False)
+            _copy_chunk(cursor, sql, buffer.getvalue())
+        cursor.close()
+        connection.commit()
+
+    except Exception:
+        connection.rollback()
+        raise
+
+    finally:
+        connection.close()
+
+    return len(df_csv)
+
+
+def ensure_unique_key(db_table, engine, key=('osm_id', 'date')):
+    """
+    Create the unique index on the key columns of the table if it does not exist. The existing unique index (or
+    primary key) is found by its columns, whatever its name is. The duplicate rows (e.g. written by the former
+    delete-and-append updates) are removed first; the last written row is kept.
+
+    :param db_table: Database table
+    :param engine: SQLAlchemy engine
+    :param key: Key columns
+    :return: Name of the index
+    """
+
+    index_name = '{db_table}_{columns}_key'.format(db_table=db_table, columns='_'.join(key))
+    if len(index_name) > 63:
+        # PostgreSQL truncates the identifiers to 63 characters
+        index_name = '{prefix}_{digest}_key'.format(prefix=index_name[:50],
+                                                    digest=hashlib.md5(index_name.encode()).hexdigest()[:8])
+    columns = ', '.join('"{}"'.format(col) for col in key)
+
+    # Unique index without expressions and predicate on exactly the key columns
+    query = text("SELECT i.relname FROM pg_index x JOIN pg_class t ON t.oid = x.indrelid "
+                 "JOIN pg_class i ON i.oid = x.indexrelid JOIN pg_namespace n ON n.oid = t.relnamespace "
+                 "WHERE n.nspname = 'public' AND t.relname = :db_table AND x.indisunique AND x.indexprs IS NULL "
+                 "AND x.indpred IS NULL AND x.indnkeyatts = :n_columns AND (SELECT array_agg(a.attname::text "
+                 "ORDER BY a.attname) FROM pg_attribute a WHERE a.attrelid = t.oid AND a.attnum = ANY(x.indkey)) "
+                 "= :columns LIMIT 1")
+
+    with engine.begin() as connection:
+        existing = connection.execute(query, {'db_table': db_table, 'n_columns': len(key),
+                                              'columns': sorted(key)}).scalar()
+        if existing is not None:
+            return existing
+
+        condition = ' AND '.join('a."{col}" = b."{col}"'.format(col=col) for col in key)
+        connection.execute(text("DELETE FROM {db_table} AS a USING {db_table} AS b WHERE {condition} AND "
+                                "a.ctid < b.ctid".format(db_table=db_table, condition=condition)))
+        connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {db_table} ({columns})".format(
+            index_name=index_name, db_table=db_table, columns=columns)))
+
+    return index_name
+
+
+def upsert_to_db(df, db_table, engine, key=('osm_id', 'date'), replace_by=None, chunksize=50000):
+    """
+    Bulk upsert of a DataFrame to the database table. The rows are copied to a temporary staging table by COPY and
+    merged to the table by INSERT ... ON CONFLICT (key) DO UPDATE, all in one transaction. The table and its unique
+    key are created if they do not exist.
+
+    With replace_by (e.g. 'osm_id') the table rows of the replace_by values in the DataFrame which are not in the
+    DataFrame are deleted in the same transaction, so the data of these objects are swapped at once (e.g. forecast).
+
+    :param df: DataFrame or GeoDataFrame
+    :param db_table: Database table
+    :param engine: SQLAlchemy engine
+    :param key: Key columns
+    :param replace_by: Column of the objects whose rows are replaced by the DataFrame. Default None - only upsert
+    :param chunksize: Number of rows sent to the database at once
+    :return: Number of written rows
+    """
+
+    if df is None or df.empty:
+        return 0
+
+    if isinstance(df, gpd.GeoDataFrame):
+        geom_col = df.geometry.name
+        srid = df.crs.to_epsg() if df.crs is not None else 4326
+    else:
+        geom_col = None
+        srid = None
+
+    _create_table(df, db_table, engine, geom_col, srid)
+    ensure_unique_key(db_table, engine, key)
+
+    df_csv = _to_csv_frame(df, geom_col, srid)
+    columns = ', '.join('"{}"'.format(col) for col in df_csv.columns)
+    key_columns = ', '.join('"{}"'.format(col) for col in key)
+    update = ', '.join('"{col}" = EXCLUDED."{col}"'.format(col=col) for col in df_csv.columns if col not in key)
+
+    stage = '{db_table}_stage'.format(db_table=db_table)
+    sql_stage = "CREATE TEMP TABLE {stage} (LIKE {db_table} INCLUDING DEFAULTS) ON COMMIT DROP".format(
+        stage=stage, db_table=db_table)
+    sql_copy = "COPY {stage} ({columns}) FROM STDIN WITH (FORMAT csv)".format(stage=stage, columns=columns)
+    sql_insert = ("INSERT INTO {db_table} ({columns}) SELECT DISTINCT ON ({key_columns}) {columns} FROM {stage} "
+                  "ON CONFLICT ({key_columns}) DO {action}").format(
+        db_table=db_table, columns=columns, key_columns=key_columns, stage=stage,
+        action='UPDATE SET {}'.format(update) if update else 'NOTHING')
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(sql_stage)
+        for i in range(0, len(df_csv), chunksize):
+            buffer = io.StringIO()
+            df_csv.iloc[i:i + chunksize].to_csv(buffer, header=False, index=False)
+            _copy_chunk(cursor, sql_copy, buffer.getvalue())
+
+        if replace_by is not None:
+            key_match = ' AND '.join('s."{col}" = t."{col}"'.format(col=col) for col in key)
+            cursor.execute(("DELETE FROM {db_table} AS t WHERE t.\"{by}\" IN (SELECT \"{by}\" FROM {stage}) AND "
+                            "NOT EXISTS (SELECT 1 FROM {stage} AS s WHERE {key_match})").format(
+                db_table=db_table, by=replace_by, stage=stage, key_match=key_match))
+
+        cursor.execute(sql_insert)
+        cursor.close()
+        connection.commit()
+
+    except Exception:
+        connection.rollback()
+        raise
+
+    finally:
+        connection.close()
+
+    return len(df_csv)
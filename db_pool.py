@@ -0,0 +1,166 @@
+import os
+import atexit
+import threading
+
+from sqlalchemy import create_engine, event
+
+
+# Pool configuration shared by all engines created by the registry
+_POOL_CONFIG = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_pre_ping": True,
+    "pool_recycle": 1800,
+}
+
+_engines = {}
+_stats = {}
+_lock = threading.Lock()
+_pid = os.getpid()
+
+
+def set_pool_config(pool_size=None, max_overflow=None, pool_recycle=None, pool_pre_ping=None):
+    """
+    Set the connection pool parameters for the engines created by the registry. If the configuration changes, the
+    existing engines are disposed and removed from the registry, so the next get_engine() call creates the engine with
+    the new configuration.
+
+    :param pool_size: Number of connections kept open in the pool
+    :param max_overflow: Number of connections that can be opened above pool_size
+    :param pool_recycle: Time in seconds after which the connection is recycled
+    :param pool_pre_ping: Test the connection before its use
+    :return:
+    """
+
+    config = dict(_POOL_CONFIG)
+    if pool_size is not None:
+        config["pool_size"] = int(pool_size)
+    if max_overflow is not None:
+        config["max_overflow"] = int(max_overflow)
+    if pool_recycle is not None:
+        config["pool_recycle"] = int(pool_recycle)
+    if pool_pre_ping is not None:
+        config["pool_pre_ping"] = bool(pool_pre_ping)
+
+    with _lock:
+        if config == _POOL_CONFIG:
+            return
+
+        _POOL_CONFIG.update(config)
+
+        # The connections checked out by other threads are closed when they are returned to the disposed pool
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _stats.clear()
+
+    return
+
+
+def _reset_after_fork():
+    """
+    Forget the engines inherited from the parent process. The pooled connections cannot be shared between processes,
+    so the child process creates its own engines.
+
+    :return:
+    """
+
+    global _pid
+
+    if os.getpid() != _pid:
+        for engine in _engines.values():
+            engine.dispose(close=False)
+        _engines.clear()
+        _stats.clear()
+        _pid = os.getpid()
+
+    return
+
+
+def get_engine(user, db_name):
+    """
+    Get the shared SQLAlchemy engine (connection pool) for the database user and database name. The engine is created
+    at the first request and reused by all following calls in the process.
+
+    :param user: Database user
+    :param db_name: Database name
+    :return: SQLAlchemy engine
+    """
+
+    key = (str(user), str(db_name))
+
+    with _lock:
+        _reset_after_fork()
+
+        engine = _engines.get(key)
+        if engine is None:
+            engine = create_engine('postgresql://{user}@/{db_name}'.format(user=user, db_name=db_name),
+                                   **_POOL_CONFIG)
+
+            counter = {"opened": 0, "checkouts": 0}
+
+            @event.listens_for(engine, "connect")
+            def _on_connect(dbapi_connection, connection_record):
+                counter["opened"] += 1
+
+            @event.listens_for(engine, "checkout")
+            def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+                counter["checkouts"] += 1
+
+            _engines[key] = engine
+            _stats[key] = counter
+
+    return engine
+
+
+def get_pool_stats():
+    """
+    Get the number of opened and reused connections for each engine in the registry.
+
+    :return: Dictionary {(user, db_name): {'opened': int, 'reused': int, 'checkouts': int}}
+    """
+
+    with _lock:
+        stats = {}
+        for key, counter in _stats.items():
+            stats[key] = {
+                "opened": counter["opened"],
+                "reused": max(counter["checkouts"] - counter["opened"], 0),
+                "checkouts": counter["checkouts"],
+            }
+
+    return stats
+
+
+def reset_pool_stats():
+    """
+    Reset the connection counters of all engines in the registry (e.g. at the start of a run).
+
+    :return:
+    """
+
+    with _lock:
+        for counter in _stats.values():
+            counter["opened"] = 0
+            counter["checkouts"] = 0
+
+    return
+
+
+def dispose_engines():
+    """
+    Shutdown hook. Close all pooled connections and remove the engines from the registry.
+
+    :return:
+    """
+
+    with _lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _stats.clear()
+
+    return
+
+
+atexit.register(dispose_engines)
@@ -0,0 +1,751 @@
+import io
+import time
+import random
+import threading
+
+import numpy as np
+import pandas as pd
+
+from datetime import datetime, timedelta
+
+
+# Band names of the SENTINEL2_L2A collection (the first 15 bands are used by get_S2_points_OpenEO)
+OEO_S2_BANDS = ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B11", "B12", "AOT", "SCL",
+                "SNW", "CLD", "sunAzimuthAngles", "sunZenithAngles", "viewAzimuthMean", "viewZenithMean"]
+
+# Band names of the COPERNICUS/S2_SR_HARMONIZED collection returned by sampleRegions
+GEE_S2_BANDS = ["B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B8A", "B9", "B11", "B12", "AOT", "WVP", "SCL",
+                "TCI_R", "TCI_G", "TCI_B", "MSK_CLDPRB", "MSK_SNWPRB", "QA10", "QA20", "QA60"]
+
+
+class FakeBackend:
+    """
+    Common behaviour of the fake backends: random generator, latency of the requests, random failures and the
+    counters of the calls.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        """
+        :param latency: Latency of the requests in seconds (number or range (min, max))
+        :param failure_rate: Probability of the failure of the request
+        :param seed: Seed of the random generator
+        """
+
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def _random(self):
+        with self._lock:
+            return self.rng.random()
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _duration(self, value):
+        if isinstance(value, (tuple, list)):
+            with self._lock:
+                return self.rng.uniform(value[0], value[1])
+        return value
+
+    def _request(self, name):
+        """
+        Simulates the request: counts the call, waits for the latency and raises the error by the failure rate.
+        """
+
+        self._count(name)
+        time.sleep(self._duration(self.latency))
+
+        if self._random() < self.failure_rate:
+            raise ConnectionError(f"Fake backend: request {name} failed")
+
+
+def _dates(start_date, end_date, revisit_days, inclusive_end=True):
+    """
+    Dates of the satellite overpasses in the time window.
+    """
+
+    start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date)
+    dates = pd.date_range(start, end if inclusive_end else end - pd.Timedelta(days=1), freq='D')
+
+    return dates[(dates - pd.Timestamp('2015-06-01')).days % revisit_days == 0]
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# OpenEO
+# ---------------------------------------------------------------------------------------------------------------------
+
+class FakeOpenEOConnection(FakeBackend):
+    """
+    Fake OpenEO connection. It mimics the client surface used by get_S2_points_OpenEO (describe_collection,
+    load_collection, the datacube operations, create_job and the batch jobs). The jobs run for job_duration seconds
+    and then finish, fail (failure_rate) or fail with NoDataAvailable (no_data_rate). The results are synthetic CSV or
+    Parquet aggregations for the points (one row per point and cloud free overpass).
+    """
+
+    def __init__(self, job_duration=(1.0, 3.0), latency=0.0, failure_rate=0.0, no_data_rate=0.0, revisit_days=5,
+                 cloud_free_rate=0.6, seed=0):
+        """
+        :param job_duration: Duration of the jobs on the backend in seconds (number or range (min, max))
+        :param latency: Latency of the requests in seconds (number or range (min, max))
+        :param failure_rate: Probability of the failure of the job
+        :param no_data_rate: Probability of the job without data (NoDataAvailable)
+        :param revisit_days: Days between the overpasses
+        :param cloud_free_rate: Probability of the cloud free observation of the point
+        :param seed: Seed of the random generator
+        """
+
+        super().__init__(latency=latency, failure_rate=0.0, seed=seed)
+
+        self.job_duration = job_duration
+        self.job_failure_rate = failure_rate
+        self.no_data_rate = no_data_rate
+        self.revisit_days = revisit_days
+        self.cloud_free_rate = cloud_free_rate
+
+        self.jobs = {}
+        self.max_running = 0
+
+    def authenticate_oidc(self, *args, **kwargs):
+        self._request('authenticate')
+        return self
+
+    def try_access_token_refresh(self, reason=None):
+        self._request('authenticate')
+        return True
+
+    def describe_collection(self, collection_id):
+        self._request('describe_collection')
+        return {'id': collection_id, 'cube:dimensions': {'bands': {'type': 'bands', 'values': list(OEO_S2_BANDS)}}}
+
+    def load_collection(self, collection_id, temporal_extent=None, bands=None, **kwargs):
+        return FakeDataCube(self, temporal_extent, bands)
+
+    def job(self, job_id):
+        return self.jobs[job_id]
+
+    def n_running(self):
+        return sum(job.status() == 'running' for job in list(self.jobs.values()))
+
+    def _create_job(self, cube, n_points, title, out_format):
+        self._request('create_job')
+
+        with self._lock:
+            job_id = "j-fake{:06d}".format(len(self.jobs) + 1)
+            job = FakeBatchJob(self, job_id, cube.temporal_extent, cube.bands, n_points, title, out_format)
+            self.jobs[job_id] = job
+
+        return job
+
+    def _job_started(self):
+        with self._lock:
+            running = sum(job._t_start is not None and not job._done() for job in self.jobs.values())
+            self.max_running = max(self.max_running, running)
+
+
+class FakeDataCube:
+    """
+    Fake OpenEO datacube. The band math and masking operations return the datacube itself.
+    """
+
+    def __init__(self, connection, temporal_extent, bands):
+        self.connection = connection
+        self.temporal_extent = temporal_extent
+        self.bands = bands if bands is not None else list(OEO_S2_BANDS)
+
+    def band(self, name):
+        return self
+
+    def __eq__(self, other):
+        return self
+
+    def __gt__(self, other):
+        return self
+
+    def __or__(self, other):
+        return self
+
+    def __invert__(self):
+        return self
+
+    __hash__ = object.__hash__
+
+    def apply_kernel(self, kernel, **kwargs):
+        return self
+
+    def mask(self, mask, **kwargs):
+        return self
+
+    def aggregate_spatial(self, geometries, reducer, **kwargs):
+        return FakeVectorCube(self, len(geometries['features']))
+
+
+class FakeVectorCube:
+    """
+    Fake OpenEO vector cube (result of aggregate_spatial).
+    """
+
+    def __init__(self, cube, n_points):
+        self.cube = cube
+        self.n_points = n_points
+
+    def create_job(self, title=None, out_format="CSV", **kwargs):
+        return self.cube.connection._create_job(self.cube, self.n_points, title, out_format)
+
+
+class FakeBatchJob:
+    """
+    Fake OpenEO batch job.
+    """
+
+    def __init__(self, connection, job_id, temporal_extent, bands, n_points, title, out_format):
+        self.connection = connection
+        self.job_id = job_id
+        self.temporal_extent = temporal_extent
+        self.bands = bands
+        self.n_points = n_points
+        self.title = title
+        self.out_format = out_format
+
+        self._t_start = None
+        self._duration = None
+        self._outcome = None
+
+    def start(self):
+        self.connection._request('start_job')
+
+        if self._t_start is None:
+            self._duration = self.connection._duration(self.connection.job_duration)
+
+            draw = self.connection._random()
+            if draw < self.connection.job_failure_rate:
+                self._outcome = 'error'
+            elif draw < self.connection.job_failure_rate + self.connection.no_data_rate:
+                self._outcome = 'no_data'
+            else:
+                self._outcome = 'finished'
+
+            self._t_start = time.time()
+            self.connection._job_started()
+
+        return self
+
+    def _done(self):
+        return self._t_start is not None and time.time() - self._t_start >= self._duration
+
+    def status(self):
+        self.connection._request('job_status')
+
+        if self._t_start is None:
+            return 'created'
+        if not self._done():
+            return 'running'
+
+        return 'finished' if self._outcome == 'finished' else 'error'
+
+    def start_and_wait(self):
+        self.start()
+        while not self._done():
+            time.sleep(min(0.1, self._duration))
+
+        if self._outcome != 'finished':
+            raise RuntimeError(f"Batch job {self.job_id!r} didn't finish successfully. Status: error")
+
+        return self
+
+    def logs(self):
+        if self._outcome == 'no_data':
+            return [{'id': '1', 'level': 'error', 'message': 'NoDataAvailable: There is no data available for the '
+                                                              'given extents.'}]
+        if self._outcome == 'error':
+            return [{'id': '1', 'level': 'error', 'message': 'Exception during Spark execution'}]
+
+        return []
+
+    def get_results(self):
+        return FakeJobResults(self)
+
+    def results_frame(self):
+        """
+        Synthetic results of the job (date, feature_index, avg(band_0) ... avg(band_n)).
+        """
+
+        rng = np.random.default_rng(int(self.job_id[-6:]))
+        dates = _dates(self.temporal_extent[0], self.temporal_extent[1], self.connection.revisit_days,
+                       inclusive_end=False)
+
+        date = np.repeat(dates, self.n_points)
+        pid = np.tile(np.arange(self.n_points), len(dates))
+        keep = rng.random(len(date)) < self.connection.cloud_free_rate
+
+        df = pd.DataFrame({'date': date[keep].strftime('%Y-%m-%dT00:00:00.000Z'), 'feature_index': pid[keep]})
+        values = rng.integers(0, 5000, size=(keep.sum(), len(self.bands))).astype(float)
+        for i in range(len(self.bands)):
+            df['avg(band_{})'.format(i)] = values[:, i]
+
+        return df
+
+
+class FakeJobResults:
+    """
+    Fake results of the OpenEO batch job.
+    """
+
+    def __init__(self, job):
+        self.job = job
+
+    def get_assets(self):
+        if self.job.out_format.lower() == 'parquet':
+            return [FakeResultAsset(self.job, 'timeseries.parquet', 'application/parquet')]
+        return [FakeResultAsset(self.job, 'timeseries.csv', 'text/csv')]
+
+    def download_file(self, target=None, name=None):
+        asset = self.get_assets()[0]
+        with open(target, 'wb') as f:
+            f.write(asset.load_bytes())
+        return target
+
+
+class FakeResultAsset:
+    """
+    Fake result asset of the OpenEO batch job.
+    """
+
+    def __init__(self, job, name, media_type):
+        self.job = job
+        self.name = name
+        self.media_type = media_type
+        self.href = f"https://fake.openeo/jobs/{job.job_id}/results/{name}"
+
+    def load_bytes(self):
+        self.job.connection._request('download')
+
+        df = self.job.results_frame()
+        buffer = io.BytesIO()
+        if self.name.endswith('.parquet'):
+            df.to_parquet(buffer, index=False)
+        else:
+            buffer.write(df.to_csv(index=False).encode())
+
+        return buffer.getvalue()
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Open-Meteo
+# ---------------------------------------------------------------------------------------------------------------------
+
+class FakeOpenMeteoClient(FakeBackend):
+    """
+    Fake Open-Meteo client. It mimics openmeteo_requests.Client.weather_api for the daily variables of the Historical
+    Weather API (start_date, end_date) and of the Forecast API (forecast_days). One response is returned for each
+    location.
+    """
+
+    def weather_api(self, url, params):
+        self._request('weather_api')
+
+        latitudes = np.atleast_1d(params['latitude'])
+        longitudes = np.atleast_1d(params['longitude'])
+        variables = params['daily'] if isinstance(params['daily'], (list, tuple)) else [params['daily']]
+
+        if 'start_date' in params:
+            start = pd.Timestamp(str(params['start_date']))
+            end = pd.Timestamp(str(params['end_date'])) + pd.Timedelta(days=1)
+        else:
+            start = pd.Timestamp(datetime.now().date())
+            end = start + pd.Timedelta(days=int(params.get('forecast_days', 7)))
+
+        responses = []
+        for lat, lon in zip(latitudes, longitudes):
+            seed = int(abs(lat * 1000) + abs(lon * 1000))
+            responses.append(FakeWeatherApiResponse(lat, lon, start, end, len(variables), seed))
+
+        return responses
+
+
+class FakeWeatherApiResponse:
+    """
+    Fake response of the Open-Meteo API (one location).
+    """
+
+    def __init__(self, lat, lon, start, end, n_variables, seed):
+        self.lat = lat
+        self.lon = lon
+        self.daily = FakeVariablesWithTime(start, end, n_variables, seed)
+
+    def Latitude(self):
+        return self.lat
+
+    def Longitude(self):
+        return self.lon
+
+    def Daily(self):
+        return self.daily
+
+
+class FakeVariablesWithTime:
+    """
+    Fake daily variables of the Open-Meteo response.
+    """
+
+    def __init__(self, start, end, n_variables, seed):
+        self.start = int(start.tz_localize('UTC').timestamp())
+        self.end = int(end.tz_localize('UTC').timestamp())
+
+        # The values depend only on the location and the day (the same for the overlapping date ranges)
+        days = np.arange(self.start, self.end, 86400) // 86400
+        variables = np.arange(n_variables)[:, None]
+        noise = np.sin(days * 12.9898 + seed * 78.233 + variables * 37.719) * 43758.5453
+        self.values = ((noise - np.floor(noise)) * 30).astype(np.float32)
+
+    def Time(self):
+        return self.start
+
+    def TimeEnd(self):
+        return self.end
+
+    def Interval(self):
+        return 86400
+
+    def VariablesLength(self):
+        return len(self.values)
+
+    def Variables(self, i):
+        return FakeVariable(self.values[i])
+
+
+class FakeVariable:
+    def __init__(self, values):
+        self.values = values
+
+    def ValuesAsNumpy(self):
+        return self.values
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Google Earth Engine
+# ---------------------------------------------------------------------------------------------------------------------
+
+class FakeEarthEngine(FakeBackend):
+    """
+    Fake Earth Engine API (the ee module). It mimics the surface used by get_S2_points_GEE: FeatureCollection (map,
+    flatten, size, toList, getInfo), ImageCollection (filterBounds, filterDate, sort, first, map), Image
+    (sampleRegions, addBands, select, id, date, get), Join.saveFirst, Filter.equals, Geometry.Rectangle and Date. The
+    COPERNICUS/S2_SR_HARMONIZED and COPERNICUS/S2_CLOUD_PROBABILITY collections have the same images for the points
+    (one image every revisit_days days, the same system:index). getInfo waits for the latency and fails by the failure
+    rate.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, revisit_days=5, first_date='2017-03-28', seed=0):
+        """
+        :param latency: Latency of getInfo in seconds (number or range (min, max))
+        :param failure_rate: Probability of the failure of getInfo
+        :param revisit_days: Days between the overpasses
+        :param first_date: Date of the first image
+        :param seed: Seed of the random generator
+        """
+
+        super().__init__(latency=latency, failure_rate=failure_rate, seed=seed)
+
+        self.revisit_days = revisit_days
+        self.first_date = first_date
+        self.Geometry = FakeGeometry
+        self.Join = FakeJoin
+        self.Filter = FakeFilter
+
+    def Authenticate(self, *args, **kwargs):
+        return True
+
+    def Initialize(self, *args, **kwargs):
+        return None
+
+    def FeatureCollection(self, collection):
+        if isinstance(collection, FakeFeatureCollection):
+            return collection
+        if isinstance(collection, dict):
+            features = [FakeFeature(dict(feature['properties']), feature.get('geometry'))
+                        for feature in collection['features']]
+        else:
+            features = list(collection)
+        return FakeFeatureCollection(self, features)
+
+    def ImageCollection(self, collection_id):
+        if isinstance(collection_id, FakeImageCollection):
+            return collection_id
+        return FakeImageCollection(self, collection_id)
+
+    def Image(self, image):
+        if isinstance(image, FakeComputed):
+            image = image.value
+        return image
+
+    def Date(self, value):
+        return FakeDate(self, value)
+
+
+class FakeGeometry:
+    """
+    Fake ee.Geometry.
+    """
+
+    def __init__(self, coords):
+        self.coords = coords
+
+    @staticmethod
+    def Rectangle(coords, *args, **kwargs):
+        return FakeGeometry(coords)
+
+
+class FakeComputed:
+    """
+    Fake computed object with getInfo.
+    """
+
+    def __init__(self, ee_api, value):
+        self.ee_api = ee_api
+        self.value = value
+
+    def getInfo(self):
+        self.ee_api._request('getInfo')
+        return self.value() if callable(self.value) else self.value
+
+
+class FakeDate(FakeComputed):
+    """
+    Fake ee.Date.
+    """
+
+    def __init__(self, ee_api, value):
+        if isinstance(value, FakeComputed):
+            value = value.value
+        if isinstance(value, (int, float, np.integer)):
+            value = pd.Timestamp(int(value), unit='ms')
+        super().__init__(ee_api, pd.Timestamp(value))
+
+    def format(self, fmt=None):
+        return FakeComputed(self.ee_api, self.value.strftime('%Y-%m-%d'))
+
+    def millis(self):
+        return FakeComputed(self.ee_api, int(self.value.timestamp() * 1000))
+
+
+class FakeFeature:
+    """
+    Fake ee.Feature.
+    """
+
+    def __init__(self, properties, geometry=None):
+        self.properties = properties
+        self.geometry = geometry
+
+    def set(self, properties, value=None):
+        if not isinstance(properties, dict):
+            properties = {properties: value}
+        properties = {key: _value(value) for key, value in properties.items()}
+        return FakeFeature(dict(self.properties, **properties), self.geometry)
+
+    def get(self, name):
+        return self.properties.get(name)
+
+    def getInfo(self):
+        return {'type': 'Feature', 'geometry': self.geometry, 'properties': self.properties}
+
+
+def _value(value):
+    """
+    Resolves the fake computed values (e.g. the formatted date) to Python values.
+    """
+
+    if isinstance(value, FakeDate):
+        return value.value.strftime('%Y-%m-%d')
+    if isinstance(value, FakeComputed):
+        return value.value
+    return value
+
+
+class FakeFeatureCollection:
+    """
+    Fake ee.FeatureCollection.
+    """
+
+    def __init__(self, ee_api, features):
+        self.ee_api = ee_api
+        self.features = features
+
+    def map(self, func):
+        return FakeFeatureCollection(self.ee_api, [func(feature) for feature in self.features])
+
+    def flatten(self):
+        features = []
+        for feature in self.features:
+            if isinstance(feature, FakeFeatureCollection):
+                features.extend(feature.flatten().features)
+            else:
+                features.append(feature)
+        return FakeFeatureCollection(self.ee_api, features)
+
+    def size(self):
+        return FakeComputed(self.ee_api, len(self.features))
+
+    def toList(self, count, offset=0):
+        return FakeComputed(self.ee_api, lambda: [feature.getInfo() for feature in self.features[offset:offset + count]])
+
+    def getInfo(self):
+        self.ee_api._request('getInfo')
+        return {'type': 'FeatureCollection', 'features': [feature.getInfo() for feature in self.features]}
+
+
+class FakeImage:
+    """
+    Fake ee.Image of the Sentinel-2 collections.
+    """
+
+    def __init__(self, ee_api, collection_id, date, properties=None, added=None):
+        self.ee_api = ee_api
+        self.collection_id = collection_id
+        self.date_value = date
+        self.properties = properties or {}
+        self.added = added or []
+
+    def id(self):
+        return FakeComputed(self.ee_api, self.date_value.strftime('%Y%m%dT100000_%Y%m%dT100000_T33UVR'))
+
+    def date(self):
+        return FakeDate(self.ee_api, self.date_value)
+
+    def get(self, name):
+        if name == 'system:time_start':
+            return FakeComputed(self.ee_api, int(self.date_value.timestamp() * 1000))
+        if name == 'system:index':
+            return self.id()
+        return FakeComputed(self.ee_api, self.properties.get(name))
+
+    def set(self, name, value):
+        return FakeImage(self.ee_api, self.collection_id, self.date_value, dict(self.properties, **{name: value}),
+                         self.added)
+
+    def select(self, *bands):
+        return self
+
+    def addBands(self, image):
+        return FakeImage(self.ee_api, self.collection_id, self.date_value, self.properties,
+                         self.added + [image] + image.added)
+
+    def _sample(self, n):
+        seed = int(self.date_value.strftime('%Y%m%d')) + len(self.collection_id)
+        rng = np.random.default_rng(seed)
+
+        if 'CLOUD_PROBABILITY' in self.collection_id:
+            return [{'probability': float(v)} for v in rng.integers(0, 100, n)]
+
+        bands = rng.integers(0, 5000, size=(n, len(GEE_S2_BANDS)))
+        return [dict(zip(GEE_S2_BANDS, row.tolist())) for row in bands]
+
+    def sampleRegions(self, collection, scale=None, properties=None, **kwargs):
+        values = self._sample(len(collection.features))
+        for image in self.added:
+            values = [dict(value, **added) for value, added in zip(values, image._sample(len(values)))]
+
+        features = [FakeFeature(dict(feature.properties, **value), feature.geometry)
+                    for feature, value in zip(collection.features, values)]
+
+        return FakeFeatureCollection(self.ee_api, features)
+
+
+class FakeImageCollection:
+    """
+    Fake ee.ImageCollection.
+    """
+
+    def __init__(self, ee_api, collection_id, start_date=None, end_date=None, points=None, ascending=True,
+                 image_list=None):
+        self.ee_api = ee_api
+        self.collection_id = collection_id
+        self.start_date = start_date or ee_api.first_date
+        self.end_date = end_date or datetime.now().date().isoformat()
+        self.points = points
+        self.ascending = ascending
+        self.image_list = image_list
+
+    def _copy(self, **kwargs):
+        args = dict(start_date=self.start_date, end_date=self.end_date, points=self.points, ascending=self.ascending,
+                    image_list=self.image_list)
+        args.update(kwargs)
+        return FakeImageCollection(self.ee_api, self.collection_id, **args)
+
+    def filterBounds(self, geometry):
+        return self._copy(points=geometry)
+
+    def filterDate(self, start_date, end_date):
+        start = max(pd.Timestamp(str(start_date)), pd.Timestamp(self.ee_api.first_date))
+        return self._copy(start_date=start.date().isoformat(), end_date=str(end_date))
+
+    def sort(self, prop='system:time_start', ascending=True):
+        return self._copy(ascending=ascending)
+
+    def images(self):
+        if self.image_list is not None:
+            return self.image_list
+
+        dates = _dates(self.start_date, self.end_date, self.ee_api.revisit_days, inclusive_end=False)
+        if not self.ascending:
+            dates = dates[::-1]
+        properties = {'CLOUDY_PIXEL_PERCENTAGE': 10.0, 'CLOUD_SHADOW_PERCENTAGE': 1.0}
+        return [FakeImage(self.ee_api, self.collection_id, date, properties) for date in dates]
+
+    def first(self):
+        return self.images()[0]
+
+    def map(self, func):
+        results = [func(image) for image in self.images()]
+        if results and all(isinstance(result, FakeImage) for result in results):
+            return self._copy(image_list=results)
+        return FakeFeatureCollection(self.ee_api, results)
+
+    def size(self):
+        return FakeComputed(self.ee_api, lambda: len(self.images()))
+
+
+class FakeFilter:
+    """
+    Fake ee.Filter (only the equality of the image properties for the joins).
+    """
+
+    def __init__(self, left_field, right_field):
+        self.left_field = left_field
+        self.right_field = right_field
+
+    @staticmethod
+    def equals(leftField=None, rightField=None, **kwargs):
+        return FakeFilter(leftField, rightField)
+
+
+class FakeJoin:
+    """
+    Fake ee.Join.saveFirst. The first matching image of the secondary collection is saved as the property of the
+    primary image, the primary images without the match are dropped.
+    """
+
+    def __init__(self, match_key):
+        self.match_key = match_key
+
+    @staticmethod
+    def saveFirst(matchKey=None, **kwargs):
+        return FakeJoin(matchKey)
+
+    def apply(self, primary, secondary, condition):
+        secondary_images = {}
+        for image in secondary.images():
+            secondary_images.setdefault(image.get(condition.right_field).value, image)
+
+        joined = []
+        for image in primary.images():
+            match = secondary_images.get(image.get(condition.left_field).value)
+            if match is not None:
+                joined.append(image.set(self.match_key, match))
+
+        return primary._copy(image_list=joined)
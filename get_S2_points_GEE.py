@@ -1,36 +1,57 @@
 import ee
 
+import time
+import queue
+import threading
+import warnings
+
 import geopandas as gpd
 import pandas as pd
 
 from shapely.geometry import Point
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor
 
 from AIHABs_wrappers import measure_execution_time
+from db_pool import get_engine
+from db_copy import copy_to_db
 from get_random_points import get_sampling_points
 from get_meteo import getLastDateInDB
 
 
-@measure_execution_time
-def process_sentinel2_points_data(point_layer, start_date, end_date, db_name, user, db_table):
+def fetch_sentinel2_points_data(point_layer, start_date, end_date, page_size=5000, ee_api=None):
     """
-    Function to fetch Sentinel-2 data for random points within the water reservoir polygon and time
-    period using Google Earth Engine. The result is GeoDataFrame with Sentinel-2 data for each point and in the PostGIS database.
+    Function to fetch Sentinel-2 data for random points within the water reservoir polygon and time period using
+    Google Earth Engine. The data are not written to the database.
+
+    The S2_SR_HARMONIZED images are joined with the S2_CLOUD_PROBABILITY images by system:index on the server, so the
+    reflectances and the cloud probability of the point are sampled from the same image at once.
+
+    getInfo is limited to 5000 elements, but paging the sampled collection by toList(page_size, offset) makes the
+    server compute the whole joined collection again for each page. The period is therefore split to date sub-ranges
+    which are expected to fit into one page (by the number of images and points) and each sub-range is downloaded by
+    one getInfo request. A sub-range which fills the whole page is split in halves again; only a single day with more
+    sampled points than page_size is downloaded by pages. This costs one extra request for the number of images.
 
     :param point_layer: The randomly selected points within the reservoir polygon
     :param start_date: Start date in the format 'YYYY-MM-dd'
-    :param end_date: End date in the format 'YYYY-MM-dd'
-    :param db_name: Database name
-    :param user: Database user
-    :param db_table: Table with the results
-    :return: GeoDataFrame
+    :param end_date: End date in the format 'YYYY-MM-dd' (not included)
+    :param page_size: Number of features downloaded by one getInfo request. Default 5000
+    :param ee_api: Earth Engine API. Default None - the ee module
+    :return: GeoDataFrame (empty DataFrame if there are no data)
     """
 
-    engine = create_engine('postgresql://{user}@/{db_name}'.format(user=user, db_name=db_name))
+    if ee_api is None:
+        ee_api = ee
+
+    point_collection = ee_api.FeatureCollection(point_layer.__geo_interface__)
+
+    def s2_images(start, end):
+        return ee_api.ImageCollection('COPERNICUS/S2_SR_HARMONIZED').filterBounds(point_collection).filterDate(
+            start.isoformat(), end.isoformat())
 
-    point_collection = ee.FeatureCollection(point_layer.__geo_interface__)
+    def add_probability(image):
+        return image.addBands(ee_api.Image(image.get('cloud_probability')).select('probability'))
 
     def extract_values(image):
         # Set the parameters
@@ -44,26 +65,50 @@ def process_sentinel2_points_data(point_layer, start_date, end_date, db_name, us
 
         return pixel_values
 
-    collection = [
-        'COPERNICUS/S2_SR_HARMONIZED',
-        'COPERNICUS/S2_CLOUD_PROBABILITY']
-    s2_outputs_list = []
-    for col in collection:
-        s2_output = ee.ImageCollection(col).filterBounds(point_collection).filterDate(start_date, end_date)
-        sampled_points = s2_output.map(extract_values)
+    def sampled_points(start, end):
+        cloud_images = ee_api.ImageCollection('COPERNICUS/S2_CLOUD_PROBABILITY').filterBounds(
+            point_collection).filterDate(start.isoformat(), end.isoformat())
 
-        results = sampled_points.flatten().getInfo()
+        # Join the cloud probability image to the Sentinel-2 image with the same system:index
+        join = ee_api.Join.saveFirst(matchKey='cloud_probability')
+        condition = ee_api.Filter.equals(leftField='system:index', rightField='system:index')
+        joined = ee_api.ImageCollection(join.apply(s2_images(start, end), cloud_images, condition))
 
-        features = []
-        for idx, value in enumerate(results['features']):
-            properties = value['properties']
-            features.append(properties)
+        return joined.map(add_probability).map(extract_values).flatten()
 
-        s2_outputs_df = pd.DataFrame(features)
+    def fetch_range(start, end):
+        page = sampled_points(start, end).toList(page_size).getInfo()
+        if len(page) < page_size:
+            return page
 
-        s2_outputs_list.append(s2_outputs_df)
+        n_days = (end - start).days
+        if n_days > 1:
+            middle = start + timedelta(days=n_days // 2)
+            return fetch_range(start, middle) + fetch_range(middle, end)
 
-    df_all = pd.concat([s2_outputs_list[0], s2_outputs_list[1]['probability']], axis=1)
+        # More sampled points in one day than page_size
+        offset = page_size
+        while len(page) == offset:
+            page.extend(sampled_points(start, end).toList(page_size, offset).getInfo())
+            offset += page_size
+
+        return page
+
+    start = datetime.strptime(str(start_date), "%Y-%m-%d").date()
+    end = datetime.strptime(str(end_date), "%Y-%m-%d").date()
+
+    # Date sub-ranges expected to fit into one page
+    features = []
+    n_images = s2_images(start, end).size().getInfo() if end > start else 0
+    if n_images > 0:
+        n_days = (end - start).days
+        n_ranges = min(-(-n_images * len(point_layer) // page_size), n_days)
+        bounds = [start + timedelta(days=n_days * i // n_ranges) for i in range(n_ranges + 1)]
+
+        for range_start, range_end in zip(bounds[:-1], bounds[1:]):
+            features.extend(value['properties'] for value in fetch_range(range_start, range_end))
+
+    df_all = pd.DataFrame(features)
 
     if df_all.get('date') is not None:
         df_all['date'] = pd.to_datetime(df_all['date']).dt.date
@@ -73,9 +118,6 @@ def process_sentinel2_points_data(point_layer, start_date, end_date, db_name, us
 
         gdf_out = gpd.GeoDataFrame(df_all, geometry=geometries, crs='epsg:4326')
 
-        gdf_out.to_postgis(db_table, con=engine, if_exists='append', index=False)
-        engine.dispose()
-
     else:
         df_all = pd.DataFrame()
         gdf_out = df_all
@@ -83,9 +125,147 @@ def process_sentinel2_points_data(point_layer, start_date, end_date, db_name, us
     return gdf_out
 
 
+@measure_execution_time
+def process_sentinel2_points_data(point_layer, start_date, end_date, db_name, user, db_table, ee_api=None):
+    """
+    Function to fetch Sentinel-2 data for random points within the water reservoir polygon and time
+    period using Google Earth Engine. The result is GeoDataFrame with Sentinel-2 data for each point and in the PostGIS database.
+
+    :param point_layer: The randomly selected points within the reservoir polygon
+    :param start_date: Start date in the format 'YYYY-MM-dd'
+    :param end_date: End date in the format 'YYYY-MM-dd'
+    :param db_name: Database name
+    :param user: Database user
+    :param db_table: Table with the results
+    :param ee_api: Earth Engine API. Default None - the ee module
+    :return: GeoDataFrame
+    """
+
+    engine = get_engine(user, db_name)
+
+    gdf_out = fetch_sentinel2_points_data(point_layer, start_date, end_date, ee_api=ee_api)
+
+    if not gdf_out.empty:
+        copy_to_db(gdf_out, db_table, engine)
+
+    return gdf_out
+
+
+def run_sentinel2_pipeline(point_layer, slots, engine, db_table, n_workers=10, queue_size=4, batch_rows=200000,
+                           raise_errors=True, ee_api=None):
+    """
+    Producer/consumer pipeline for fetching of the Sentinel-2 data for the time slots. The fetch threads take the
+    slots and put the fetched data to the bounded queue (the fetching waits when the queue is full). One writer
+    (the calling thread) writes the data to the database in batches of at least batch_rows rows. The errors of the
+    fetching are collected for each slot and raised after the data of the other slots are written; the error of the
+    writer stops the pipeline and is raised immediately.
+
+    :param point_layer: The randomly selected points within the reservoir polygon
+    :param slots: List of time slots (start date, end date) as ISO strings, the end date is included
+    :param engine: SQLAlchemy engine
+    :param db_table: Table with the results
+    :param n_workers: Number of fetch threads
+    :param queue_size: Maximum number of fetched slots waiting for the writer
+    :param batch_rows: Minimum number of rows written at once (smaller batch is written when the queue is empty)
+    :param raise_errors: Raise RuntimeError if fetching of any slot failed, otherwise only warn. Default True
+    :param ee_api: Earth Engine API. Default None - the ee module
+    :return: DataFrame with statistics of the slots (status, rows, fetch time, wait time, latency, rows/s, error)
+    """
+
+    slot_queue = queue.Queue()
+    for slot in slots:
+        slot_queue.put(slot)
+
+    data_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+    stats = {slot: {'start_date': slot[0], 'end_date': slot[1], 'status': 'pending', 'rows': 0, 't_fetch': None,
+                    't_wait': None, 'latency': None, 'rows_per_sec': None, 'error': None} for slot in slots}
+
+    def producer():
+        while not stop.is_set():
+            try:
+                slot = slot_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            t0 = time.time()
+            try:
+                # The end date of the slot is included, the end date of the filter is not
+                end = (datetime.strptime(slot[1], "%Y-%m-%d").date() + timedelta(days=1)).isoformat()
+                gdf = fetch_sentinel2_points_data(point_layer, slot[0], end, ee_api=ee_api)
+            except Exception as e:
+                errors.append(e)
+                stats[slot].update(status='failed', t_fetch=time.time() - t0, error=repr(e))
+                print(f"Fetching of the time slot from {slot[0]} to {slot[1]} failed. Error: {e}")
+                continue
+
+            t_fetch = time.time() - t0
+            stats[slot].update(t_fetch=t_fetch, rows=len(gdf), rows_per_sec=len(gdf) / t_fetch if t_fetch > 0 else None)
+
+            # Backpressure: wait for the writer when the queue is full
+            t1 = time.time()
+            while not stop.is_set():
+                try:
+                    data_queue.put((slot, gdf, t0), timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            stats[slot]['t_wait'] = time.time() - t1
+
+    workers = [threading.Thread(target=producer, daemon=True) for _ in range(max(min(n_workers, len(slots)), 1))]
+    for worker in workers:
+        worker.start()
+
+    batch = []
+
+    def write_batch():
+        frames = [gdf for slot, gdf, t0 in batch if not gdf.empty]
+        if frames:
+            copy_to_db(gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs='epsg:4326'), db_table, engine)
+        for slot, gdf, t0 in batch:
+            stats[slot].update(status='written', latency=time.time() - t0)
+        batch.clear()
+
+    try:
+        while True:
+            try:
+                batch.append(data_queue.get(timeout=0.5))
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers) and data_queue.empty():
+                    break
+                continue
+
+            # Write the batch when it is large enough or when no other data are waiting
+            if sum(len(gdf) for slot, gdf, t0 in batch) >= batch_rows or data_queue.empty():
+                write_batch()
+
+        write_batch()
+
+    except Exception:
+        stop.set()
+        raise
+
+    finally:
+        for worker in workers:
+            worker.join()
+
+    df_stats = pd.DataFrame(list(stats.values()))
+
+    if errors:
+        failed = df_stats.loc[df_stats['status'] == 'failed', ['start_date', 'end_date']].values.tolist()
+        message = f"Sentinel 2 data for {len(failed)} time slots were not downloaded: {failed}"
+        if raise_errors:
+            raise RuntimeError(message) from errors[0]
+        warnings.warn(message, stacklevel=2)
+
+    return df_stats
+
+
 @measure_execution_time
 def get_sentinel2_data(ee_project, osm_id, db_name, user, db_table_reservoirs, db_table_points, db_table_S2_points_data,
-                       start_date=None, end_date=None, n_points_max=5000, n_processes=10):
+                       start_date=None, end_date=None, n_points_max=5000, n_processes=10, queue_size=4,
+                       batch_rows=200000, raise_errors=True, ee_api=None):
     """
     This function is a wrapper for the process_sentinel2_points_data function. Function for managing of the Sentinel-2
     data fetching for random points within the water reservoir polygon and time period using Google Earth Engine.
@@ -102,14 +282,21 @@ def get_sentinel2_data(ee_project, osm_id, db_name, user, db_table_reservoirs, d
     :param end_date: End date. Default is None - last date in the GEE database or current date
     :param n_points_max: Maximum number of points. Default 5000
     :param n_processes: Number of parallel fetching of time windows. Default 10
-    :return:
+    :param queue_size: Maximum number of fetched time windows waiting for writing. Default 4
+    :param batch_rows: Minimum number of rows written to the database at once. Default 200000
+    :param raise_errors: Raise RuntimeError if fetching of any time window failed, otherwise only warn. Default True
+    :param ee_api: Earth Engine API. Default None - the ee module
+    :return: DataFrame with statistics of the time windows
     """
 
-    ee.Authenticate()
-    ee.Initialize(project=ee_project)
+    if ee_api is None:
+        ee_api = ee
+
+    ee_api.Authenticate()
+    ee_api.Initialize(project=ee_project)
 
     # Connect to PostGIS
-    engine = create_engine('postgresql://{user}@/{db_name}'.format(user=user, db_name=db_name))
+    engine = get_engine(user, db_name)
 
     # get points
     point_layer = get_sampling_points(osm_id, db_name, user, db_table_reservoirs, db_table_points)
@@ -118,7 +305,7 @@ def get_sentinel2_data(ee_project, osm_id, db_name, user, db_table_reservoirs, d
 
     # Vytvořte oblast zájmu (AOI) jako obdélníkový polygon
     minx, miny, maxx, maxy = point_layer.total_bounds
-    aoi = ee.Geometry.Rectangle([minx, miny, maxx, maxy])
+    aoi = ee_api.Geometry.Rectangle([minx, miny, maxx, maxy])
 
     # Create chunks for time series
     # Get possible length of steps (chunks)
@@ -147,7 +334,7 @@ def get_sentinel2_data(ee_project, osm_id, db_name, user, db_table_reservoirs, d
     else:
         if start_date is None:
             # Get collection
-            collection = ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
+            collection = ee_api.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
 
             # Filter by the AOI
             filtered_collection = collection.filterBounds(aoi)
@@ -156,7 +343,7 @@ def get_sentinel2_data(ee_project, osm_id, db_name, user, db_table_reservoirs, d
             earliest_image = filtered_collection.sort('system:time_start').first()
 
             # get the date for the oldest image
-            earliest_date = ee.Date(earliest_image.get('system:time_start')).format('YYYY-MM-dd').getInfo()
+            earliest_date = ee_api.Date(earliest_image.get('system:time_start')).format('YYYY-MM-dd').getInfo()
             start_date = earliest_date
 
         st_date = datetime.strptime(start_date, "%Y-%m-%d").date()
@@ -188,19 +375,12 @@ def get_sentinel2_data(ee_project, osm_id, db_name, user, db_table_reservoirs, d
 
     print(slots)
 
-    # Get Sentinel-2 data for each time window using Multiprocessing
-    if n_chunks > n_processes:
-        n_processes = n_processes
-    else:
-        n_processes = n_chunks
-
-    def worker(args):
-        return process_sentinel2_points_data(*args)
-
-    with ThreadPoolExecutor(max_workers=n_processes) as executor:
-        executor.map(worker, [(point_layer, start.format('YYYY-MM-dd'), end.format('YYYY-MM-dd'), db_name, user, db_table_S2_points_data)
-                                             for start, end in slots])
+    # Get Sentinel-2 data for each time window: parallel fetching and one writer
+    df_stats = run_sentinel2_pipeline(point_layer, slots, engine, db_table_S2_points_data, n_workers=n_processes,
+                                      queue_size=queue_size, batch_rows=batch_rows,
+                                      raise_errors=raise_errors, ee_api=ee_api)
 
-    engine.dispose()
+    print(f"Written {df_stats['rows'].sum()} rows for {len(df_stats)} time slots. Median latency of the slot: "
+          f"{df_stats['latency'].median():.1f} s")
 
-    return
+    return df_stats
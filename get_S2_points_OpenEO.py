@@ -1,71 +1,82 @@
+import io
 import json
-import os
 import time
-import openeo
 import warnings
 import scipy.signal
-import uuid
 
 import pandas as pd
 
 import numpy as np
 import geopandas as gpd
 
+from collections import deque
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, text
-from shapely.geometry import Point
+from sqlalchemy import text, inspect
 
 from AIHABs_wrappers import measure_execution_time
+from db_pool import get_engine
+from db_copy import copy_to_db
+from oeo_session import get_connection, describe_collection
 from get_random_points import get_sampling_points
 from get_meteo import getLastDateInDB
 
 
+# Errors of the failed windows caused by the jobs on the backend (the status of the job). Only these failures limit
+# the size of the windows; the errors of the submission, download or database are not related to the size.
+JOB_ERRORS = ('error', 'canceled')
+
+
 def authenticate_OEO():
-    # Authenticate
-    connection = openeo.connect(url="openeo.dataspace.copernicus.eu")
-    connection.authenticate_oidc()
+    # Authenticate (the connection is shared by the process and its token is refreshed before the expiration)
+    connection = get_connection()
 
     return connection
 
 
-def process_s2_points_OEO(osm_id, point_layer, start_date, end_date, db_name, user, db_table, max_cc=30, cloud_mask=True):
+def get_s2_bands_OEO():
     """
-    The function processes Sentinel-2 satellite data from the Copernicus Dataspace Ecosystem. The function
-    retrieves data based on the specified parameters (cloud mask) for randomly selected points within the reservoir (
-    point layer). The S2 data are downloaded for defined time period. The data are stored to the PostGIS database.
-    The output is a GeoDataFrame.
+    Returns the names of the Sentinel-2 bands used for the analysis.
 
-    Parameters:
+    :return: List of band names
+    """
+
+    # Get bands names (the collection metadata are cached)
+    collection_info = describe_collection("SENTINEL2_L2A")
+    bands = collection_info['cube:dimensions']['bands']
+    band_list = bands['values'][0:15]
+
+    return band_list
+
+
+def create_s2_job_OEO(connection, osm_id, point_layer, start_date, end_date, band_list, max_cc=30, cloud_mask=True,
+                      out_format="CSV"):
+    """
+    Creates (does not start) the OpenEO batch job which aggregates Sentinel-2 data for the points of the reservoir in
+    the time window. The end date is included (the end of the OpenEO temporal extent is exclusive, so the extent ends
+    the next day).
+
+    :param connection: OpenEO connection
     :param osm_id: OSM object id
     :param point_layer: Point layer (GeoDataFrame)
     :param start_date: Start date
-    :param end_date: End date
-    :param db_name: Database name
-    :param user: Database user
-    :param db_table: Database table
+    :param end_date: End date (included)
+    :param band_list: List of band names
     :param max_cc: Maximum cloud cover
     :param cloud_mask: Apply cloud mask
-    :return: GeoDataFrame with Sentinel-2 data for the randomly selected points for the defined time period
+    :param out_format: Format of the results (CSV or Parquet)
+    :return: OpenEO batch job
     """
 
-    # Authenticate Open EO account
-    connection = authenticate_OEO()
-
     # Transform input GeoDataFrame layer into json
     points = json.loads(point_layer.to_json())
 
-    # Connect to PostGIS
-    engine = create_engine('postgresql://{user}@/{db_name}'.format(user=user, db_name=db_name))
-
-    # Get bands names
-    collection_info = connection.describe_collection("SENTINEL2_L2A")
-    bands = collection_info['cube:dimensions']['bands']
-    band_list = bands['values'][0:15]
+    # The end of the temporal extent is exclusive
+    extent_end = (datetime.strptime(str(end_date), "%Y-%m-%d").date() + timedelta(days=1)).isoformat()
 
     # Getting data
     datacube = connection.load_collection(
         "SENTINEL2_L2A",
-        temporal_extent=[start_date, end_date],
+        temporal_extent=[str(start_date), extent_end],
         max_cloud_cover=max_cc,
         bands=band_list,
     )
@@ -96,8 +107,141 @@ def process_s2_points_OEO(osm_id, point_layer, start_date, end_date, db_name, us
         reducer="mean",
     )
 
-    # Run the job
-    job = aggregated.create_job(title=f"{osm_id}_{start_date}_{end_date}", out_format="CSV")
+    # Create the job
+    job = aggregated.create_job(title=f"{osm_id}_{start_date}_{end_date}", out_format=out_format)
+
+    return job
+
+
+def read_s2_job_results(job):
+    """
+    Reads the result asset of the finished OpenEO job into memory (no temporary file). CSV and Parquet results are
+    supported.
+
+    :param job: Finished OpenEO batch job
+    :return: DataFrame with the results
+    """
+
+    assets = job.get_results().get_assets()
+    data_assets = [asset for asset in assets if asset.name.lower().endswith(('.csv', '.parquet'))]
+    asset = data_assets[0] if data_assets else assets[0]
+
+    data = io.BytesIO(asset.load_bytes())
+
+    if asset.name.lower().endswith('.parquet') or 'parquet' in (asset.media_type or ''):
+        df = pd.read_parquet(data)
+    else:
+        df = pd.read_csv(data)
+
+    return df
+
+
+def parse_s2_results(df, point_layer, band_list):
+    """
+    Converts the results of the OpenEO job to the GeoDataFrame stored in the database. The columns are renamed at
+    once, the coordinates and the geometry of the points are attached by the join on PID.
+
+    :param df: DataFrame with the results (date, feature_index, avg(band_0) ... avg(band_n))
+    :param point_layer: Point layer (GeoDataFrame)
+    :param band_list: List of band names
+    :return: GeoDataFrame with Sentinel-2 data; None if there are no data
+    """
+
+    if df.get('date') is None:
+        return None
+
+    # Convert date do isoformat
+    df['date'] = pd.to_datetime(df['date']).dt.date
+
+    # Remove missing values
+    df_all = df.dropna(axis=0, how='any')
+
+    # Rename columns
+    columns = {'feature_index': 'PID'}
+    columns.update({'avg(band_{})'.format(i): band for i, band in enumerate(band_list)})
+    df_all = df_all.rename(columns=columns)
+    df_all['PID'] = df_all['PID'].astype('int64')
+
+    # Add OSM id
+    df_all['osm_id'] = point_layer['osm_id'].iloc[0]
+
+    # Attach coordinates of the points
+    latlon = pd.DataFrame({'PID': point_layer['PID'].astype('int64').values, 'lat': point_layer.geometry.y.values,
+                           'lon': point_layer.geometry.x.values})
+    df_all = df_all.merge(latlon, on='PID', how='left')
+
+    # Convert to GeoDataFrame
+    gdf_out = gpd.GeoDataFrame(df_all, geometry=gpd.points_from_xy(df_all['lon'], df_all['lat']), crs='epsg:4326')
+
+    return gdf_out
+
+
+def ingest_s2_job_OEO(job, osm_id, point_layer, band_list, start_date, end_date, db_table, engine):
+    """
+    Reads the results of the finished OpenEO job in memory and writes them to the PostGIS database.
+
+    :param job: Finished OpenEO batch job
+    :param osm_id: OSM object id
+    :param point_layer: Point layer (GeoDataFrame)
+    :param band_list: List of band names
+    :param start_date: Start date
+    :param end_date: End date
+    :param db_table: Database table
+    :param engine: SQLAlchemy engine
+    :return: Number of rows written to the database
+    """
+
+    df = read_s2_job_results(job)
+    print("Data has been downloaded!")
+
+    n_rows = 0
+
+    print("Writing data to the PostGIS table")
+    gdf_out = parse_s2_results(df, point_layer, band_list)
+
+    if gdf_out is not None:
+        # Save the results to the database
+        n_rows = copy_to_db(gdf_out, db_table, engine)
+
+        print("Done!")
+
+    print(f"Data for OSM_ID: {osm_id} in the time window {start_date} and {end_date} has been downloaded!")
+
+    return n_rows
+
+
+def process_s2_points_OEO(osm_id, point_layer, start_date, end_date, db_name, user, db_table, max_cc=30, cloud_mask=True):
+    """
+    The function processes Sentinel-2 satellite data from the Copernicus Dataspace Ecosystem. The function
+    retrieves data based on the specified parameters (cloud mask) for randomly selected points within the reservoir (
+    point layer). The S2 data are downloaded for defined time period. The data are stored to the PostGIS database.
+    The output is a GeoDataFrame.
+
+    Parameters:
+    :param osm_id: OSM object id
+    :param point_layer: Point layer (GeoDataFrame)
+    :param start_date: Start date
+    :param end_date: End date
+    :param db_name: Database name
+    :param user: Database user
+    :param db_table: Database table
+    :param max_cc: Maximum cloud cover
+    :param cloud_mask: Apply cloud mask
+    :return: GeoDataFrame with Sentinel-2 data for the randomly selected points for the defined time period
+    """
+
+    # Authenticate Open EO account
+    connection = authenticate_OEO()
+
+    # Connect to PostGIS
+    engine = get_engine(user, db_name)
+
+    # Get bands names
+    band_list = get_s2_bands_OEO()
+
+    # Create the job
+    job = create_s2_job_OEO(connection, osm_id, point_layer, start_date, end_date, band_list, max_cc=max_cc,
+                            cloud_mask=cloud_mask)
 
     # Get job ID
     jobid = job.job_id
@@ -110,91 +254,656 @@ def process_s2_points_OEO(osm_id, point_layer, start_date, end_date, db_name, us
 
     except Exception as e:
         print(e)
-        engine.dispose()
         return jobid
 
     # Download the results
     try:
         if job.status() == 'finished':
-            # Create temporary CSV file
-            csv_file = f"{uuid.uuid4()}.csv"
-            csv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp', csv_file)
-
-            # Download the results
-            job.get_results().download_file(csv_path)
-
-            # Check if the file is available
-            print("Waiting for data to be available...")
-            t0 = time.time()
-            while not os.path.exists(csv_path):
-                if time.time() - t0 > 360:                  # up to 6 minutes
-                    print(f"Data are not available.")
-                time.sleep(1)
-
-            df = pd.read_csv(csv_path)
-            print("Data has been downloaded!")
-
-            print("Writing data to the PostGIS table")
-            # Convert to GeoDataFrame
-            if df.get('date') is not None:
-                # Convert date do isoformat
-                df['date'] = pd.to_datetime(df['date']).dt.date
-
-                # Remove missing values
-                df_all = df.dropna(axis=0, how='any')
-
-                # Rename columns
-                df_all = df_all.rename(columns={'feature_index': 'PID'})
-                for i in range(0, len(band_list)):
-                    df_all = df_all.rename(columns={'avg(band_{})'.format(i): band_list[i]})
-
-                # Add OSM id
-                df_all['osm_id'] = point_layer['osm_id'][0]
-
-                # Convert to GeoDataFrame
-                latlon = pd.DataFrame(point_layer['PID'])
-                latlon['lat'] = point_layer.geometry.y
-                latlon['lon'] = point_layer.geometry.x
-                df_all = df_all.merge(latlon, on='PID', how='left')
-
-                geometries = [Point(xy) for xy in zip(df_all['lon'], df_all['lat'])]
-                gdf_out = gpd.GeoDataFrame(df_all, geometry=geometries, crs='epsg:4326')
-
-                # Save the results to the database
-                gdf_out.to_postgis(db_table, con=engine, if_exists='append', index=False)
-                engine.dispose()
-
-                print("Done!")
-
-            # Remove the temporary file
-            print(f"Removing temporary file {csv_file}")
-            if os.path.exists(csv_path):
-                os.remove(csv_path)
-
-            print(f"Data for OSM_ID: {osm_id} in the time window {start_date} and {end_date} has been downloaded!")
+            ingest_s2_job_OEO(job, osm_id, point_layer, band_list, start_date, end_date, db_table, engine)
             return jobid
 
         else:
             print(f"Data are not available.")
-            engine.dispose()
             return jobid
 
     except Exception as e:
         print(e)
         print(f"Data are not available.")
-        engine.dispose()
         return jobid
 
 
-def check_job_error(jobid=None):
+class OEOJobManager:
+    """
+    Manager of the concurrent OpenEO batch jobs for the time slots of one reservoir. Up to max_jobs jobs are
+    running on the backend at once. The statuses of the running jobs are polled together and the results of each job
+    are downloaded and written to the database as soon as the job is finished, so the total time is close to the time
+    of the slowest jobs instead of the sum of all jobs.
+
+    The failed slots are submitted again (max_attempts) after an exponential backoff (retry_delay doubled with each
+    attempt, at most max_retry_delay). After that, the slot is bisected recursively (2 attempts for each half) down to
+    windows of one day. The slots without available data (NoDataAvailable) are not repeated.
+
+    The job whose status is not available at max_attempts consecutive polls is handled as a failed attempt.
+
+    When the results of the finished job cannot be downloaded or written to the database, only the download of the
+    same job is repeated (max_attempts, with the backoff); the job is never submitted again for that. The job which
+    was not written after that is recorded as ingest_failed and its results are downloaded at the next run.
+
+    Each time window is recorded in the job ledger table (job id, status, number of rows, duration and error class)
+    as soon as it is queued, including the repeated attempts and the halves of the bisected windows. The next run
+    resumes from the ledger: the windows which were ingested or have no data are skipped, the results of the
+    submitted, finished or not written (ingest_failed) jobs are downloaded without new processing on the backend and
+    the queued and failed windows are submitted again.
+    """
+
+    def __init__(self, osm_id, point_layer, db_name, user, db_table, max_jobs=4, poll_interval=10, max_attempts=3,
+                 max_cc=30, cloud_mask=True, ledger_table='s2_job_ledger', out_format="CSV", retry_delay=5,
+                 max_retry_delay=300):
+        """
+        :param osm_id: OSM object id
+        :param point_layer: Point layer (GeoDataFrame)
+        :param db_name: Database name
+        :param user: Database user
+        :param db_table: Database table with Sentinel-2 data
+        :param max_jobs: Maximum number of jobs running at once
+        :param poll_interval: Time between the polls of the job statuses (seconds)
+        :param max_attempts: Number of attempts for each time slot
+        :param max_cc: Maximum cloud cover
+        :param cloud_mask: Apply cloud mask
+        :param ledger_table: Database table with the job ledger (None - the ledger is not used)
+        :param out_format: Format of the job results (CSV or Parquet)
+        :param retry_delay: Delay before the first repeated attempt (seconds)
+        :param max_retry_delay: Maximum delay before the repeated attempt (seconds)
+        """
+
+        self.osm_id = osm_id
+        self.point_layer = point_layer
+        self.db_name = db_name
+        self.user = user
+        self.db_table = db_table
+        self.max_jobs = max_jobs
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.max_cc = max_cc
+        self.cloud_mask = cloud_mask
+        self.ledger_table = ledger_table
+        self.out_format = out_format
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.connection = None
+        self.band_list = None
+        self.engine = None
+
+    def run(self, slots):
+        """
+        Runs the jobs for all time slots and for the unfinished windows from the job ledger.
+
+        :param slots: List of time slots (start date, end date) as ISO strings
+        :return: List of dictionaries with the results of the windows (start_date, end_date, job_id, status, rows,
+                 duration, error)
+        """
+
+        self.connection = authenticate_OEO()
+        self.band_list = get_s2_bands_OEO()
+        self.engine = get_engine(self.user, self.db_name)
+
+        queue = deque()
+        running = []
+        downloads = []
+        results = []
+
+        # Resume the windows from the job ledger
+        if self.ledger_table is not None:
+            ledger = read_job_ledger(self.engine, self.ledger_table, self.osm_id)
+
+            for record in ledger.itertuples():
+                task = self._task(record.start_date, record.end_date)
+
+                if record.status in ('submitted', 'finished', 'ingest_failed') and record.job_id is not None:
+                    print(f"Job ID: {record.job_id} for time slot from {task['start_date']} to {task['end_date']} "
+                          f"resumed")
+                    task.update(job=self.connection.job(record.job_id), t_start=time.time(), resumed=True)
+                    running.append(task)
+
+                elif record.status in ('queued', 'failed'):
+                    queue.append(task)
+
+            # The windows recorded in the ledger are not submitted again
+            handled = ledger.loc[ledger['status'] != 'split', ['start_date', 'end_date']].values.tolist()
+            slots = subtract_time_windows(slots, handled)
+
+        for start, end in slots:
+            task = self._task(start, end)
+            self._record(task, 'queued')
+            queue.append(task)
+
+        while queue or running or downloads:
+            # Submit new jobs up to the limit (the repeated attempts wait for their backoff)
+            while len(running) < self.max_jobs:
+                task = self._next_ready(queue)
+                if task is None:
+                    break
+                try:
+                    self._submit(task)
+                    running.append(task)
+                except Exception as e:
+                    print(f"Job for time slot from {task['start_date']} to {task['end_date']} was not submitted. "
+                          f"Error: {e}")
+                    self._retry(task, queue, results, type(e).__name__)
+
+            # Poll the statuses of the running jobs
+            changed = False
+            for task in list(running):
+                try:
+                    status = task['job'].status()
+                except Exception as e:
+                    print(f"Status of the job {task['job'].job_id} is not available. Error: {e}")
+                    task['status_errors'] = task.get('status_errors', 0) + 1
+                    if task.get('resumed'):
+                        # The resumed job does not exist on the backend anymore
+                        running.remove(task)
+                        changed = True
+                        task = self._task(task['start_date'], task['end_date'])
+                        self._record(task, 'queued')
+                        queue.append(task)
+                    elif task['status_errors'] >= self.max_attempts:
+                        # The job is lost for the manager, the time slot is submitted again
+                        running.remove(task)
+                        changed = True
+                        self._retry(task, queue, results, type(e).__name__)
+                    continue
+
+                task['status_errors'] = 0
+
+                if status == 'finished':
+                    running.remove(task)
+                    changed = True
+                    self._record(task, 'finished')
+                    self._ingest(task, downloads, results)
+
+                elif status in ('error', 'canceled'):
+                    running.remove(task)
+                    changed = True
+                    if check_job_error(task['job'].job_id, connection=self.connection):
+                        self._retry(task, queue, results, status)
+                    else:
+                        results.append(self._record(task, 'no_data'))
+
+            # Download again the results of the finished jobs which were not written
+            for task in list(downloads):
+                if task['not_before'] <= time.time():
+                    downloads.remove(task)
+                    changed = True
+                    self._ingest(task, downloads, results)
+
+            if running and not changed:
+                time.sleep(self.poll_interval)
+            elif not running and not changed and (queue or downloads):
+                # All the waiting tasks wait for their backoff
+                time.sleep(max(min(task.get('not_before', 0) for task in list(queue) + downloads) - time.time(), 0))
+
+        return results
+
+    def _task(self, start_date, end_date, max_attempts=None):
+        """
+        Returns the new task for the time window.
+        """
+
+        return {'start_date': str(start_date), 'end_date': str(end_date), 'attempt': 1,
+                'max_attempts': max_attempts or self.max_attempts}
+
+    def _next_ready(self, queue):
+        """
+        Removes and returns the first queued task whose backoff has passed (None if there is no such task).
+        """
+
+        now = time.time()
+        for task in queue:
+            if task.get('not_before', 0) <= now:
+                queue.remove(task)
+                return task
+
+        return None
+
+    def _backoff(self, attempt):
+        """
+        Returns the time of the next attempt after the failed attempt (exponential backoff).
+        """
+
+        return time.time() + min(self.retry_delay * 2 ** (attempt - 1), self.max_retry_delay)
+
+    def _submit(self, task):
+        """
+        Creates and starts the job for the time slot.
+        """
+
+        job = create_s2_job_OEO(self.connection, self.osm_id, self.point_layer, task['start_date'], task['end_date'],
+                                self.band_list, max_cc=self.max_cc, cloud_mask=self.cloud_mask,
+                                out_format=self.out_format)
+        job.start()
+
+        task['job'] = job
+        task['t_start'] = time.time()
+        self._record(task, 'submitted')
+        print(f"Job ID: {job.job_id} for time slot from {task['start_date']} to {task['end_date']} started")
+
+    def _ingest(self, task, downloads, results):
+        """
+        Downloads the results of the finished job and writes them to the database. When it fails, the download of the
+        same job is repeated after the backoff (the job is not submitted again).
+        """
+
+        try:
+            # The results of the resumed job could be written partly by the previous run
+            if task.get('resumed'):
+                delete_s2_points(self.engine, self.db_table, self.osm_id, task['start_date'], task['end_date'])
+
+            n_rows = ingest_s2_job_OEO(task['job'], self.osm_id, self.point_layer, self.band_list, task['start_date'],
+                                       task['end_date'], self.db_table, self.engine)
+        except Exception as e:
+            print(f"Results of the job {task['job'].job_id} were not written. Error: {e}")
+
+            ingest_attempt = task.get('ingest_attempt', 1)
+            if ingest_attempt < self.max_attempts:
+                warnings.warn(f"Attempt no. {ingest_attempt} to write the results of the job {task['job'].job_id} "
+                              f"failed.", stacklevel=2)
+                task.update(ingest_attempt=ingest_attempt + 1, not_before=self._backoff(ingest_attempt))
+                downloads.append(task)
+            else:
+                results.append(self._record(task, 'ingest_failed', error=type(e).__name__))
+            return
+
+        results.append(self._record(task, 'ingested', rows=n_rows))
+
+    def _retry(self, task, queue, results, error):
+        """
+        Submits the failed time slot again (after the backoff) or bisects it when the attempts are exhausted.
+        """
+
+        if task['attempt'] < task['max_attempts']:
+            warnings.warn(f"Attempt no. {task['attempt']} to get Sentinel 2 data failed.", stacklevel=2)
+            task = dict(task, attempt=task['attempt'] + 1, job=None, t_start=None, resumed=False, status_errors=0,
+                        not_before=self._backoff(task['attempt']))
+            self._record(task, 'queued', error=error)
+            queue.append(task)
+            return
+
+        halves = bisect_time_window(task['start_date'], task['end_date'])
+        if halves is not None:
+            warnings.warn(f"Attempt to get Sentinel 2 data failed. The time window will be split to smaller windows",
+                          stacklevel=2)
+            results.append(self._record(task, 'split', error=error))
+            for start, end in halves:
+                half = dict(self._task(start, end, max_attempts=2), not_before=self._backoff(task['attempt']))
+                self._record(half, 'queued')
+                queue.append(half)
+            return
+
+        results.append(self._record(task, 'failed', error=error))
+
+    def _record(self, task, status, rows=0, error=None):
+        """
+        Returns the record of the time window and writes it to the job ledger.
+        """
+
+        job = task.get('job')
+        t_start = task.get('t_start')
+
+        record = {'start_date': task['start_date'], 'end_date': task['end_date'],
+                  'job_id': job.job_id if job is not None else None, 'status': status, 'rows': rows,
+                  'duration': time.time() - t_start if t_start is not None else None, 'error': error}
+
+        if self.ledger_table is not None:
+            write_job_ledger(self.engine, self.ledger_table, self.osm_id, record)
+
+        return record
+
+
+def read_job_ledger(engine, db_table, osm_id):
+    """
+    Reads the job ledger records of the reservoir. The ledger table is created if it does not exist.
+
+    :param engine: SQLAlchemy engine
+    :param db_table: Database table with the job ledger
+    :param osm_id: OSM object id
+    :return: DataFrame with the records (start_date, end_date, job_id, status, n_rows, duration, error, updated_at)
+    """
+
+    query_create = text(
+        "CREATE TABLE IF NOT EXISTS {db_table} (osm_id text, start_date date, end_date date, job_id text, status text, "
+        "n_rows integer, duration double precision, error text, updated_at timestamp)".format(db_table=db_table))
+    query = text(
+        "SELECT start_date, end_date, job_id, status, n_rows, duration, error, updated_at FROM {db_table} "
+        "WHERE osm_id = :osm_id ORDER BY start_date".format(db_table=db_table))
+
+    with engine.begin() as connection:
+        connection.execute(query_create)
+        ledger = pd.read_sql(query, connection, params={'osm_id': str(osm_id)})
+
+    ledger['start_date'] = ledger['start_date'].astype(str)
+    ledger['end_date'] = ledger['end_date'].astype(str)
+    ledger['job_id'] = ledger['job_id'].astype(object).where(ledger['job_id'].notna(), None)
+
+    return ledger
+
+
+def write_job_ledger(engine, db_table, osm_id, record):
+    """
+    Writes the record of the time window to the job ledger (the previous record of the window is replaced).
+
+    :param engine: SQLAlchemy engine
+    :param db_table: Database table with the job ledger
+    :param osm_id: OSM object id
+    :param record: Dictionary with start_date, end_date, job_id, status, rows, duration and error
+    :return:
+    """
+
+    query_delete = text(
+        "DELETE FROM {db_table} WHERE osm_id = :osm_id AND start_date = :start_date AND end_date = :end_date".format(
+            db_table=db_table))
+    query_insert = text(
+        "INSERT INTO {db_table} (osm_id, start_date, end_date, job_id, status, n_rows, duration, error, updated_at) "
+        "VALUES (:osm_id, :start_date, :end_date, :job_id, :status, :n_rows, :duration, :error, :updated_at)".format(
+            db_table=db_table))
+
+    params = {'osm_id': str(osm_id), 'start_date': record['start_date'], 'end_date': record['end_date'],
+              'job_id': record['job_id'], 'status': record['status'], 'n_rows': record['rows'],
+              'duration': record['duration'], 'error': record['error'], 'updated_at': datetime.now()}
+
+    with engine.begin() as connection:
+        connection.execute(query_delete, params)
+        connection.execute(query_insert, params)
+
+    return
+
+
+def delete_s2_points(engine, db_table, osm_id, start_date, end_date):
+    """
+    Deletes the Sentinel-2 data of the reservoir in the time window.
+
+    :param engine: SQLAlchemy engine
+    :param db_table: Database table with Sentinel-2 data
+    :param osm_id: OSM object id
+    :param start_date: Start date
+    :param end_date: End date
+    :return:
+    """
+
+    if not inspect(engine).has_table(db_table):
+        return
+
+    query = text("DELETE FROM {db_table} WHERE osm_id = :osm_id AND date BETWEEN :start_date AND :end_date".format(
+        db_table=db_table))
+
+    with engine.begin() as connection:
+        connection.execute(query, {'osm_id': str(osm_id), 'start_date': start_date, 'end_date': end_date})
+
+    return
+
+
+def subtract_time_windows(slots, windows):
+    """
+    Removes the time windows from the time slots. The parts of the slots which are not covered by the windows are
+    returned.
+
+    :param slots: List of time slots (start date, end date) as ISO strings
+    :param windows: List of time windows (start date, end date) as ISO strings
+    :return: List of time slots (start date, end date) as ISO strings
+    """
+
+    windows = sorted((datetime.strptime(str(start), "%Y-%m-%d").date(), datetime.strptime(str(end), "%Y-%m-%d").date())
+                     for start, end in windows)
+
+    remaining = []
+    for slot_start, slot_end in slots:
+        start = datetime.strptime(slot_start, "%Y-%m-%d").date()
+        end = datetime.strptime(slot_end, "%Y-%m-%d").date()
+
+        for window_start, window_end in windows:
+            if window_end < start or window_start > end:
+                continue
+            if window_start > start:
+                remaining.append((start.isoformat(), (window_start - timedelta(days=1)).isoformat()))
+            start = max(start, window_end + timedelta(days=1))
+            if start > end:
+                break
+
+        if start <= end:
+            remaining.append((start.isoformat(), end.isoformat()))
+
+    return remaining
+
+
+def ledger_start_date(ledger):
+    """
+    Returns the first day of the reservoir which is not covered by the windows of the job ledger (the windows are
+    ingested in any order, so the days before the last ingested date can be missing). The split windows are covered
+    by their halves.
+
+    :param ledger: DataFrame with the job ledger records (see read_job_ledger)
+    :return: Date; None if the ledger is empty
+    """
+
+    windows = ledger.loc[ledger['status'] != 'split', ['start_date', 'end_date']].values.tolist()
+    if not windows:
+        return None
+
+    first = min(start for start, end in windows)
+    last = max(end for start, end in windows)
+
+    gaps = subtract_time_windows([(first, last)], windows)
+    if gaps:
+        return datetime.strptime(gaps[0][0], "%Y-%m-%d").date()
+
+    return datetime.strptime(last, "%Y-%m-%d").date() + timedelta(days=1)
+
+
+def bisect_time_window(start_date, end_date):
+    """
+    Splits the time window to two halves.
+
+    :param start_date: Start date (ISO string)
+    :param end_date: End date (ISO string)
+    :return: List of two time windows (start date, end date) as ISO strings; None for the window of one day
+    """
+
+    start = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end = datetime.strptime(end_date, "%Y-%m-%d").date()
+    n_days = (end - start).days + 1
+
+    if n_days < 2:
+        return None
+
+    middle = start + timedelta(days=n_days // 2)
+
+    return [(start.isoformat(), (middle - timedelta(days=1)).isoformat()), (middle.isoformat(), end.isoformat())]
+
+
+class S2WindowPlanner:
+    """
+    Planner of the time windows for the Sentinel-2 jobs of one reservoir. The length of the windows is derived from
+    the sizing model of the reservoir: number of rows and job duration per point-day (exponentially weighted averages
+    of the finished jobs) and the maximum size of the window (point-days) which did not fail. The windows target
+    target_rows rows per job. The model is stored in the database table and updated after each run.
+
+    The maximum size is lowered only by the windows whose jobs failed on the backend (see JOB_ERRORS). Each processed
+    window raises it again by the factor recovery, so the windows grow back to the sizing model after a temporary
+    outage of the backend.
+    """
+
+    def __init__(self, osm_id, n_points, engine, model_table='s2_window_model', target_rows=50000,
+                 max_duration=None, initial_days=None, min_days=2, max_days=365, alpha=0.3, recovery=1.1):
+        """
+        :param osm_id: OSM object id
+        :param n_points: Number of points of the reservoir
+        :param engine: SQLAlchemy engine
+        :param model_table: Database table with the sizing models
+        :param target_rows: Target number of rows per job
+        :param max_duration: Maximum expected duration of the job in seconds (None - not limited)
+        :param initial_days: Length of the windows (days) when there is no model for the reservoir
+        :param min_days: Minimum length of the windows (days)
+        :param max_days: Maximum length of the windows (days)
+        :param alpha: Weight of the new jobs in the averages
+        :param recovery: Growth of the maximum size of the windows after each processed window
+        """
+
+        self.osm_id = osm_id
+        self.n_points = max(int(n_points), 1)
+        self.engine = engine
+        self.model_table = model_table
+        self.target_rows = target_rows
+        self.max_duration = max_duration
+        self.initial_days = initial_days
+        self.min_days = min_days
+        self.max_days = max_days
+        self.alpha = alpha
+        self.recovery = recovery
+
+        self.model = self.load()
+
+    def load(self):
+        """
+        Reads the sizing model of the reservoir. The table is created if it does not exist.
+
+        :return: Dictionary with rows_per_point_day, seconds_per_point_day and max_point_days (None if not known)
+        """
+
+        query_create = text(
+            "CREATE TABLE IF NOT EXISTS {db_table} (osm_id text PRIMARY KEY, rows_per_point_day double precision, "
+            "seconds_per_point_day double precision, max_point_days double precision, n_jobs integer, "
+            "updated_at timestamp)".format(db_table=self.model_table))
+        query = text(
+            "SELECT rows_per_point_day, seconds_per_point_day, max_point_days, n_jobs FROM {db_table} "
+            "WHERE osm_id = :osm_id".format(db_table=self.model_table))
+
+        with self.engine.begin() as connection:
+            connection.execute(query_create)
+            row = connection.execute(query, {'osm_id': str(self.osm_id)}).mappings().first()
+
+        if row is None:
+            return {'rows_per_point_day': None, 'seconds_per_point_day': None, 'max_point_days': None, 'n_jobs': 0}
+
+        return dict(row)
+
+    def save(self):
+        """
+        Writes the sizing model of the reservoir to the database.
+
+        :return:
+        """
+
+        query = text(
+            "INSERT INTO {db_table} (osm_id, rows_per_point_day, seconds_per_point_day, max_point_days, n_jobs, "
+            "updated_at) VALUES (:osm_id, :rows_per_point_day, :seconds_per_point_day, :max_point_days, :n_jobs, "
+            ":updated_at) ON CONFLICT (osm_id) DO UPDATE SET rows_per_point_day = EXCLUDED.rows_per_point_day, "
+            "seconds_per_point_day = EXCLUDED.seconds_per_point_day, max_point_days = EXCLUDED.max_point_days, "
+            "n_jobs = EXCLUDED.n_jobs, updated_at = EXCLUDED.updated_at".format(db_table=self.model_table))
+
+        with self.engine.begin() as connection:
+            connection.execute(query, dict(self.model, osm_id=str(self.osm_id), updated_at=datetime.now()))
+
+        return
+
+    def window_days(self):
+        """
+        Returns the length of the windows in days.
+
+        :return: Number of days
+        """
+
+        rate = self.model['rows_per_point_day']
+        if rate is None or rate <= 0:
+            days = self.initial_days if self.initial_days is not None else self.max_days
+        else:
+            days = self.target_rows / (rate * self.n_points)
+
+        # Limits given by the duration of the jobs and by the failed windows
+        if self.max_duration is not None and self.model['seconds_per_point_day']:
+            days = min(days, self.max_duration / (self.model['seconds_per_point_day'] * self.n_points))
+        if self.model['max_point_days'] is not None:
+            days = min(days, self.model['max_point_days'] / self.n_points)
+
+        return int(min(max(days, self.min_days), self.max_days))
+
+    def plan(self, start_date, end_date):
+        """
+        Splits the period to windows of the same length (at most window_days days). The end date is not included.
+
+        :param start_date: Start date (date)
+        :param end_date: End date (date)
+        :return: List of time windows (start date, end date) as ISO strings
+        """
+
+        n_days = (end_date - start_date).days
+        if n_days < 1:
+            return []
+
+        n_windows = -(-n_days // self.window_days())
+        bounds = np.linspace(0, n_days, n_windows + 1).round().astype(int)
+
+        return [((start_date + timedelta(days=int(bounds[i]))).isoformat(),
+                 (start_date + timedelta(days=int(bounds[i + 1]) - 1)).isoformat()) for i in range(n_windows)]
+
+    def update(self, results):
+        """
+        Updates the sizing model by the results of the jobs and stores it to the database.
+
+        :param results: List of dictionaries with the results of the windows (see OEOJobManager.run)
+        :return:
+        """
+
+        for result in results:
+            n_days = (datetime.strptime(result['end_date'], "%Y-%m-%d").date() -
+                      datetime.strptime(result['start_date'], "%Y-%m-%d").date()).days + 1
+            point_days = n_days * self.n_points
+
+            if result['status'] in ('ingested', 'no_data'):
+                rate = (result['rows'] or 0) / point_days
+                self.model['rows_per_point_day'] = self._average(self.model['rows_per_point_day'], rate)
+
+                if result['duration'] is not None:
+                    seconds = result['duration'] / point_days
+                    self.model['seconds_per_point_day'] = self._average(self.model['seconds_per_point_day'], seconds)
+
+                # The window of this size was processed, so the limit can grow again
+                if self.model['max_point_days'] is not None:
+                    limit = max(self.model['max_point_days'] * self.recovery, float(point_days))
+                    self.model['max_point_days'] = limit if limit < self.max_days * self.n_points else None
+
+                self.model['n_jobs'] += 1
+
+            elif result['status'] in ('split', 'failed') and result['error'] in JOB_ERRORS:
+                limit = 0.75 * point_days
+                if self.model['max_point_days'] is None or limit < self.model['max_point_days']:
+                    self.model['max_point_days'] = limit
+
+        self.save()
+
+        return
+
+    def _average(self, value, new_value):
+        """
+        Exponentially weighted average.
+        """
+
+        if value is None:
+            return float(new_value)
+
+        return (1 - self.alpha) * value + self.alpha * new_value
+
+
+def check_job_error(jobid=None, connection=None):
     """
     Check if the dataset is empty
 
     :param jobid:
+    :param connection: OpenEO connection. Default None - a new connection is authenticated
     :return:
     """
     # Connection to OEO
-    connection = authenticate_OEO()
+    if connection is None:
+        connection = authenticate_OEO()
 
     # Check if the error is in the log
     if jobid is not None:
@@ -231,7 +940,9 @@ def check_job_error(jobid=None):
 
 @measure_execution_time
 def get_s2_points_OEO(osm_id, db_name, user, db_table_reservoirs, db_table_points, db_table_S2_points_data,
-                       start_date=None, end_date=None, n_points_max=5000, **kwargs):
+                       start_date=None, end_date=None, n_points_max=5000, max_jobs=4, poll_interval=10,
+                       ledger_table='s2_job_ledger', out_format="CSV", model_table='s2_window_model',
+                       target_rows=50000, **kwargs):
     """
     This function is a wrapper for the get_sentinel2_data function. It calls it with the defined parameters,
     manage the time windows and the database connection.
@@ -245,17 +956,33 @@ def get_s2_points_OEO(osm_id, db_name, user, db_table_reservoirs, db_table_point
     :param db_table_meteo: Database table with historic meteo data
     :param start_date: Start date
     :param end_date: End date
-    :param n_points_max: Maximum number of points for water reservoir
+    :param n_points_max: Maximum number of points for water reservoir (sets the time windows of the first run)
+    :param max_jobs: Maximum number of OpenEO jobs running at once
+    :param poll_interval: Time between the polls of the job statuses (seconds)
+    :param ledger_table: Database table with the job ledger (None - the ledger is not used)
+    :param out_format: Format of the OpenEO job results (CSV or Parquet)
+    :param model_table: Database table with the sizing models of the time windows
+    :param target_rows: Target number of rows per OpenEO job
     :param kwargs: Kwargs
     :return: None
     """
 
     # Connect to PostGIS
-    engine = create_engine('postgresql://{user}@/{db_name}'.format(user=user, db_name=db_name))
+    engine = get_engine(user, db_name)
 
     # Get points
     point_layer = get_sampling_points(osm_id, db_name, user, db_table_reservoirs, db_table_points)
 
+    # Planner of the time windows
+    n_points: int = len(point_layer)
+    if n_points == 0:
+        warnings.warn(f"There are no sampling points for the reservoir {osm_id}. Sentinel 2 data will not be "
+                      f"downloaded.", stacklevel=2)
+        return
+
+    planner = S2WindowPlanner(osm_id, n_points, engine, model_table=model_table, target_rows=target_rows,
+                              initial_days=max(1, int(n_points_max * 100 // n_points)))
+
     # Check if table exists and create new one if not
     query = text(
         "SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema = 'public' AND table_name = '{tab_name}')".format(
@@ -266,16 +993,19 @@ def get_s2_points_OEO(osm_id, db_name, user, db_table_reservoirs, db_table_point
         exists = result.scalar()
 
     # Set start date
-    if exists:
+    st_date = None
+    if ledger_table is not None:
+        # The first day not covered by the job ledger; the windows recorded after it are skipped or resumed by the
+        # job manager
+        st_date = ledger_start_date(read_job_ledger(engine, ledger_table, osm_id))
+
+    if st_date is None and exists:
         # Get last date from database
         st_date = getLastDateInDB(osm_id, db_name, user, db_table_S2_points_data)
+        if st_date is not None:
+            st_date = st_date + timedelta(days=1)
 
-    else:
-        st_date = None
-
-    if st_date is not None:
-        st_date = st_date + timedelta(days=1)
-    else:
+    if st_date is None:
         if start_date is None:
             start_date = '2015-06-01'
 
@@ -291,107 +1021,34 @@ def get_s2_points_OEO(osm_id, db_name, user, db_table_reservoirs, db_table_point
         print('Data for period from {st_date} to {end_date} are not available. Data will not be downloaded'.format(st_date=st_date,
                                                                                             end_date=end_date))
 
-        return
-
-    print('Data for period from {st_date} to {end_date} will be downloaded'.format(st_date=st_date, end_date=end_date))
-
-    # Set time windows
-    # Create chunks for time series
-    # Get possible length of steps (chunks)
-    n_points: int = len(point_layer)
-
-    step_length = int(n_points_max) // (n_points/100)
-
-    n_days = (end_date - st_date).days
-
-    n_chunks = n_days // step_length + 1
-
-    # Create time windows
-    t_delta = int((end_date - st_date).days / n_chunks)
+        # Only the unfinished windows from the job ledger are resumed
+        if ledger_table is None:
+            return
 
-    if t_delta < 2:
-        t_delta = 2
+        slots = []
 
-    freq = '{tdelta}D'.format(tdelta=t_delta)
-    date_range = pd.date_range(start=st_date, end=end_date, freq=freq)
-    slots = [(date_range[i].date().isoformat(), (date_range[i + 1] - timedelta(days=1)).date().isoformat()) for i in
-             range(len(date_range) - 1)]
-    # slots.append((date_range[-1].date().isoformat(), end_date.isoformat()))       # Add last day window
-
-    # Get Sentinel-2 data - run the job
-    # Loop over the time windows
-    for i in range(len(slots)):
-        print(f"Data for time slot from {slots[i][0]} to {slots[i][1]} will be downloaded")
-
-        # Try to get Sentinel-2 data for the time window. There are 2 attempts
-        dataset_err = True
-
-        # Attempt to get Sentinel-2 data
-        attempt_no = 1
-        while dataset_err:
-            try:
-                print(f"Attempt no. {attempt_no} to get Sentinel 2 data.")
-                jobid = process_s2_points_OEO(osm_id, point_layer, slots[i][0], slots[i][1], db_name, user, db_table_S2_points_data)
-
-            except Exception as e:
-                print(f"Attempt no. {attempt_no} to get Sentinel 2 data failed. Error: {str(e)}")
-                jobid = None
+    else:
+        print('Data for period from {st_date} to {end_date} will be downloaded'.format(st_date=st_date, end_date=end_date))
 
-            # Check if there is an error in the job
-            dataset_err = check_job_error(jobid)
+        # Set time windows by the sizing model of the reservoir (the first run uses windows of
+        # n_points_max * 100 // n_points days)
+        slots = planner.plan(st_date, end_date)
 
-            if dataset_err:
-                warnings.warn(f"Attempt no. {attempt_no} to get Sentinel 2 data failed.", stacklevel=2)
-                time.sleep(5)
-                if attempt_no == 3:
-                    break
-            attempt_no = attempt_no + 1
+    # Get Sentinel-2 data - run the jobs for all time windows concurrently
+    manager = OEOJobManager(osm_id, point_layer, db_name, user, db_table_S2_points_data, max_jobs=max_jobs,
+                            poll_interval=poll_interval, ledger_table=ledger_table, out_format=out_format)
+    results = manager.run(slots)
 
-        print(f"Dataset error: {dataset_err}")
+    # Update the sizing model by the results of the jobs
+    planner.update(results)
 
-        if dataset_err:
-            # Split time window to smaller windows
-            warnings.warn(f"Attempt to get Sentinel 2 data failed. The time window will be split to smaller windows", stacklevel=2)
-            st_in_slot = datetime.strptime(slots[i][0], "%Y-%m-%d").date()
-            end_in_slot = datetime.strptime(slots[i][1], "%Y-%m-%d").date()
-            n_days_window = (end_in_slot - st_in_slot).days
+    n_failed = sum(result['status'] == 'failed' for result in results)
+    if n_failed > 0:
+        warnings.warn(f"Sentinel 2 data for {n_failed} time windows were not downloaded.", stacklevel=2)
 
-            # Split time window to smaller windows (30 days max)
-            if n_days_window > 30:
-                t_delta_window = 30
-            else:
-                t_delta_window = n_days_window
-
-            freq_window = '{tdelta}D'.format(tdelta=t_delta_window)
-            date_range_window = pd.date_range(start=st_in_slot, end=end_in_slot, freq=freq_window)
-            slots_window = [(date_range_window[j].date().isoformat(), (date_range_window[j + 1] - timedelta(
-                days=1)).date().isoformat()) for j in range(len(date_range_window) - 1)]
-            slots_window.append((date_range_window[-1].date().isoformat(), end_in_slot.isoformat()))
-
-            #
-            for slot in range(len(slots_window)):
-                # Attempt to download data in the time windows. If the data are not available, the attempt will be
-                # repeated 5 times. In case of an error, the function will use shorter time windows as a protection
-                # of the missing data. Because there can be some blocks in the server, the function is sleeping for 1
-                # second between attempts.
-
-                print(slots_window[slot][0], slots_window[slot][1])
-
-                max_attempts = 2
-                attempt = 0
-                success = False
-
-                while attempt < max_attempts and not success:
-                    try:
-                        process_s2_points_OEO(osm_id, point_layer, slots_window[slot][0], slots_window[slot][1], db_name, user,
-                                              db_table_S2_points_data)
-                        success = True
-                    except Exception as e:
-                        warnings.warn("Attempt {attempt} failed. Error: {error}".format(attempt=attempt, error=str(e)),
-                                      stacklevel=2)
-                        attempt += 1
-                        time.sleep(1)       # sleep for 1 second because the possibly unblocking the server
-
-    engine.dispose()
+    n_not_written = sum(result['status'] == 'ingest_failed' for result in results)
+    if n_not_written > 0:
+        warnings.warn(f"Sentinel 2 data for {n_not_written} time windows were processed but not written to the "
+                      f"database.", stacklevel=2)
 
     return
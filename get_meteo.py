@@ -4,15 +4,127 @@ import requests_cache
 import geopandas as gpd
 
 from retry_requests import retry
-from sqlalchemy import create_engine, exc, text
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import exc, text
 from datetime import datetime, timedelta
 import warnings
 
+from db_pool import get_engine
+from db_copy import upsert_to_db
+from meteo_cache import MeteoCache, get_meteo_cache
+from reservoirs import has_precomputed_columns
 
-def getHistoricalMeteoData(osm_id, meteo_features, user, db_name, db_table, vect_db_table, time_zone='GMT'):
+
+def getOpenMeteoClient(expire_after=-1):
+    """
+    Setup the Open-Meteo API client with cache and retry on error
+
+    :param expire_after: Expiration of the cached responses in seconds (-1 - never, None - without the HTTP cache)
+    :return: Open-Meteo client
+    """
+
+    cache_session = requests_cache.CachedSession('.cache', expire_after=expire_after) if expire_after is not None else None
+    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
+    openmeteo = openmeteo_requests.Client(session=retry_session)
+
+    return openmeteo
+
+
+def decodeDailyResponse(response, meteo_features):
+    """
+    Decode the daily variables of one location of the Open-Meteo response to DataFrame.
+
+    :param response: Open-Meteo response for one location
+    :param meteo_features: List of meteo features (in the requested order)
+    :return: DataFrame with date and meteo features
     """
-    Get meteodata from Open-Meteo Historical Weather API and save it to PostGIS database for the particular OSM id and its location. The function fulfill the last data in the database. The time serries is daily from 2015-06-01 till one day before today.
+
+    daily = response.Daily()
+
+    daily_data = {"date": pd.date_range(
+        start=pd.to_datetime(daily.Time(), unit="s", utc=True),
+        end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
+        freq=pd.Timedelta(seconds=daily.Interval()),
+        inclusive="left"
+    )}
+
+    # Process daily data. The order of variables needs to be the same as requested.
+    for i in range(len(meteo_features)):
+        daily_data[meteo_features[i]] = daily.Variables(i).ValuesAsNumpy()
+
+    daily_meteo = pd.DataFrame(data=daily_data)
+
+    # Handling date
+    daily_meteo["date"] = daily_meteo["date"].dt.tz_localize(None).dt.date
+
+    return daily_meteo
+
+
+def fetchHistoricalMeteo(df_loc, end_date, meteo_features, time_zone='GMT', batch_size=50, openmeteo=None,
+                         meteo_cache=None):
+    """
+    Fetch the daily meteodata from Open-Meteo Historical Weather API for many locations. The days found in the meteo
+    cache are not requested. The locations with the same missing date range are requested together by
+    multi-location requests (at most batch_size locations in one request).
+
+    :param df_loc: DataFrame with lat, lon and start_date columns indexed by the location id
+    :param end_date: End date (included)
+    :param meteo_features: List of meteo features
+    :param time_zone: Time zone. Default GMT
+    :param batch_size: Maximum number of locations in one request. Default 50
+    :param openmeteo: Open-Meteo client. Default None - the client with retry is created
+    :param meteo_cache: MeteoCache. Default None - the cache shared by the process
+    :return: Dictionary {location id: DataFrame with date and meteo features}
+    """
+
+    if meteo_cache is None:
+        meteo_cache = get_meteo_cache()
+
+    # Cached days and the missing date ranges of the locations
+    frames = {loc_id: [] for loc_id in df_loc.index}
+    keys = {}
+    missing = {}
+    for loc_id, lat, lon, start_date in zip(df_loc.index, df_loc["lat"], df_loc["lon"], df_loc["start_date"]):
+        keys[loc_id] = MeteoCache.key(lat, lon, meteo_features, time_zone)
+        df_cached, ranges = meteo_cache.get(keys[loc_id], start_date, end_date)
+        if not df_cached.empty:
+            frames[loc_id].append(df_cached)
+        for date_range in ranges:
+            missing.setdefault(date_range, []).append(loc_id)
+
+    if missing and openmeteo is None:
+        # The responses are cached by the meteo cache, the HTTP cache is not used
+        openmeteo = getOpenMeteoClient(expire_after=None)
+
+    url = "https://archive-api.open-meteo.com/v1/archive"
+
+    # Request the locations with the same date range together
+    for (start_date, range_end), loc_ids in missing.items():
+        for i in range(0, len(loc_ids), batch_size):
+            df_batch = df_loc.loc[loc_ids[i:i + batch_size]]
+            params = {
+                "latitude": df_batch["lat"].tolist(),
+                "longitude": df_batch["lon"].tolist(),
+                "start_date": start_date,
+                "end_date": range_end,
+                "daily": meteo_features,
+                "timezone": time_zone
+            }
+            responses = openmeteo.weather_api(url, params=params)
+
+            # The responses are in the same order as the locations
+            for loc_id, response in zip(df_batch.index, responses):
+                daily_meteo = decodeDailyResponse(response, meteo_features)
+                meteo_cache.put(keys[loc_id], daily_meteo)
+                frames[loc_id].append(daily_meteo)
+
+    return {loc_id: pd.concat(dfs, ignore_index=True).sort_values("date", ignore_index=True)
+            for loc_id, dfs in frames.items() if dfs}
+
+
+def getHistoricalMeteoData(osm_id, meteo_features, user, db_name, db_table, vect_db_table, time_zone='GMT',
+                           openmeteo=None, meteo_cache=None):
+    """
+    Get meteodata from Open-Meteo Historical Weather API and save it to PostGIS database for the particular OSM id and its location. The function fulfill the last data in the database. The time serries is daily from 2015-06-01 till one day before today. The last date in the database is downloaded again and updated (upsert by osm_id and date).
 
     :param osm_id: ID of OSM object (water reservoir)
     :param meteo_features: List of meteo features
@@ -21,11 +133,13 @@ def getHistoricalMeteoData(osm_id, meteo_features, user, db_name, db_table, vect
     :param db_table: Postgres database table
     :param vect_db_table: PostGIS database table with water reservoirs
     :param time_zone: Time zone. Default GMT
+    :param openmeteo: Open-Meteo client. Default None - the client with retry is created
+    :param meteo_cache: MeteoCache. Default None - the cache shared by the process
     :return:
     """
 
     # Connect to PostGIS
-    engine = create_engine('postgresql://{user}@/{db_name}'.format(user=user, db_name=db_name))
+    engine = get_engine(user, db_name)
 
     # Get latitude and longitude
     lat, lon = getLatLon(osm_id, db_name, user, vect_db_table)
@@ -38,14 +152,6 @@ def getHistoricalMeteoData(osm_id, meteo_features, user, db_name, db_table, vect
             datum = '2015-06-01'
             last_db_date = datetime.strptime(datum, "%Y-%m-%d").date()
 
-        else:
-            # Remove last date from database.
-            sql_query = text("DELETE FROM meteo_history WHERE osm_id = :val1 AND date = :val2")
-            conn = engine.connect()
-            conn.execute(sql_query, {'val1': str(osm_id), 'val2': last_db_date})
-            conn.commit()
-            conn.close()
-
         start_date = last_db_date
 
     except:
@@ -54,62 +160,135 @@ def getHistoricalMeteoData(osm_id, meteo_features, user, db_name, db_table, vect
 
     end_date = datetime.now().date() - timedelta(days=1)
 
-    # Setup the Open-Meteo API client with cache and retry on error
-    cache_session = requests_cache.CachedSession('.cache', expire_after=-1)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
+    # One location is requested (see getHistoricalMeteoDataBatch for many locations)
+    df_loc = pd.DataFrame({"lat": [lat], "lon": [lon], "start_date": [start_date]}, index=[str(osm_id)])
+    daily_meteo = fetchHistoricalMeteo(df_loc, end_date, meteo_features, time_zone, openmeteo=openmeteo,
+                                       meteo_cache=meteo_cache).get(str(osm_id))
 
-    # Make sure all required weather variables are listed here
-    # The order of variables in hourly or daily is important to assign them correctly below
-    url = "https://archive-api.open-meteo.com/v1/archive"
-    params = {
-        "latitude": lat,
-        "longitude": lon,
-        "start_date": start_date,
-        "end_date": end_date,
-        "daily": meteo_features,
-        "timezone": time_zone
-    }
-    responses = openmeteo.weather_api(url, params=params)
+    if daily_meteo is None:
+        return
 
-    # Process first location. Add a for-loop for multiple locations or weather models
-    response = responses[0]
-    # print(f"Coordinates {response.Latitude()}°N {response.Longitude()}°E")
-    # print(f"Elevation {response.Elevation()} m asl")
-    # print(f"Timezone {response.Timezone()} {response.TimezoneAbbreviation()}")
-    # print(f"Timezone difference to GMT+0 {response.UtcOffsetSeconds()} s"),
+    # Add OSM ID to dataframe
+    daily_meteo["osm_id"] = str(osm_id)
 
-    daily = response.Daily()
+    # Save data to PostGIS (the last date is updated)
+    upsert_to_db(daily_meteo, db_table, engine)
 
-    daily_data = {"date": pd.date_range(
-        start=pd.to_datetime(daily.Time(), unit="s", utc=True),
-        end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
-        freq=pd.Timedelta(seconds=daily.Interval()),
-        inclusive="left"
-    )}
+    return
 
-    # Process daily data. The order of variables needs to be the same as requested.
-    for i in range(len(meteo_features)):
-        daily_data[meteo_features[i]] = daily.Variables(i).ValuesAsNumpy()
+def getHistoricalMeteoDataBatch(osm_ids, meteo_features, user, db_name, db_table, vect_db_table, time_zone='GMT',
+                                batch_size=50, grid_resolution=None, db_table_cells='meteo_cells', openmeteo=None,
+                                meteo_cache=None):
+    """
+    Get meteodata from Open-Meteo Historical Weather API for many water reservoirs and save it to PostGIS database.
+    The reservoirs with the same missing date range (from the last date in the database, without the days in the meteo
+    cache) are requested together by multi-location requests (at most batch_size locations in one request). The data
+    of all reservoirs are written to the database at once (upsert by osm_id and date, so the downloaded last dates are
+    updated).
 
-    daily_meteo = pd.DataFrame(data=daily_data)
+    With grid_resolution the reservoirs are mapped to the cells of the meteo model grid (see getMeteoCells). The data
+    are fetched and stored once for each cell (the table is keyed by cell_id and date) and the reservoirs point to
+    their cell in the db_table_cells table.
 
-    # Handling date
-    daily_meteo["date"] = daily_meteo["date"].dt.tz_localize(None).dt.date
+    :param osm_ids: List of OSM object ids (water reservoirs)
+    :param meteo_features: List of meteo features
+    :param user: Postgres DB user
+    :param db_name: Postgres database name
+    :param db_table: Postgres database table
+    :param vect_db_table: PostGIS database table with water reservoirs
+    :param time_zone: Time zone. Default GMT
+    :param batch_size: Maximum number of locations in one request. Default 50
+    :param grid_resolution: Resolution of the meteo grid in degrees. Default None - the data are stored for each
+                            reservoir
+    :param db_table_cells: Database table with the grid cells of the reservoirs. Default 'meteo_cells'
+    :param openmeteo: Open-Meteo client. Default None - the client with retry is created
+    :param meteo_cache: MeteoCache. Default None - the cache shared by the process
+    :return: Number of the written rows
+    """
 
-    # Add OSM ID to dataframe
-    daily_meteo["osm_id"] = str(osm_id)
+    osm_ids = [str(osm_id) for osm_id in osm_ids]
 
-    # Save data to PostGIS
-    daily_meteo.to_sql(db_table, con=engine, if_exists='append', index=False)
-    engine.dispose()
+    # Connect to PostGIS
+    engine = get_engine(user, db_name)
+
+    # Get latitude and longitude of all reservoirs or of their grid cells
+    if grid_resolution is None:
+        key = "osm_id"
+        df_loc = getLatLonBatch(osm_ids, db_name, user, vect_db_table)
+        found = df_loc.index
+    else:
+        key = "cell_id"
+        df_cells = getMeteoCells(osm_ids, db_name, user, vect_db_table, db_table_cells, grid_resolution)
+        df_loc = df_cells.drop_duplicates("cell_id").set_index("cell_id")[["lat", "lon"]]
+        found = df_cells.index
+
+    missing = set(osm_ids) - set(found)
+    if missing:
+        warnings.warn("Water reservoirs {} are not in the table {}".format(sorted(missing), vect_db_table),
+                      stacklevel=2)
+
+    # The last date is downloaded again (it could be incomplete)
+    last_dates = getLastDatesInDB(df_loc.index.tolist(), db_name, user, db_table, key=key)
+    default_date = datetime.strptime("2015-06-01", "%Y-%m-%d").date()
+    df_loc["start_date"] = [last_dates.get(loc_id, default_date) for loc_id in df_loc.index]
 
-    return
+    end_date = datetime.now().date() - timedelta(days=1)
+    df_loc = df_loc[df_loc["start_date"] <= end_date]
+
+    if df_loc.empty:
+        return 0
+
+    # Fetch the data of all locations (the cached days are not requested)
+    results = fetchHistoricalMeteo(df_loc, end_date, meteo_features, time_zone, batch_size, openmeteo, meteo_cache)
+    if not results:
+        return 0
+
+    daily_meteo = pd.concat([df.assign(**{key: loc_id}) for loc_id, df in results.items()], ignore_index=True)
+
+    # Save all data at once (the last dates are updated)
+    upsert_to_db(daily_meteo, db_table, engine, key=(key, "date"))
 
-def getPredictedMeteoData(osm_id, meteo_features, user, db_name, db_table_forecast, db_table_reservoirs, forecast_days=10, time_zone='GMT'):
+    print("Meteo data for {} locations of {} water reservoirs ({} rows) were saved".format(
+        len(df_loc), len(found), len(daily_meteo)))
+
+    return len(daily_meteo)
+
+
+def getMeteoCells(osm_ids, db_name, user, db_table_reservoirs, db_table_cells, grid_resolution=0.1):
+    """
+    Map the centroids of the water reservoirs to the cells of the meteo model grid and save the mapping to the
+    database (one row for each reservoir). The Open-Meteo historical data come from the grid of about 0.1 degree
+    (ERA5-Land) or coarser, so the reservoirs in the same cell have the same meteo data.
+
+    :param osm_ids: List of OSM object ids (water reservoirs)
+    :param db_name: Database name
+    :param user: Database user
+    :param db_table_reservoirs: PostGIS database table with water reservoirs
+    :param db_table_cells: Database table with the grid cells of the reservoirs
+    :param grid_resolution: Resolution of the meteo grid in degrees. Default 0.1
+    :return: DataFrame indexed by osm_id with cell_id and lat and lon of the cell centre
+    """
+
+    engine = get_engine(user, db_name)
+
+    df_loc = getLatLonBatch(osm_ids, db_name, user, db_table_reservoirs)
+
+    # Centre of the grid cell
+    df_cells = pd.DataFrame(index=df_loc.index)
+    df_cells["lat"] = (df_loc["lat"] / grid_resolution).round() * grid_resolution
+    df_cells["lon"] = (df_loc["lon"] / grid_resolution).round() * grid_resolution
+    df_cells["cell_id"] = ["{:.4f}_{:.4f}".format(lat, lon) for lat, lon in zip(df_cells["lat"], df_cells["lon"])]
+
+    upsert_to_db(df_cells.reset_index(), db_table_cells, engine, key=("osm_id",))
+
+    return df_cells
+
+
+def getPredictedMeteoData(osm_id, meteo_features, user, db_name, db_table_forecast, db_table_reservoirs, forecast_days=10, time_zone='GMT',
+                          openmeteo=None):
     """
     Get meteodata forecast from Open-Meteo Forecast API in daily step for particular OSM object id. The results are
-    saved to database.
+    saved to database; the old forecast of the OSM object is replaced in one transaction.
 
     :param osm_id: OSM object id (water reservoir)
     :param meteo_features: List of weather variables to get
@@ -119,6 +298,7 @@ def getPredictedMeteoData(osm_id, meteo_features, user, db_name, db_table_foreca
     :param db_table_reservoirs: PostGIS database table with water reservoirs
     :param forecast_days: Number of days to forecast. Default = 10, max = 16
     :param time_zone: Time zone. Default = 'GMT'
+    :param openmeteo: Open-Meteo client. Default None - the client with cache and retry is created
     :return: Dataframe with meteo data forecast
     """
 
@@ -127,17 +307,14 @@ def getPredictedMeteoData(osm_id, meteo_features, user, db_name, db_table_foreca
         forecast_days = 16
 
     # Connect to PostGIS
-    engine = create_engine('postgresql://{user}@/{db_name}'.format(user=user, db_name=db_name))
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    engine = get_engine(user, db_name)
 
     # Get latitude and longitude
     lat, lon = getLatLon(osm_id, db_name, user, db_table_reservoirs)
 
     # Setup the Open-Meteo API client with cache and retry on error
-    cache_session = requests_cache.CachedSession('.cache', expire_after=3600)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
+    if openmeteo is None:
+        openmeteo = getOpenMeteoClient(expire_after=3600)
 
     # Make sure all required weather variables are listed here
     # The order of variables in hourly or daily is important to assign them correctly below
@@ -152,58 +329,82 @@ def getPredictedMeteoData(osm_id, meteo_features, user, db_name, db_table_foreca
 
     responses = openmeteo.weather_api(url, params=params)
 
-    # Process first location. Add a for-loop for multiple locations or weather models
-    response = responses[0]
-    # print(f"Coordinates {response.Latitude()}°N {response.Longitude()}°E")
-    # print(f"Elevation {response.Elevation()} m asl")
-    # print(f"Timezone {response.Timezone()} {response.TimezoneAbbreviation()}")
-    # print(f"Timezone difference to GMT+0 {response.UtcOffsetSeconds()} s"),
+    daily_forecast = decodeDailyResponse(responses[0], meteo_features)
+    daily_forecast["osm_id"] = str(osm_id)
 
-    daily = response.Daily()
+    # Replace the old forecast by the new one in one transaction
+    upsert_to_db(daily_forecast, db_table_forecast, engine, replace_by='osm_id')
 
-    daily_data = {"date": pd.date_range(
-        start=pd.to_datetime(daily.Time(), unit="s", utc=True),
-        end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
-        freq=pd.Timedelta(seconds=daily.Interval()),
-        inclusive="left"
-    )}
+    return daily_forecast
 
-    # Process daily data. The order of variables needs to be the same as requested.
-    for i in range(len(meteo_features)):
-        daily_data[meteo_features[i]] = daily.Variables(i).ValuesAsNumpy()
 
-    daily_forecast = pd.DataFrame(data=daily_data)
-    daily_forecast["osm_id"] = str(osm_id)
+def getPredictedMeteoDataBatch(osm_ids, meteo_features, user, db_name, db_table_forecast, db_table_reservoirs,
+                               forecast_days=10, time_zone='GMT', batch_size=50, openmeteo=None):
+    """
+    Get meteodata forecast from Open-Meteo Forecast API in daily step for many OSM objects by multi-location requests
+    (at most batch_size locations in one request). The old forecasts of all OSM objects are replaced by the new ones
+    in one transaction.
 
-    # Handling date
-    daily_forecast["date"] = daily_forecast["date"].dt.tz_localize(None).dt.date
+    :param osm_ids: List of OSM object ids (water reservoirs)
+    :param meteo_features: List of weather variables to get
+    :param user: Database user
+    :param db_name: Database name
+    :param db_table_forecast: Database table with meteo forecast
+    :param db_table_reservoirs: PostGIS database table with water reservoirs
+    :param forecast_days: Number of days to forecast. Default = 10, max = 16
+    :param time_zone: Time zone. Default = 'GMT'
+    :param batch_size: Maximum number of locations in one request. Default 50
+    :param openmeteo: Open-Meteo client. Default None - the client with cache and retry is created
+    :return: Dataframe with meteo data forecast
+    """
 
-    # Remove the old data from Postgres
-    # Check if table exists and create new one if not
-    query = text(
-        "SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema = 'public' AND table_name = '{tab_name}')".format(
-            tab_name=db_table_forecast))
+    if forecast_days > 16:
+        warnings.warn("The maximum number of days to forecast is 16. The forecast will be set to 16 days", stacklevel=2)
+        forecast_days = 16
 
-    # Vykonání dotazu s parametrem
-    with engine.connect() as connection:
-        result = connection.execute(query)
-        exists = result.scalar()
+    # Connect to PostGIS
+    engine = get_engine(user, db_name)
+
+    # Get latitude and longitude of all reservoirs
+    df_loc = getLatLonBatch(osm_ids, db_name, user, db_table_reservoirs)
+
+    if df_loc.empty:
+        return pd.DataFrame()
+
+    # Setup the Open-Meteo API client with cache and retry on error
+    if openmeteo is None:
+        openmeteo = getOpenMeteoClient(expire_after=3600)
+
+    url = "https://api.open-meteo.com/v1/forecast"
 
-    if exists:
-        print("Table {} exists".format(db_table_forecast))
-        session.execute(text("DELETE FROM {db_table} WHERE osm_id = '{osm_id}'".format(db_table=db_table_forecast, osm_id=str(osm_id))))
-        session.commit()
+    frames = []
+    for i in range(0, len(df_loc), batch_size):
+        df_batch = df_loc.iloc[i:i + batch_size]
+        params = {
+            "latitude": df_batch["lat"].tolist(),
+            "longitude": df_batch["lon"].tolist(),
+            "daily": meteo_features,
+            "timezone": time_zone,
+            "forecast_days": forecast_days
+        }
+        responses = openmeteo.weather_api(url, params=params)
 
+        for osm_id, response in zip(df_batch.index, responses):
+            daily_forecast = decodeDailyResponse(response, meteo_features)
+            daily_forecast["osm_id"] = osm_id
+            frames.append(daily_forecast)
 
-    # Save new data to Postgres
-    daily_forecast.to_sql(db_table_forecast, con=engine, if_exists='append', index=False)
-    engine.dispose()
+    daily_forecast = pd.concat(frames, ignore_index=True)
+
+    # Replace the old forecasts by the new ones in one transaction
+    upsert_to_db(daily_forecast, db_table_forecast, engine, replace_by='osm_id')
 
     return daily_forecast
 
 def getLatLon(osm_id, db_name, user, db_table):
     """
-    Get latitude and longitude from OSM id
+    Get latitude and longitude from OSM id. The precomputed centroid is read if the table was filled by
+    reservoirs.load_reservoirs.
 
     :param osm_id: OSM object id
     :param db_name: Database name
@@ -213,7 +414,14 @@ def getLatLon(osm_id, db_name, user, db_table):
     """
 
     # Připojení k databázi PostGIS
-    engine = create_engine('postgresql://{}@/{}'.format(user, db_name))
+    engine = get_engine(user, db_name)
+
+    if has_precomputed_columns(engine, db_table):
+        sql_query = text("SELECT AVG(lat) AS lat, AVG(lon) AS lon FROM {db_table} WHERE osm_id = :osm_id".format(
+            db_table=db_table))
+        with engine.connect() as connection:
+            lat, lon = connection.execute(sql_query, {'osm_id': str(osm_id)}).one()
+        return lat, lon
 
     # Get geometry for polygon
     sql_query = text("SELECT * FROM {db_table} WHERE osm_id = '{osm_id}'".format(osm_id=str(osm_id), db_table=db_table))
@@ -225,10 +433,69 @@ def getLatLon(osm_id, db_name, user, db_table):
     lon = centroid.x.mean()
     lat = centroid.y.mean()
 
-    engine.dispose()
-
     return lat, lon
 
+def getLatLonBatch(osm_ids, db_name, user, db_table):
+    """
+    Get latitude and longitude of the centroids for many OSM ids by one query. The precomputed centroids are read if
+    the table was filled by reservoirs.load_reservoirs.
+
+    :param osm_ids: List of OSM object ids
+    :param db_name: Database name
+    :param user: Database user
+    :param db_table: Database table
+    :return: DataFrame with lat and lon columns indexed by osm_id (str)
+    """
+
+    engine = get_engine(user, db_name)
+
+    if has_precomputed_columns(engine, db_table):
+        sql_query = text("SELECT osm_id, AVG(lat) AS lat, AVG(lon) AS lon FROM {db_table} WHERE osm_id = ANY(:ids) "
+                         "GROUP BY osm_id".format(db_table=db_table))
+        df_loc = pd.read_sql(sql_query, engine, params={"ids": [str(i) for i in osm_ids]})
+        df_loc['osm_id'] = df_loc['osm_id'].astype(str)
+        return df_loc.set_index('osm_id')[['lat', 'lon']]
+
+    sql_query = text("SELECT osm_id, geometry FROM {db_table} WHERE CAST(osm_id AS text) = ANY(:ids)".format(
+        db_table=db_table))
+    gdf = gpd.read_postgis(sql_query, engine, geom_col='geometry', params={"ids": [str(i) for i in osm_ids]})
+    gdf = gpd.GeoDataFrame(gdf, geometry='geometry', crs='epsg:4326')
+
+    # Mean of the centroids of the reservoir polygons (the same as getLatLon)
+    centroid = gdf['geometry'].centroid
+    df_loc = pd.DataFrame({'osm_id': gdf['osm_id'].astype(str), 'lat': centroid.y, 'lon': centroid.x})
+
+    return df_loc.groupby('osm_id')[['lat', 'lon']].mean()
+
+
+def getLastDatesInDB(osm_ids, db_name, user, db_table, key='osm_id'):
+    """
+    Get last dates in the db table for many OSM ids by one query
+
+    :param osm_ids: List of OSM object ids (or of the values of the key column)
+    :param db_name: Database name
+    :param user: Database user
+    :param db_table: Database table
+    :param key: Key column of the table (e.g. cell_id). Default 'osm_id'
+    :return: Dictionary {osm_id (str): last date}; the OSM ids without data are not included
+    """
+
+    engine = get_engine(user, db_name)
+
+    query = text(
+        "SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema = 'public' AND table_name = '{tab_name}')".format(
+            tab_name=db_table))
+    sql_query = text("SELECT {key}, MAX(date) AS date FROM {db_table} WHERE {key} = ANY(:ids) GROUP BY {key}".format(
+        db_table=db_table, key=key))
+
+    with engine.connect() as connection:
+        if not connection.execute(query).scalar():
+            return {}
+        rows = connection.execute(sql_query, {"ids": [str(i) for i in osm_ids]}).fetchall()
+
+    return {str(loc_id): pd.Timestamp(date).date() for loc_id, date in rows if date is not None}
+
+
 def getLastDateInDB(osm_id, db_name, user, db_table):
     """
     Get last date db table for particular OSM id
@@ -242,7 +509,7 @@ def getLastDateInDB(osm_id, db_name, user, db_table):
 
     try:
         # Connect to PostGIS
-        engine = create_engine('postgresql://{}@/{}'.format(user, db_name))
+        engine = get_engine(user, db_name)
         connection = engine.connect()
 
         # Define SQL query
@@ -252,7 +519,6 @@ def getLastDateInDB(osm_id, db_name, user, db_table):
         # Running SQL query, conversion to DataFrame
         df = pd.read_sql(sql_query, connection)
         connection.close()
-        engine.dispose()
         last_date = df.iloc[0,0]
 
     except exc.NoSuchTableError:
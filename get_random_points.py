@@ -1,98 +1,187 @@
-import os
-
 import numpy as np
-import pandas as pd
 import geopandas as gpd
+import shapely
 
-from shapely.geometry import Polygon, Point
 from scipy.spatial import Delaunay, Voronoi
-from sqlalchemy import create_engine, text
-from multiprocessing import Pool
+from sqlalchemy import text
 from AIHABs_wrappers import measure_execution_time
+from db_pool import get_engine
+from db_copy import copy_to_db
+from reservoirs import has_precomputed_columns
+
+
+def in_polygon(x, y, polygon):
+    """
+    Test which points are in the polygon. The polygon is prepared and the coordinates of all points are tested at once
+    (shapely.intersects_xy), so the points on the boundary are kept as by GeoSeries.intersects.
+
+    :param x: Array of the x coordinates
+    :param y: Array of the y coordinates
+    :param polygon: Polygon geometry
+    :return: Boolean array (True for the points in the polygon)
+    """
+
+    shapely.prepare(polygon)
+
+    return shapely.intersects_xy(polygon, x, y)
 
 
 def points_clip(points, polygon):
     """
-    Clip points to the polygon
+    Clip points to the polygon (see in_polygon).
+
     :param points: GeoDataFrame with points
-    :param polygon: GeoDataFrame with polygons
+    :param polygon: Polygon geometry
     :return: Clipped points (GeoDataFrame)
     """
-    return points[points.intersects(polygon)]
 
+    geoms = points.geometry.values
 
-def point_mesh(polygon, distance_lat=0.01, distance_lon=0.01):
+    return points[in_polygon(shapely.get_x(geoms), shapely.get_y(geoms), polygon)]
+
+
+def point_mesh_coords(polygon, distance_lat=0.01, distance_lon=0.01):
     """
-    Create a grid of points based on the bounding box of the input polygon.
+    Create a grid of point coordinates based on the bounding box of the input polygon. Only the grid points between the
+    west and east edge of the polygon in each grid row are kept.
 
-    :param polygon: A GeoDataFrame representing a polygon.
+    :param polygon: Polygon geometry
     :param distance_lat: The distance between grid points in latitude. Default 0.01° for EPSG:4326.
     :param distance_lon: The distance between grid points in longitude. Default 0.01° for EPSG:4326.
-    :return: A GeoDataFrame containing the grid points.
+    :return: Array of the grid point coordinates (n x 2)
     """
 
     # Get the bounding box of the polygon
-    minx, miny, maxx, maxy = polygon.total_bounds
+    minx, miny, maxx, maxy = polygon.bounds
 
     # Calculate the number of grid points based on the distance and bounding box size
     num_points_lat = int((maxy - miny)/distance_lat)
     num_points_lon = int((maxx - minx)/distance_lon)
 
-    # Create the grid points
     latitudes = np.linspace(miny, maxy, num_points_lat)
     longitudes = np.linspace(minx, maxx, num_points_lon)
-    grid_points = [Point(lon, lat) for lat in latitudes for lon in longitudes]
+
+    if len(latitudes) == 0 or len(longitudes) == 0:
+        return np.empty((0, 2))
+
+    # Extent of the polygon in each grid row (intersection with the horizontal line)
+    rows = shapely.linestrings(np.stack([np.column_stack([np.full_like(latitudes, minx), latitudes]),
+                                         np.column_stack([np.full_like(latitudes, maxx), latitudes])], axis=1))
+    row_bounds = shapely.bounds(shapely.intersection(rows, polygon))
+
+    with np.errstate(invalid='ignore'):
+        mask = (longitudes[None, :] >= row_bounds[:, [0]]) & (longitudes[None, :] <= row_bounds[:, [2]])
+    i_lat, i_lon = np.nonzero(mask)
+
+    return np.column_stack([longitudes[i_lon], latitudes[i_lat]])
+
+
+def point_mesh(polygon, distance_lat=0.01, distance_lon=0.01):
+    """
+    Create a grid of points based on the bounding box of the input polygon (see point_mesh_coords).
+
+    :param polygon: A GeoDataFrame representing a polygon.
+    :param distance_lat: The distance between grid points in latitude. Default 0.01° for EPSG:4326.
+    :param distance_lon: The distance between grid points in longitude. Default 0.01° for EPSG:4326.
+    :return: A GeoDataFrame containing the grid points.
+    """
+
+    coords = point_mesh_coords(polygon.geometry.union_all(), distance_lat, distance_lon)
 
     # Convert the grid points into a GeoDataFrame
-    gdf_grid = gpd.GeoDataFrame(geometry=grid_points)
+    gdf_grid = gpd.GeoDataFrame(geometry=gpd.points_from_xy(coords[:, 0], coords[:, 1]))
 
     return gdf_grid
 
 
-def delaunay_centroids(vertices):
+def delaunay_centroid_coords(vertices):
     """
-    Perform Delaunay triangulation on the given vertices and return a GeoDataFrame
-    containing the centroids of the Voronoi regions.
+    Perform Delaunay triangulation on the given vertices and return the centroids of the triangles (the means of the
+    triangle vertices).
 
-    :param vertices: The vertices for the Delaunay triangulation. Points geometry.
-    :return: A GeoDataFrame containing the centroids of the Delaunay triangles.
+    :param vertices: The vertices for the Delaunay triangulation (n x 2 array).
+    :return: Array of the centroid coordinates (n x 2)
     """
 
     # Calculate Delaunay triangulation
     tri = Delaunay(vertices)
 
-    # Get triangles
-    triangles = np.array([Polygon(vertices[simplex]) for simplex in tri.simplices])
-    gdf_triangles = gpd.GeoDataFrame(geometry=triangles)
+    return vertices[tri.simplices].mean(axis=1)
+
+
+def delaunay_centroids(vertices):
+    """
+    Perform Delaunay triangulation on the given vertices and return a GeoDataFrame
+    containing the centroids of the Delaunay triangles.
+
+    :param vertices: The vertices for the Delaunay triangulation. Points geometry.
+    :return: A GeoDataFrame containing the centroids of the Delaunay triangles.
+    """
 
-    # Centroids of the triangles
-    centroids = gdf_triangles['geometry'].centroid
-    gdf_centroids = gpd.GeoDataFrame(geometry=centroids)
+    coords = delaunay_centroid_coords(vertices)
+    gdf_centroids = gpd.GeoDataFrame(geometry=gpd.points_from_xy(coords[:, 0], coords[:, 1]))
 
     return gdf_centroids
 
 
-def voronoi_centroids(vertices):
+def voronoi_centroid_coords(vertices):
     """
-    Perform Voronoi triangulation on the given vertices and return a GeoDataFrame
-    containing the centroids of the Voronoi regions.
+    Perform Voronoi triangulation on the given vertices and return the centroids of the bounded Voronoi regions. The
+    centroids are computed by the shoelace formula for all regions at once.
 
-    :param vertices: The vertices for the Voronoi triangulation. Points geometry.
-    :return: A GeoDataFrame containing the centroids of the Voronoi triangles.
+    :param vertices: The vertices for the Voronoi triangulation (n x 2 array).
+    :return: Array of the centroid coordinates (n x 2)
     """
+
     # Calculate Voronoi triangulation
     vor = Voronoi(vertices)
 
     # Get valid regions
     valid_regions = [region for region in vor.regions if -1 not in region and len(region) > 0]
 
-    # Get Voronoi polygons
-    vor_polygons = [Polygon(vor.vertices[region]) for region in valid_regions]
-    gdf_polygons = gpd.GeoDataFrame(geometry=vor_polygons)
+    if not valid_regions:
+        return np.empty((0, 2))
+
+    # Vertices of all regions in one array and the next vertex of each region vertex (closing the ring)
+    lengths = np.array([len(region) for region in valid_regions])
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    index = np.concatenate(valid_regions)
+    position = np.arange(len(index)) - np.repeat(starts, lengths)
+    index_next = index[np.repeat(starts, lengths) + (position + 1) % np.repeat(lengths, lengths)]
+
+    # Relative coordinates (the first vertex of the region) for the numerical precision
+    origin = np.repeat(vor.vertices[index[starts]], lengths, axis=0)
+    x0, y0 = (vor.vertices[index] - origin).T
+    x1, y1 = (vor.vertices[index_next] - origin).T
+
+    cross = x0 * y1 - x1 * y0
+    area = np.add.reduceat(cross, starts) / 2
+    cx = np.add.reduceat((x0 + x1) * cross, starts)
+    cy = np.add.reduceat((y0 + y1) * cross, starts)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroids = np.column_stack([cx, cy]) / (6 * area[:, None])
+
+    # Degenerate regions (zero area): mean of the vertices
+    degenerate = area == 0
+    if degenerate.any():
+        means = np.column_stack([np.add.reduceat(x0, starts), np.add.reduceat(y0, starts)]) / lengths[:, None]
+        centroids[degenerate] = means[degenerate]
+
+    return centroids + vor.vertices[index[starts]]
+
+
+def voronoi_centroids(vertices):
+    """
+    Perform Voronoi triangulation on the given vertices and return a GeoDataFrame
+    containing the centroids of the Voronoi regions.
+
+    :param vertices: The vertices for the Voronoi triangulation. Points geometry.
+    :return: A GeoDataFrame containing the centroids of the Voronoi triangles.
+    """
 
-    # Centroids of the polygons
-    centroids = gdf_polygons['geometry'].centroid
-    gdf_centroids = gpd.GeoDataFrame(geometry=centroids)
+    coords = voronoi_centroid_coords(vertices)
+    gdf_centroids = gpd.GeoDataFrame(geometry=gpd.points_from_xy(coords[:, 0], coords[:, 1]))
 
     return gdf_centroids
 
@@ -130,6 +219,11 @@ def generate_points_in_polygon(in_gdf_polygon, lake_buffer=-20, n_points_km=100,
     """
     Generate points within a polygon with respect of its complexity, and clip them with a buffer zone.
 
+    If the input has the precomputed geom_buffer, area_ha and lake_buffer columns (see reservoirs.reservoir_attributes)
+    and its geometry is already simplified, the simplification, reprojection, buffer and area are not computed again.
+    The precomputed buffer is used only if it was built with the requested lake_buffer, otherwise the buffer is
+    computed from the simplified geometry.
+
     :param in_gdf_polygon: The input polygon as a GeoDataFrame.
     :param lake_buffer: The buffer distance inside the selected water reservoir. Defaults to -20.
     :param n_points_km: The number of points per square kilometer in the area of the reservoir. Defaults to 100.
@@ -140,54 +234,58 @@ def generate_points_in_polygon(in_gdf_polygon, lake_buffer=-20, n_points_km=100,
               - The buffer layer in the original coordinate reference system (GeoDataFrame).
     """
 
+    precomputed = {'geom_buffer', 'area_ha', 'lake_buffer'} <= set(in_gdf_polygon.columns)
+
     # Simplyfy input polygon
-    polygon_geom = in_gdf_polygon['geometry'][0].simplify(0.0001, preserve_topology=True)
+    if precomputed:
+        polygon_geom = in_gdf_polygon.geometry.iloc[0]
+    else:
+        polygon_geom = in_gdf_polygon['geometry'][0].simplify(0.0001, preserve_topology=True)
     gdf_polygon = gpd.GeoDataFrame(geometry=[polygon_geom], crs=in_gdf_polygon.crs)
 
     # Get the vertices of the polygon
     vertices = get_vertices(polygon_geom)
 
-    # Get random points
-    gdf_Delaunay_centroids = delaunay_centroids(vertices)
-    gdf_Voronoi_centroids = voronoi_centroids(vertices)
-    gdf_mesh = point_mesh(gdf_polygon)
-
-    # Concatenate all centroids
-    gdf_centroids = gpd.pd.concat([gdf_Delaunay_centroids, gdf_Voronoi_centroids, gdf_mesh], ignore_index=True)
+    # Get random points (coordinates, the point geometries are created for the clipped points only)
+    centroids = np.vstack([delaunay_centroid_coords(vertices), voronoi_centroid_coords(vertices),
+                           point_mesh_coords(polygon_geom)])
 
     # Sample centroids for decreasing number of points in the dataset
-    if len(gdf_centroids) > 10000:
-        gdf_centroids = gdf_centroids.sample(10000)
+    if len(centroids) > 10000:
+        centroids = centroids[np.random.default_rng().choice(len(centroids), 10000, replace=False)]
 
-    # Create a buffer zone inside the selected water reservoir
-    # Get original CRS of the input layer
-    try:
-        epsg_orig = in_gdf_polygon.crs()
-    except:
-        epsg_orig = 'epsg:4326'
+    if precomputed and in_gdf_polygon['lake_buffer'].iloc[0] == lake_buffer:
+        # Precomputed buffer zone and area of the reservoir
+        gdf_buffer_wgs = gpd.GeoSeries([in_gdf_polygon['geom_buffer'].iloc[0]], crs='epsg:4326')
+        area = in_gdf_polygon['area_ha'].iloc[0]
 
-    # Convert selected layer to UTM CRS
-    epsg_new = in_gdf_polygon.estimate_utm_crs()
-    gdf_polygon_utm = gdf_polygon.to_crs(epsg_new)
+    else:
+        # Create a buffer zone inside the selected water reservoir
+        # Get original CRS of the input layer
+        try:
+            epsg_orig = in_gdf_polygon.crs()
+        except:
+            epsg_orig = 'epsg:4326'
 
-    # Remove buffer zone of the selected water reservoir
-    gdf_buffer_utm = gdf_polygon_utm.buffer(lake_buffer)
+        # Convert selected layer to UTM CRS
+        epsg_new = in_gdf_polygon.estimate_utm_crs()
+        gdf_polygon_utm = gdf_polygon.to_crs(epsg_new)
 
-    # Cover the buffer layer to the original CRS
-    gdf_buffer_wgs = gdf_buffer_utm.to_crs(epsg_orig)
-    buffer_wgs_geometry = gdf_buffer_wgs.geometry.iloc[0]
+        # Remove buffer zone of the selected water reservoir
+        gdf_buffer_utm = gdf_polygon_utm.buffer(lake_buffer)
 
-    # Clip centroids with the buffer layer
-    num_processes = os.cpu_count()
-    chunk_size = len(gdf_centroids) // num_processes
-    points_subsets = [gdf_centroids.iloc[i * chunk_size: (i + 1) * chunk_size] for i in range(num_processes)]
+        # Cover the buffer layer to the original CRS
+        gdf_buffer_wgs = gdf_buffer_utm.to_crs(epsg_orig)
 
-    with Pool(num_processes) as pool:
-        results = pool.starmap(points_clip, [(subset, buffer_wgs_geometry) for subset in points_subsets])
-    gdf_centroids_clipped = gpd.GeoDataFrame(pd.concat(results))
+        # Calculate area of the reservoir
+        area = gdf_polygon_utm.area.values[0] / 10000
 
-    # Calculate area of the reservoir
-    area = gdf_polygon_utm.area.values[0] / 10000
+    buffer_wgs_geometry = gdf_buffer_wgs.geometry.iloc[0]
+
+    # Clip centroids with the buffer layer
+    centroids = centroids[in_polygon(centroids[:, 0], centroids[:, 1], buffer_wgs_geometry)]
+    gdf_centroids_clipped = gpd.GeoDataFrame(geometry=gpd.points_from_xy(centroids[:, 0], centroids[:, 1]),
+                                             crs='epsg:4326')
 
     # Get number of points for the area
     n_points = int(area * n_points_km / 100) + 1
@@ -222,7 +320,7 @@ def get_sampling_points(osm_id, db_name, user, db_table_reservoirs, db_table_poi
     """
 
     # Connect to PostGIS
-    engine = create_engine('postgresql://{user}@/{db_name}'.format(user=user, db_name=db_name))
+    engine = get_engine(user, db_name)
 
     # Check if points table exists and create new one if not
     query = text("SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema = 'public' AND table_name = '{tab_name}')".format(tab_name=db_table_points))
@@ -244,9 +342,15 @@ def get_sampling_points(osm_id, db_name, user, db_table_reservoirs, db_table_poi
 
             return points_selected
 
-    # Get polygon of the reservoir from the DB
-    sql_query = "SELECT * FROM {db_table} WHERE osm_id = '{osm_id}'".format(osm_id=str(osm_id), db_table=db_table_reservoirs)
-    gdf = gpd.read_postgis(sql_query, engine, geom_col='geometry')
+    # Get polygon of the reservoir from the DB (only the precomputed columns if they are available)
+    if has_precomputed_columns(engine, db_table_reservoirs):
+        sql_query = text("SELECT osm_id, geom_simplified AS geometry, geom_buffer, area_ha, lake_buffer FROM {db_table} "
+                         "WHERE osm_id = :osm_id".format(db_table=db_table_reservoirs))
+        gdf = gpd.read_postgis(sql_query, engine, geom_col='geometry', params={'osm_id': str(osm_id)})
+        gdf['geom_buffer'] = shapely.from_wkb(gdf['geom_buffer'].values)
+    else:
+        sql_query = "SELECT * FROM {db_table} WHERE osm_id = '{osm_id}'".format(osm_id=str(osm_id), db_table=db_table_reservoirs)
+        gdf = gpd.read_postgis(sql_query, engine, geom_col='geometry')
     polygon = gpd.GeoDataFrame(gdf, geometry='geometry', crs='epsg:4326')
 
     # Produce random points in the reservoir polygon
@@ -255,7 +359,6 @@ def get_sampling_points(osm_id, db_name, user, db_table_reservoirs, db_table_poi
     points_selected['PID'] = [i for i in range(len(points_selected))]
 
     # Insert points into the DB table
-    points_selected.to_postgis(db_table_points, con=engine, if_exists='append', index=False)
-    engine.dispose()
+    copy_to_db(points_selected, db_table_points, engine)
 
     return points_selected
@@ -0,0 +1,205 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+import pandas as pd
+
+
+class MeteoCache:
+    """
+    Bounded in-memory cache of the daily meteo data. The entries are keyed by the location, the set of variables and
+    the time zone and hold the daily values of the dates fetched so far, so the overlapping date ranges are served
+    from the cached days and only the missing days are fetched. The number of cached days is limited (the least
+    recently used locations are evicted) and the cached days older than max_age are dropped (the archive data can
+    be revised).
+
+    The archive lags behind today, so the days within archive_delay days before the fetch are incomplete. They are
+    not cached and every request of such a day (e.g. the last stored date which is fetched again) reaches the API.
+    """
+
+    def __init__(self, max_rows=500000, max_entries=5000, max_age=7 * 86400, archive_delay=5):
+        """
+        :param max_rows: Maximum number of cached days of all locations
+        :param max_entries: Maximum number of cached locations (and variable sets)
+        :param max_age: Maximum age of the cached days in seconds
+        :param archive_delay: Number of days before today whose archive data are not complete
+        """
+
+        self.max_rows = max_rows
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.archive_delay = archive_delay
+
+        self._entries = OrderedDict()
+        self._rows = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'partial': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def key(lat, lon, variables, time_zone='GMT'):
+        """
+        Cache key of the location and the variables.
+
+        :param lat: Latitude
+        :param lon: Longitude
+        :param variables: List of the meteo variables
+        :param time_zone: Time zone
+        :return: Tuple
+        """
+
+        return round(float(lat), 4), round(float(lon), 4), tuple(variables), time_zone
+
+    def get(self, key, start_date, end_date):
+        """
+        Get the cached days of the date range and the missing date ranges.
+
+        :param key: Cache key (see MeteoCache.key)
+        :param start_date: Start date (included)
+        :param end_date: End date (included)
+        :return: DataFrame with the cached days (date and variables); list of the missing ranges (start, end)
+        """
+
+        dates = pd.date_range(start_date, end_date, freq='D').date
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                # Drop the old days
+                fresh = entry['fetched'] >= time.time() - self.max_age
+                if not fresh.all():
+                    self._rows -= int((~fresh).sum())
+                    entry = entry[fresh]
+                    self._entries[key] = entry
+                self._entries.move_to_end(key)
+                cached = entry[entry.index.isin(dates)]
+            else:
+                cached = None
+
+            if cached is None or cached.empty:
+                self.stats['misses'] += 1
+            elif len(cached) < len(dates):
+                self.stats['partial'] += 1
+            else:
+                self.stats['hits'] += 1
+
+        if cached is None or cached.empty:
+            return pd.DataFrame(), [(dates[0], dates[-1])] if len(dates) else []
+
+        # Missing days as continuous date ranges
+        missing = dates[~pd.Index(dates).isin(cached.index)]
+        ranges = []
+        for d in missing:
+            if ranges and (d - ranges[-1][1]).days == 1:
+                ranges[-1] = (ranges[-1][0], d)
+            else:
+                ranges.append((d, d))
+
+        df = cached.drop(columns=['fetched']).rename_axis('date').reset_index()
+
+        return df, ranges
+
+    def put(self, key, df):
+        """
+        Add the fetched days to the cache entry and evict the least recently used entries above the limits. The days
+        within archive_delay days before today are not added.
+
+        :param key: Cache key (see MeteoCache.key)
+        :param df: DataFrame with date and variables
+        :return:
+        """
+
+        if df is None or df.empty:
+            return
+
+        first_incomplete = (pd.Timestamp.now() - pd.Timedelta(days=self.archive_delay)).date()
+        df = df[pd.to_datetime(df['date']).dt.date < first_incomplete]
+        if df.empty:
+            return
+
+        df_new = df.set_index('date')
+        df_new['fetched'] = time.time()
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._rows -= len(entry)
+                df_new = pd.concat([entry[~entry.index.isin(df_new.index)], df_new]).sort_index()
+
+            self._entries[key] = df_new
+            self._rows += len(df_new)
+
+            while len(self._entries) > 1 and (self._rows > self.max_rows or len(self._entries) > self.max_entries):
+                _, evicted = self._entries.popitem(last=False)
+                self._rows -= len(evicted)
+                self.stats['evictions'] += 1
+
+        return
+
+    def size(self):
+        """
+        Number of the cached locations and days.
+
+        :return: Dictionary {'entries': int, 'rows': int}
+        """
+
+        with self._lock:
+            return {'entries': len(self._entries), 'rows': self._rows}
+
+    def clear(self):
+        """
+        Remove all cached data.
+
+        :return:
+        """
+
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+        return
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_meteo_cache():
+    """
+    Get the meteo cache shared by the process.
+
+    :return: MeteoCache
+    """
+
+    with _cache_lock:
+        if 'cache' not in _cache:
+            _cache['cache'] = MeteoCache()
+        return _cache['cache']
+
+
+def set_meteo_cache_config(max_rows=None, max_entries=None, max_age=None, archive_delay=None):
+    """
+    Set the limits of the meteo cache shared by the process. The entries above the new limits are evicted at the
+    next write.
+
+    :param max_rows: Maximum number of cached days of all locations
+    :param max_entries: Maximum number of cached locations (and variable sets)
+    :param max_age: Maximum age of the cached days in seconds
+    :param archive_delay: Number of days before today whose archive data are not complete
+    :return:
+    """
+
+    cache = get_meteo_cache()
+
+    with cache._lock:
+        if max_rows is not None:
+            cache.max_rows = int(max_rows)
+        if max_entries is not None:
+            cache.max_entries = int(max_entries)
+        if max_age is not None:
+            cache.max_age = float(max_age)
+        if archive_delay is not None:
+            cache.archive_delay = int(archive_delay)
+
+    return
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import base64
+import threading
+
+import openeo
+
+
+# Session configuration shared by all OpenEO connections of the process
+_SESSION_CONFIG = {
+    "url": "openeo.dataspace.copernicus.eu",
+    "refresh_margin": 60,          # Refresh the access token this number of seconds before it expires
+    "token_lifetime": 600,         # Lifetime of the access token when it cannot be read from the token
+    "metadata_ttl": 86400,         # Lifetime of the cached collection metadata in seconds
+}
+
+_session = {}
+_metadata = {}
+_lock = threading.RLock()
+_pid = os.getpid()
+
+
+def set_session_config(url=None, refresh_margin=None, token_lifetime=None, metadata_ttl=None):
+    """
+    Set the parameters of the shared OpenEO session. The existing connection is not changed; call close_session()
+    first to connect with the new URL.
+
+    :param url: URL of the OpenEO backend
+    :param refresh_margin: Number of seconds before the expiration when the access token is refreshed
+    :param token_lifetime: Lifetime of the access token in seconds (used when the expiration is not in the token)
+    :param metadata_ttl: Lifetime of the cached collection metadata in seconds
+    :return:
+    """
+
+    with _lock:
+        if url is not None:
+            _SESSION_CONFIG["url"] = url
+        if refresh_margin is not None:
+            _SESSION_CONFIG["refresh_margin"] = float(refresh_margin)
+        if token_lifetime is not None:
+            _SESSION_CONFIG["token_lifetime"] = float(token_lifetime)
+        if metadata_ttl is not None:
+            _SESSION_CONFIG["metadata_ttl"] = float(metadata_ttl)
+
+    return
+
+
+def _reset_after_fork():
+    """
+    Forget the connection inherited from the parent process. The child process connects again (the refresh token is
+    read from the token store, so no interactive login is needed).
+
+    :return:
+    """
+
+    global _pid
+
+    if os.getpid() != _pid:
+        _session.clear()
+        _metadata.clear()
+        _pid = os.getpid()
+
+    return
+
+
+def _token_expiration(connection):
+    """
+    Get the expiration time of the access token of the connection. The time is read from the JWT access token,
+    otherwise the token_lifetime from now is returned.
+
+    :param connection: OpenEO connection
+    :return: Expiration time (seconds since epoch)
+    """
+
+    try:
+        token = connection.auth.bearer.split("/")[-1]
+        payload = token.split(".")[1]
+        payload = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(payload["exp"])
+
+    except Exception:
+        return time.time() + _SESSION_CONFIG["token_lifetime"]
+
+
+def get_connection():
+    """
+    Get the authenticated OpenEO connection shared by the process. The connection is authenticated at the first
+    request; the access token is refreshed only when it is about to expire. The connection is shared safely by the
+    threads of the process, the worker processes create their own connection.
+
+    :return: OpenEO connection
+    """
+
+    with _lock:
+        _reset_after_fork()
+
+        connection = _session.get("connection")
+
+        if connection is None:
+            connection = openeo.connect(url=_SESSION_CONFIG["url"])
+            connection.authenticate_oidc()
+
+            _session["connection"] = connection
+            _session["expires_at"] = _token_expiration(connection)
+            _session["authentications"] = 1
+
+        elif time.time() > _session["expires_at"] - _SESSION_CONFIG["refresh_margin"]:
+            # Refresh the access token with the refresh token, authenticate again if it is not possible
+            if not connection.try_access_token_refresh(reason="access token is about to expire"):
+                connection.authenticate_oidc()
+
+            _session["expires_at"] = _token_expiration(connection)
+            _session["authentications"] += 1
+
+    return connection
+
+
+def set_connection(connection, expires_at=None):
+    """
+    Use the given (already authenticated) connection as the shared connection of the process, e.g. the connection to
+    other backend or the fake backend for testing and benchmarking.
+
+    :param connection: OpenEO connection
+    :param expires_at: Expiration time of the access token (seconds since epoch). Default None - read from the token
+    :return:
+    """
+
+    with _lock:
+        _reset_after_fork()
+        _session.clear()
+        _metadata.clear()
+
+        _session["connection"] = connection
+        _session["expires_at"] = expires_at if expires_at is not None else _token_expiration(connection)
+        _session["authentications"] = 0
+
+    return
+
+
+def describe_collection(collection_id):
+    """
+    Get the metadata of the collection (e.g. band names). The metadata are cached for metadata_ttl seconds.
+
+    :param collection_id: Collection id (e.g. "SENTINEL2_L2A")
+    :return: Dictionary with the collection metadata
+    """
+
+    with _lock:
+        _reset_after_fork()
+        cached = _metadata.get(collection_id)
+
+    if cached is not None and time.time() - cached[0] < _SESSION_CONFIG["metadata_ttl"]:
+        return cached[1]
+
+    info = get_connection().describe_collection(collection_id)
+
+    with _lock:
+        _metadata[collection_id] = (time.time(), info)
+
+    return info
+
+
+def get_session_stats():
+    """
+    Get the number of authentications (including token refreshes) and the expiration of the access token.
+
+    :return: Dictionary {'authentications': int, 'expires_at': float}
+    """
+
+    with _lock:
+        return {"authentications": _session.get("authentications", 0), "expires_at": _session.get("expires_at")}
+
+
+def close_session():
+    """
+    Forget the shared connection and the cached collection metadata.
+
+    :return:
+    """
+
+    with _lock:
+        _session.clear()
+        _metadata.clear()
+
+    return
@@ -1,6 +1,8 @@
 import os.path
 
-from sqlalchemy import create_engine, exc, text
+from sqlalchemy import exc, text
+from db_pool import get_engine
+from calculate_features import clear_model_cache
 import datetime
 from warnings import warn
 import dill
@@ -26,7 +28,7 @@ def add_model_to_table(table_name, db_name, user, feature, osm_id, orig_date, au
     """
 
     # Connect to PostGIS
-    engine = create_engine('postgresql://{user}@/{db_name}'.format(user=user, db_name=db_name))
+    engine = get_engine(user, db_name)
 
     # Check if table exists
     query = text("SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema = 'public' AND table_name = '{tab_name}')".format(tab_name=table_name))
@@ -78,7 +80,9 @@ def add_model_to_table(table_name, db_name, user, feature, osm_id, orig_date, au
         connection.commit()
 
     connection.close()
-    engine.dispose()
+
+    # The models table was changed, the cached models need to be loaded again
+    clear_model_cache()
 
     return
 
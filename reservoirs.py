@@ -0,0 +1,191 @@
+import os
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from sqlalchemy import inspect, text
+
+from AIHABs_wrappers import measure_execution_time
+from db_pool import get_engine
+from db_copy import upsert_to_db
+
+
+# Precomputed columns of the water reservoirs table (see reservoir_attributes)
+RESERVOIR_COLUMNS = ['geom_simplified', 'centroid', 'lat', 'lon', 'utm_epsg', 'area_ha', 'geom_buffer', 'lake_buffer']
+
+# Types of the precomputed columns added to the existing table
+_COLUMN_TYPES = {'geom_simplified': 'geometry(Geometry, 4326)', 'centroid': 'geometry(Point, 4326)',
+                 'lat': 'double precision', 'lon': 'double precision', 'utm_epsg': 'bigint',
+                 'area_ha': 'double precision', 'geom_buffer': 'geometry(Geometry, 4326)',
+                 'lake_buffer': 'double precision'}
+
+_columns_cache = {}
+
+
+def utm_epsg(lon, lat):
+    """
+    EPSG code of the WGS 84 / UTM zone for the coordinates.
+
+    :param lon: Longitude (array)
+    :param lat: Latitude (array)
+    :return: EPSG codes (array)
+    """
+
+    zone = (np.floor((np.asarray(lon) + 180) / 6).astype(int) % 60) + 1
+
+    return np.where(np.asarray(lat) >= 0, 32600 + zone, 32700 + zone)
+
+
+def reservoir_attributes(gdf, lake_buffer=-20, simplify_tolerance=0.0001):
+    """
+    Compute the geometry attributes of the water reservoirs used by the other modules: simplified geometry, centroid
+    (lat, lon), EPSG code of the UTM zone, area (ha) and the inner buffer of the simplified geometry (with its distance
+    lake_buffer). The attributes are computed in the same way as in generate_points_in_polygon and getLatLon. The geometries are reprojected to
+    UTM by the groups of the reservoirs in the same zone.
+
+    :param gdf: GeoDataFrame with the reservoir polygons
+    :param lake_buffer: The buffer distance inside the water reservoir in meters. Default -20
+    :param simplify_tolerance: Tolerance of the simplification in degrees. Default 0.0001
+    :return: GeoDataFrame (EPSG:4326) with the added columns
+    """
+
+    gdf = gdf.to_crs('epsg:4326') if gdf.crs is not None else gdf.set_crs('epsg:4326')
+    gdf = gdf.reset_index(drop=True)
+
+    geoms = gdf.geometry.values
+    simplified = shapely.simplify(np.asarray(geoms), simplify_tolerance, preserve_topology=True)
+    centroids = shapely.centroid(np.asarray(geoms))
+
+    gdf['geom_simplified'] = gpd.GeoSeries(simplified, crs='epsg:4326')
+    gdf['centroid'] = gpd.GeoSeries(centroids, crs='epsg:4326')
+    gdf['lat'] = shapely.get_y(centroids)
+    gdf['lon'] = shapely.get_x(centroids)
+    gdf['utm_epsg'] = utm_epsg(gdf['lon'], gdf['lat'])
+
+    area = np.full(len(gdf), np.nan)
+    buffers = np.empty(len(gdf), dtype=object)
+
+    for epsg, idx in gdf.groupby('utm_epsg').indices.items():
+        geoms_utm = gpd.GeoSeries(simplified[idx], crs='epsg:4326').to_crs(epsg=int(epsg))
+        area[idx] = geoms_utm.area.values / 10000
+        buffers[idx] = geoms_utm.buffer(lake_buffer).to_crs('epsg:4326').values
+
+    gdf['area_ha'] = area
+    gdf['geom_buffer'] = gpd.GeoSeries(buffers, crs='epsg:4326')
+    gdf['lake_buffer'] = float(lake_buffer)
+
+    return gdf
+
+
+@measure_execution_time
+def load_reservoirs(path, db_name, user, db_table='water_reservoirs', layer=None, lake_buffer=-20,
+                    simplify_tolerance=0.0001):
+    """
+    Bulk load of the water reservoirs from GeoPackage (or other file readable by GeoPandas) or GeoParquet file to the
+    database table. The precomputed geometry attributes (see reservoir_attributes) are stored with the polygons. The
+    reservoirs are upserted by osm_id (unique btree index) and GiST indexes are created on the geometry columns.
+
+    The parts of the multi-part reservoirs (several rows with the same osm_id in the file) are dissolved to one row.
+    The precomputed columns are added to the existing table. The existing table can have several rows of the same
+    osm_id only for the loaded reservoirs (they are replaced by the dissolved row), otherwise ValueError is raised.
+
+    :param path: Path to the file with the reservoir polygons (osm_id column is required)
+    :param db_name: Database name
+    :param user: Database user
+    :param db_table: Database table with water reservoirs. Default 'water_reservoirs'
+    :param layer: Layer of the GeoPackage. Default None - the first layer
+    :param lake_buffer: The buffer distance inside the water reservoir in meters. Default -20
+    :param simplify_tolerance: Tolerance of the simplification in degrees. Default 0.0001
+    :return: Number of the loaded reservoirs
+    """
+
+    if os.path.splitext(path)[1].lower() in ('.parquet', '.geoparquet'):
+        gdf = gpd.read_parquet(path)
+    else:
+        gdf = gpd.read_file(path, layer=layer)
+
+    if 'osm_id' not in gdf.columns:
+        raise ValueError("The column osm_id is missing in {path}".format(path=path))
+
+    gdf['osm_id'] = gdf['osm_id'].astype(str)
+    gdf = gdf.rename_geometry('geometry') if gdf.geometry.name != 'geometry' else gdf
+
+    # Parts of the multi-part reservoirs
+    if gdf['osm_id'].duplicated().any():
+        gdf = gdf.dissolve(by='osm_id', as_index=False)
+
+    gdf = reservoir_attributes(gdf, lake_buffer=lake_buffer, simplify_tolerance=simplify_tolerance)
+
+    engine = get_engine(user, db_name)
+
+    if inspect(engine).has_table(db_table):
+        _prepare_table(engine, db_table, gdf['osm_id'])
+
+    n_rows = upsert_to_db(gdf, db_table, engine, key=('osm_id',))
+
+    # Spatial indexes (the unique index on osm_id is created by the upsert)
+    with engine.begin() as connection:
+        for col in ['geometry', 'geom_buffer']:
+            connection.execute(text("CREATE INDEX IF NOT EXISTS {db_table}_{col}_idx ON {db_table} USING GIST ({col})".format(
+                db_table=db_table, col=col)))
+        connection.execute(text("ANALYZE {db_table}".format(db_table=db_table)))
+
+    _columns_cache.pop((str(engine.url), db_table), None)
+
+    print("{n} water reservoirs were loaded to the table {db_table}".format(n=n_rows, db_table=db_table))
+
+    return n_rows
+
+
+def _prepare_table(engine, db_table, osm_ids):
+    """
+    Prepare the existing water reservoirs table for load_reservoirs: add the precomputed columns and check that the
+    table has several rows of the same osm_id only for the loaded reservoirs (the unique key of the upsert keeps one
+    row of each osm_id).
+
+    :param engine: SQLAlchemy engine
+    :param db_table: Database table with water reservoirs
+    :param osm_ids: OSM ids of the loaded reservoirs
+    :return:
+    """
+
+    query_duplicates = text("SELECT osm_id::text FROM {db_table} GROUP BY osm_id HAVING count(*) > 1".format(
+        db_table=db_table))
+
+    with engine.begin() as connection:
+        duplicates = set(connection.execute(query_duplicates).scalars().all()) - set(osm_ids)
+
+        if duplicates:
+            raise ValueError("The table {db_table} has several rows for {n} reservoirs which are not loaded (e.g. "
+                             "osm_id {examples}). Dissolve the parts of these reservoirs to one row first.".format(
+                db_table=db_table, n=len(duplicates), examples=', '.join(sorted(duplicates)[:5])))
+
+        for col in RESERVOIR_COLUMNS:
+            connection.execute(text("ALTER TABLE {db_table} ADD COLUMN IF NOT EXISTS {col} {col_type}".format(
+                db_table=db_table, col=col, col_type=_COLUMN_TYPES[col])))
+
+    return
+
+
+def has_precomputed_columns(engine, db_table):
+    """
+    Check if the water reservoirs table has the precomputed columns (the table was filled by load_reservoirs). The
+    result is cached for the process.
+
+    :param engine: SQLAlchemy engine
+    :param db_table: Database table with water reservoirs
+    :return: bool
+    """
+
+    key = (str(engine.url), db_table)
+
+    if key not in _columns_cache:
+        query = text("SELECT column_name FROM information_schema.columns WHERE table_schema = 'public' AND "
+                     "table_name = :db_table")
+        with engine.connect() as connection:
+            columns = set(connection.execute(query, {'db_table': db_table}).scalars().all())
+        _columns_cache[key] = set(RESERVOIR_COLUMNS) <= columns
+
+    return _columns_cache[key]
@@ -1,5 +1,5 @@
 from unittest import TestCase
-from calculate_features import calculate_feature, get_wq_db_last_date, select_model
+from calculate_features import calculate_feature, get_wq_db_last_date, select_model, clear_model_cache
 
 class Test(TestCase):
     feature = 'ChlA'
@@ -20,6 +20,15 @@ class Test(TestCase):
                                     self.model_name, self.default)
         print(model_id)
 
+    def test_select_model_cache(self):
+        clear_model_cache()
+        model1, model_id1 = select_model(self.db_name, self.user, self.db_models, self.feature, self.osm_id,
+                                         self.model_name, self.default)
+        model2, model_id2 = select_model(self.db_name, self.user, self.db_models, self.feature, self.osm_id,
+                                         self.model_name, self.default)
+        self.assertEqual(model_id1, model_id2)
+        self.assertIs(model1, model2)
+
     def test_calculate_feature(self):
         calculate_feature(self.feature, self.osm_id, self.db_name, self.user, self.db_bands_table,
                           self.db_features_table, self.db_models, self.model_name, self.default)
@@ -1,5 +1,10 @@
 from unittest import TestCase
-from data_imputation import create_dataset, data_imputation
+import warnings
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+from data_imputation import create_dataset, data_imputation, train_and_predict_svr, data_smoothing, impute_full, \
+    impute_incremental, split_dataset, incremental_start_date
 from matplotlib import pyplot as plt
 
 
@@ -22,6 +27,17 @@ class Test(TestCase):
         print(gdf)
         print(dataset)
 
+    def test_create_dataset_aggregate_in_db(self):
+        dataset, gdf = create_dataset(self.db_name, self.user, self.osm_id, self.feature, self.model_id,
+                                      self.db_wq_results, self.db_table_history, freq='W')
+        dataset_db, gdf_db = create_dataset(self.db_name, self.user, self.osm_id, self.feature, self.model_id,
+                                            self.db_wq_results, self.db_table_history, freq='W', aggregate_in_db=True)
+
+        self.assertEqual(list(dataset.columns), list(dataset_db.columns))
+        self.assertTrue(dataset.index.equals(dataset_db.index))
+        np.testing.assert_allclose(dataset.values, dataset_db.values, atol=1e-10)
+        self.assertEqual(len(gdf), len(gdf_db))
+
 
     def test_data_imputation(self):
         df_imputed, df_smooth = data_imputation(self.db_name, self.user, self.osm_id, self.feature, self.model_id, self.db_wq_results, self.db_table_history, freq='W', t_shift=1)
@@ -41,4 +57,120 @@ class Test(TestCase):
             except:
                 pass
 
-        plt.show()
\ No newline at end of file
+        plt.show()
+
+    def test_train_and_predict_svr_parallel(self):
+        rng = np.random.default_rng(0)
+        X = rng.random((300, 3))
+        y = rng.random((300, 50))
+        y[rng.random(y.shape) < 0.3] = np.nan
+
+        predictions_serial = train_and_predict_svr(X, y, n_jobs=1)
+        predictions_parallel = train_and_predict_svr(X, y, n_jobs=4)
+
+        np.testing.assert_array_equal(predictions_serial, predictions_parallel)
+
+    def test_train_and_predict_svr_precomputed_kernel(self):
+        rng = np.random.default_rng(0)
+        X = rng.random((300, 3))
+        y = rng.random((300, 50))
+        mask = rng.random(300) < 0.3
+        y[mask, :40] = np.nan                           # columns with the same mask
+        y[rng.random(y.shape) < 0.05] = np.nan
+
+        predictions_rbf = train_and_predict_svr(X, y, precomputed_kernel=False)
+        predictions_kernel = train_and_predict_svr(X, y, precomputed_kernel=True)
+
+        np.testing.assert_allclose(predictions_rbf, predictions_kernel, atol=1e-6)
+
+    def test_data_smoothing(self):
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame(rng.random((200, 20)), index=pd.date_range('2020-01-05', periods=200, freq='W'))
+        df.iloc[10, 5] = np.nan
+
+        df_smooth = data_smoothing(df)
+
+        x = np.asarray(df.index, dtype=float)
+        for i in df.columns:
+            lowess = sm.nonparametric.lowess(df[i], x, frac=0.02, return_sorted=False)
+            np.testing.assert_allclose(df_smooth[i].values, lowess, atol=1e-10)
+
+    def test_data_smoothing_zero_weights(self):
+        # Piecewise constant series: all residual weights of some neighbourhoods are zero
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame(np.repeat(rng.integers(0, 3, (52, 5)), 10, axis=0).astype(float),
+                          index=pd.date_range('2015-06-07', periods=520, freq='W'))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            df_smooth = data_smoothing(df)
+
+        self.assertFalse(df_smooth.isna().any().any())
+
+    def test_update_smoothing(self):
+        # Weekly series (seasonal signal with noise) without missing values, so the imputation keeps the values and
+        # only the smoothing differs between the incremental and the full run
+        rng = np.random.default_rng(1)
+        t = np.arange(410)
+        values = 50 + 10 * np.sin(2 * np.pi * t / 52)[:, None] + rng.gamma(2, 2, (410, 20)) * 2
+        y = pd.DataFrame(values, index=pd.date_range('2015-06-07', periods=410, freq='W'), columns=np.arange(20))
+        X = rng.random((410, 3))
+
+        _, _, state = impute_full(X[:400], y.iloc[:400])
+
+        # New periods within the LOWESS span (8 periods): the trailing window is smoothed with the stored medians
+        df_filled, df_update, smooth_medians = impute_incremental(state, X[:405], y.iloc[:405],
+                                                                  drift_threshold=np.inf)
+        df_smooth = data_smoothing(df_filled)
+
+        self.assertIsNone(smooth_medians)
+        self.assertTrue(df_update.index.equals(df_smooth.index))
+
+        # The periods before the window keep the previous smoothing and the residual weights use the medians of the
+        # previous smoothing, so the values differ from the smoothing of the whole series. The difference is a few
+        # percent of the standard deviation of the series (measured 2-6 % for 1-8 new periods and several random
+        # series); 8 % is allowed.
+        np.testing.assert_array_less(np.abs(df_update - df_smooth).max(), 0.08 * y.iloc[:405].std())
+
+        # More new periods than the LOWESS span: the whole series is smoothed and the medians are refreshed
+        df_filled, df_update, smooth_medians = impute_incremental(state, X, y, drift_threshold=np.inf)
+        df_smooth, medians = data_smoothing(df_filled, return_medians=True)
+
+        np.testing.assert_allclose(df_update.values, df_smooth.values, atol=1e-10)
+        np.testing.assert_allclose(smooth_medians, medians, atol=1e-10)
+
+    def test_incremental_start_date(self):
+        # Weekly data: the read starts with the week before the last processed week (t_shift=1)
+        start_date = incremental_start_date(pd.Timestamp('2024-03-17'), freq='W', t_shift=1)
+        self.assertEqual(start_date, pd.Timestamp('2024-03-04'))
+
+        start_date = incremental_start_date(pd.Timestamp('2024-03-31'), freq='ME', t_shift=1)
+        self.assertEqual(start_date, pd.Timestamp('2024-02-01'))
+
+        # Daily data: t_shift days before the last processed day
+        start_date = incremental_start_date(pd.Timestamp('2024-03-17'), freq='D', t_shift=7)
+        self.assertEqual(start_date, pd.Timestamp('2024-03-10'))
+
+    def test_impute_incremental_partial_dataset(self):
+        # The incremental imputation of the data read from incremental_start_date is the same as of the whole history
+        rng = np.random.default_rng(2)
+        index = pd.date_range('2015-06-07', periods=410, freq='W')
+        meteo_columns = ['weather_code', 'temperature_2m_max', 'temperature_2m_min', 'daylight_duration',
+                         'sunshine_duration', 'precipitation_sum', 'wind_speed_10m_max', 'wind_direction_10m_dominant',
+                         'shortwave_radiation_sum']
+        df_full = pd.DataFrame(rng.gamma(2, 2, (410, 20)), index=index, columns=np.arange(20))
+        df_full = df_full.where(rng.random((410, 20)) > 0.3)
+        df_full = df_full.join(pd.DataFrame(rng.random((410, len(meteo_columns))), index=index, columns=meteo_columns))
+
+        X, y = split_dataset(df_full.iloc[:400])
+        _, _, state = impute_full(X, y)
+
+        X, y = split_dataset(df_full.iloc[:405])
+        df_filled, df_smooth, _ = impute_incremental(state, X, y, drift_threshold=np.inf)
+
+        start_date = incremental_start_date(state['last_period'], freq='W', t_shift=1)
+        X, y = split_dataset(df_full.iloc[:405].loc[start_date:])
+        df_filled_partial, df_smooth_partial, _ = impute_incremental(state, X, y, drift_threshold=np.inf)
+
+        pd.testing.assert_frame_equal(df_filled, df_filled_partial)
+        pd.testing.assert_frame_equal(df_smooth, df_smooth_partial)
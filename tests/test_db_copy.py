@@ -0,0 +1,74 @@
+from unittest import TestCase
+import pandas as pd
+from sqlalchemy import text
+from db_pool import get_engine
+from db_copy import copy_to_db, upsert_to_db, ensure_unique_key
+from benchmarks.bench_copy_to_db import synthetic_s2_points
+
+
+class Test(TestCase):
+    db_name = 'postgres'
+    user = 'postgres'
+    db_table = 'test_copy_to_db'
+
+    def test_copy_to_db(self):
+        engine = get_engine(self.user, self.db_name)
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP TABLE IF EXISTS {self.db_table}"))
+
+        gdf = synthetic_s2_points(5000, n_points=100)
+        n_rows = copy_to_db(gdf, self.db_table, engine)
+        self.assertEqual(n_rows, 5000)
+
+        df = pd.read_sql(text(f'SELECT COUNT(*) AS n, COUNT(DISTINCT "PID") AS n_pid FROM {self.db_table}'), engine)
+        self.assertEqual(df['n'][0], 5000)
+        self.assertEqual(df['n_pid'][0], 100)
+
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP TABLE {self.db_table}"))
+
+    def test_upsert_to_db(self):
+        engine = get_engine(self.user, self.db_name)
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP TABLE IF EXISTS {self.db_table}"))
+
+        dates = pd.date_range('2024-01-01', periods=10).date
+        df = pd.DataFrame({'osm_id': ['1'] * 10 + ['2'] * 10, 'date': list(dates) * 2, 'value': 1.0})
+        copy_to_db(df.iloc[:2], self.db_table, engine)      # duplicate rows of the delete-and-append updates
+
+        upsert_to_db(df, self.db_table, engine)
+        upsert_to_db(df.assign(value=2.0).iloc[5:10], self.db_table, engine, replace_by='osm_id')
+
+        df_db = pd.read_sql(text(f"SELECT osm_id, COUNT(*) AS n, SUM(value) AS s FROM {self.db_table} "
+                                 f"GROUP BY osm_id ORDER BY osm_id"), engine)
+        self.assertEqual(df_db['n'].tolist(), [5, 10])
+        self.assertEqual(df_db['s'].tolist(), [10.0, 10.0])
+
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP TABLE {self.db_table}"))
+
+    def test_ensure_unique_key(self):
+        engine = get_engine(self.user, self.db_name)
+        db_table = 'test_copy_to_db_with_a_table_name_longer_than_the_index_limit'
+        query_indexes = text("SELECT indexname FROM pg_indexes WHERE tablename = :db_table")
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP TABLE IF EXISTS {db_table}"))
+
+        df = pd.DataFrame({'osm_id': ['1', '1'], 'date': pd.date_range('2024-01-01', periods=2).date, 'value': 1.0})
+        copy_to_db(df, db_table, engine)
+
+        # The name of the index fits into the PostgreSQL limit and the index is found again
+        index_name = ensure_unique_key(db_table, engine)
+        self.assertLessEqual(len(index_name), 63)
+        self.assertEqual(ensure_unique_key(db_table, engine), index_name)
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(query_indexes, {'db_table': db_table}).scalars().all(), [index_name])
+
+        # The existing unique index on the key columns is used whatever its name is
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP INDEX {index_name}"))
+            connection.execute(text(f"CREATE UNIQUE INDEX test_custom_key ON {db_table} (date, osm_id)"))
+        self.assertEqual(ensure_unique_key(db_table, engine), 'test_custom_key')
+
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP TABLE {db_table}"))
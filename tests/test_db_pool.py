@@ -0,0 +1,44 @@
+from unittest import TestCase
+from sqlalchemy import text
+from db_pool import get_engine, get_pool_stats, reset_pool_stats, dispose_engines, set_pool_config
+
+
+class Test(TestCase):
+    db_name = 'postgres'
+    user = 'postgres'
+
+    def test_get_engine(self):
+        engine1 = get_engine(self.user, self.db_name)
+        engine2 = get_engine(self.user, self.db_name)
+        self.assertIs(engine1, engine2)
+
+    def test_get_pool_stats(self):
+        reset_pool_stats()
+        engine = get_engine(self.user, self.db_name)
+        for i in range(5):
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+
+        stats = get_pool_stats()[(self.user, self.db_name)]
+        print(stats)
+        self.assertEqual(stats['checkouts'], 5)
+        self.assertEqual(stats['opened'] + stats['reused'], 5)
+
+    def test_dispose_engines(self):
+        engine = get_engine(self.user, self.db_name)
+        dispose_engines()
+        self.assertIsNot(engine, get_engine(self.user, self.db_name))
+
+    def test_set_pool_config(self):
+        set_pool_config(pool_size=5)
+        engine = get_engine(self.user, self.db_name)
+
+        set_pool_config(pool_size=5)
+        self.assertIs(engine, get_engine(self.user, self.db_name))
+
+        set_pool_config(pool_size=8)
+        engine_resized = get_engine(self.user, self.db_name)
+        self.assertIsNot(engine, engine_resized)
+        self.assertEqual(engine_resized.pool.size(), 8)
+
+        set_pool_config(pool_size=5)
@@ -0,0 +1,223 @@
+from unittest import TestCase
+from unittest.mock import patch
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from datetime import date
+from sqlalchemy import text
+from db_pool import get_engine
+from fake_backends import FakeOpenEOConnection, FakeOpenMeteoClient, FakeEarthEngine, FakeBatchJob
+from oeo_session import set_connection, close_session
+from get_S2_points_OpenEO import get_s2_bands_OEO, create_s2_job_OEO, read_s2_job_results, parse_s2_results, \
+    check_job_error, OEOJobManager, subtract_time_windows, read_job_ledger, write_job_ledger, ledger_start_date
+from get_S2_points_GEE import process_sentinel2_points_data
+from get_meteo import getHistoricalMeteoData
+
+
+class Test(TestCase):
+    osm_id = '123456'
+    db_name = 'postgres'
+    user = 'postgres'
+    db_table = 'test_fake_s2_points'
+    db_table_history = 'test_fake_meteo_history'
+    db_table_ledger = 'test_fake_job_ledger'
+    db_table_reservoirs = 'water_reservoirs'
+
+    point_layer = gpd.GeoDataFrame({'PID': np.arange(20), 'osm_id': osm_id},
+                                   geometry=gpd.points_from_xy(14.0 + np.arange(20) * 0.001, 49.0 + np.arange(20) * 0.001),
+                                   crs='epsg:4326')
+
+    def tearDown(self):
+        close_session()
+
+    def test_fake_openeo_results(self):
+        connection = FakeOpenEOConnection(job_duration=0)
+        set_connection(connection)
+
+        band_list = get_s2_bands_OEO()
+        job = create_s2_job_OEO(connection, self.osm_id, self.point_layer, '2023-04-01', '2023-04-30', band_list)
+        job.start_and_wait()
+
+        gdf = parse_s2_results(read_s2_job_results(job), self.point_layer, band_list)
+
+        self.assertEqual(job.status(), 'finished')
+        self.assertEqual(job.temporal_extent, ['2023-04-01', '2023-05-01'])     # the end date is included
+        self.assertEqual(list(gdf.columns[:4]), ['date', 'PID', 'B01', 'B02'])
+        self.assertTrue(gdf['date'].between(date(2023, 4, 1), date(2023, 4, 30)).all())
+
+    def test_fake_openeo_no_data(self):
+        connection = FakeOpenEOConnection(job_duration=0, no_data_rate=1.0)
+
+        job = create_s2_job_OEO(connection, self.osm_id, self.point_layer, '2023-04-01', '2023-04-30', ['B01'])
+        self.assertRaises(RuntimeError, job.start_and_wait)
+
+        self.assertEqual(job.status(), 'error')
+        self.assertFalse(check_job_error(job.job_id, connection=connection))
+
+    def test_fake_openeo_job_manager(self):
+        connection = FakeOpenEOConnection(job_duration=(0.2, 0.5), failure_rate=0.2, no_data_rate=0.1)
+        set_connection(connection)
+
+        # The results are written to the memory
+        written = []
+
+        def copy_to_db(gdf, db_table, engine):
+            written.append(gdf)
+            return len(gdf)
+
+        slots = [(f"2023-{month:02d}-01", f"2023-{month:02d}-28") for month in range(1, 13)]
+        manager = OEOJobManager(self.osm_id, self.point_layer, self.db_name, self.user, self.db_table, max_jobs=4,
+                                poll_interval=0.05, ledger_table=None, retry_delay=0.01)
+        with patch('get_S2_points_OpenEO.copy_to_db', copy_to_db):
+            results = manager.run(slots)
+
+        self.assertEqual(connection.max_running, 4)
+
+        # All the slots (or their halves) were ingested or have no data
+        processed = [result for result in results if result['status'] in ('ingested', 'no_data')]
+        self.assertEqual(subtract_time_windows(slots, [(r['start_date'], r['end_date']) for r in processed]), [])
+        self.assertNotIn('failed', [result['status'] for result in results])
+        self.assertIn('ingested', [result['status'] for result in results])
+
+        # The written rows are the results of the ingested jobs
+        band_list = get_s2_bands_OEO()
+        expected = [parse_s2_results(connection.job(result['job_id']).results_frame(), self.point_layer, band_list)
+                    for result in results if result['status'] == 'ingested']
+
+        self.assertEqual([result['rows'] for result in results if result['status'] == 'ingested'],
+                         [len(gdf) for gdf in expected])
+        columns = ['date', 'PID', 'B01', 'B12']
+        pd.testing.assert_frame_equal(
+            pd.concat(written)[columns].sort_values(['date', 'PID']).reset_index(drop=True),
+            pd.concat(expected)[columns].sort_values(['date', 'PID']).reset_index(drop=True))
+
+    def test_fake_openeo_job_manager_backoff(self):
+        connection = FakeOpenEOConnection(job_duration=0, failure_rate=1.0)
+        set_connection(connection)
+
+        manager = OEOJobManager(self.osm_id, self.point_layer, self.db_name, self.user, self.db_table,
+                                poll_interval=0.01, ledger_table=None, retry_delay=0.05)
+        t0 = time.time()
+        results = manager.run([('2023-04-01', '2023-04-02')])
+
+        # 3 attempts of the window (backoff 0.05 s and 0.1 s), then 2 attempts of each one day half (0.2 s before the
+        # halves and 0.05 s between their attempts)
+        self.assertEqual([result['status'] for result in results], ['split', 'failed', 'failed'])
+        self.assertEqual(connection.calls['create_job'], 7)
+        self.assertGreaterEqual(time.time() - t0, 0.4)
+
+    def test_fake_openeo_job_manager_ingest_retry(self):
+        connection = FakeOpenEOConnection(job_duration=0)
+        set_connection(connection)
+
+        # The first write fails, the second one is stored in memory
+        written = []
+
+        def copy_to_db(gdf, db_table, engine):
+            written.append(gdf)
+            if len(written) == 1:
+                raise ConnectionError("Fake database: connection lost")
+            return len(gdf)
+
+        manager = OEOJobManager(self.osm_id, self.point_layer, self.db_name, self.user, self.db_table,
+                                poll_interval=0.01, ledger_table=None, retry_delay=0.01)
+        with patch('get_S2_points_OpenEO.copy_to_db', copy_to_db):
+            results = manager.run([('2023-04-01', '2023-04-30')])
+
+        # The results of the same job are written at the second attempt, the job is not submitted again
+        self.assertEqual([result['status'] for result in results], ['ingested'])
+        self.assertEqual(connection.calls['create_job'], 1)
+        self.assertEqual(connection.calls['download'], 2)
+        self.assertEqual(results[0]['rows'], len(written[1]))
+
+    def test_fake_openeo_job_manager_status_errors(self):
+        connection = FakeOpenEOConnection(job_duration=0.05)
+        set_connection(connection)
+
+        # The status of the first job is never available
+        fake_status = FakeBatchJob.status
+
+        def status(job):
+            if job.job_id == 'j-fake000001':
+                raise ConnectionError("Fake backend: status not available")
+            return fake_status(job)
+
+        manager = OEOJobManager(self.osm_id, self.point_layer, self.db_name, self.user, self.db_table,
+                                poll_interval=0.01, ledger_table=None, retry_delay=0.01)
+        with patch('get_S2_points_OpenEO.copy_to_db', lambda gdf, db_table, engine: len(gdf)), \
+                patch.object(FakeBatchJob, 'status', status):
+            results = manager.run([('2023-04-01', '2023-04-30')])
+
+        # The slot is submitted again after max_attempts polls without the status
+        self.assertEqual([result['status'] for result in results], ['ingested'])
+        self.assertEqual(results[0]['job_id'], 'j-fake000002')
+        self.assertEqual(connection.calls['create_job'], 2)
+
+    def test_fake_openeo_job_manager_resume(self):
+        connection = FakeOpenEOConnection(job_duration=0)
+        set_connection(connection)
+
+        engine = get_engine(self.user, self.db_name)
+        read_job_ledger(engine, self.db_table_ledger, self.osm_id)
+        with engine.begin() as conn:
+            conn.execute(text(f"DELETE FROM {self.db_table_ledger} WHERE osm_id = :osm_id"), {'osm_id': self.osm_id})
+
+        manager = OEOJobManager(self.osm_id, self.point_layer, self.db_name, self.user, self.db_table,
+                                poll_interval=0.01, ledger_table=self.db_table_ledger, retry_delay=0.01)
+
+        # The run is interrupted at the first submission: all the windows are recorded as queued
+        slots = [('2023-01-01', '2023-01-31'), ('2023-02-01', '2023-02-28')]
+        with patch('get_S2_points_OpenEO.create_s2_job_OEO', side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, manager.run, slots)
+
+        ledger = read_job_ledger(engine, self.db_table_ledger, self.osm_id)
+        self.assertEqual(ledger[['start_date', 'end_date']].values.tolist(), [list(slot) for slot in slots])
+        self.assertEqual(list(ledger['status']), ['queued', 'queued'])
+
+        # The later window was ingested and only one half of the split window was processed before the crash
+        record = {'job_id': None, 'rows': 0, 'duration': None, 'error': None}
+        for start, end, status in [('2023-02-01', '2023-02-28', 'ingested'), ('2023-03-01', '2023-03-31', 'split'),
+                                   ('2023-03-01', '2023-03-15', 'ingested'), ('2023-03-16', '2023-03-31', 'queued')]:
+            write_job_ledger(engine, self.db_table_ledger, self.osm_id,
+                             dict(record, start_date=start, end_date=end, status=status))
+
+        ledger = read_job_ledger(engine, self.db_table_ledger, self.osm_id)
+        self.assertEqual(ledger_start_date(ledger), date(2023, 4, 1))
+
+        # The queued window before the ingested one and the queued half are submitted again
+        with patch('get_S2_points_OpenEO.copy_to_db', lambda gdf, db_table, engine: len(gdf)):
+            results = manager.run([('2023-04-01', '2023-04-30')])
+
+        self.assertEqual(sorted((result['start_date'], result['status']) for result in results),
+                         [('2023-01-01', 'ingested'), ('2023-03-16', 'ingested'), ('2023-04-01', 'ingested')])
+
+        ledger = read_job_ledger(engine, self.db_table_ledger, self.osm_id)
+        self.assertNotIn('queued', list(ledger['status']))
+
+    def test_fake_open_meteo(self):
+        client = FakeOpenMeteoClient()
+        params = {"latitude": [49.1, 49.2], "longitude": [14.1, 14.2], "start_date": date(2023, 1, 1),
+                  "end_date": date(2023, 1, 31), "daily": ["temperature_2m_max", "precipitation_sum"]}
+
+        responses = client.weather_api("https://archive-api.open-meteo.com/v1/archive", params=params)
+        daily = responses[0].Daily()
+
+        self.assertEqual(len(responses), 2)
+        self.assertEqual((daily.TimeEnd() - daily.Time()) // daily.Interval(), 31)
+        self.assertEqual(len(daily.Variables(1).ValuesAsNumpy()), 31)
+
+    def test_fake_open_meteo_history(self):
+        getHistoricalMeteoData(self.osm_id, ["temperature_2m_max", "precipitation_sum"], self.user, self.db_name,
+                               self.db_table_history, self.db_table_reservoirs, openmeteo=FakeOpenMeteoClient())
+
+    def test_fake_earth_engine(self):
+        point_layer = self.point_layer.copy()
+        point_layer['lat'] = point_layer.geometry.y
+        point_layer['lon'] = point_layer.geometry.x
+
+        gdf = process_sentinel2_points_data(point_layer, '2023-04-01', '2023-04-30', self.db_name, self.user,
+                                            self.db_table, ee_api=FakeEarthEngine())
+
+        self.assertEqual(len(gdf) % len(point_layer), 0)
+        self.assertIn('probability', gdf.columns)
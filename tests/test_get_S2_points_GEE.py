@@ -1,6 +1,11 @@
 from unittest import TestCase
-from get_S2_points_GEE import process_sentinel2_points_data, get_sentinel2_data
+import numpy as np
+import geopandas as gpd
+from get_S2_points_GEE import process_sentinel2_points_data, get_sentinel2_data, run_sentinel2_pipeline, \
+    fetch_sentinel2_points_data
 from get_random_points import get_sampling_points
+from db_pool import get_engine
+from fake_backends import FakeEarthEngine
 
 class Test(TestCase):
     ee_project = 'ee-bromjakub'
@@ -22,3 +27,43 @@ class Test(TestCase):
     def test_get_sentinel2_data(self):
         get_sentinel2_data(self.ee_project, self.osm_id, self.db_name, self.user, self.db_table_reservoirs, self.db_table_points,
                            self.db_table_S2_points_data)
+
+    def test_run_sentinel2_pipeline(self):
+        point_layer = get_sampling_points(self.osm_id, self.db_name, self.user, self.db_table_reservoirs, self.db_table_points)
+        point_layer['lat'] = point_layer.geometry.y
+        point_layer['lon'] = point_layer.geometry.x
+        engine = get_engine(self.user, self.db_name)
+        slots = [('2020-{m:02d}-01'.format(m=m), '2020-{m:02d}-28'.format(m=m)) for m in range(1, 13)]
+
+        df_stats = run_sentinel2_pipeline(point_layer, slots, engine, 's2_points_data_test', n_workers=4, queue_size=2,
+                                          batch_rows=1000, ee_api=FakeEarthEngine(latency=(0.05, 0.2)))
+        self.assertTrue((df_stats['status'] == 'written').all())
+        self.assertGreater(df_stats['rows'].sum(), 0)
+
+        with self.assertRaises(RuntimeError):
+            run_sentinel2_pipeline(point_layer, slots, engine, 's2_points_data_test', n_workers=4,
+                                   ee_api=FakeEarthEngine(failure_rate=0.5, seed=1))
+
+    def test_fetch_sentinel2_points_data(self):
+        point_layer = gpd.GeoDataFrame({'PID': np.arange(200), 'osm_id': str(self.osm_id)},
+                                       geometry=gpd.points_from_xy(14.0 + np.arange(200) * 1e-4,
+                                                                   49.0 + np.arange(200) * 1e-4), crs=4326)
+        point_layer['lat'] = point_layer.geometry.y
+        point_layer['lon'] = point_layer.geometry.x
+        n_rows = len(point_layer) * 12
+
+        # 3 date sub-ranges of 4 images (800 rows) and one request for the number of images
+        ee_api = FakeEarthEngine(revisit_days=5)
+        gdf = fetch_sentinel2_points_data(point_layer, '2020-01-01', '2020-03-01', page_size=1000, ee_api=ee_api)
+        self.assertEqual(len(gdf), n_rows)
+        self.assertIn('probability', gdf.columns)
+        self.assertEqual(ee_api.calls['getInfo'], 4)
+
+        # The sub-ranges which do not fit into one page are split again, the days with more points than the page are
+        # downloaded by pages
+        for page_size in (500, 150):
+            ee_api = FakeEarthEngine(revisit_days=5)
+            gdf = fetch_sentinel2_points_data(point_layer, '2020-01-01', '2020-03-01', page_size=page_size,
+                                              ee_api=ee_api)
+            self.assertEqual(len(gdf), n_rows)
+            self.assertFalse(gdf[['date', 'PID']].duplicated().any())
@@ -1,5 +1,14 @@
 from unittest import TestCase
-from get_S2_points_OpenEO import get_s2_points_OEO, process_s2_points_OEO, get_sampling_points, check_job_error
+from unittest.mock import patch
+import io
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from datetime import date
+from db_pool import get_engine
+from get_S2_points_OpenEO import get_s2_points_OEO, process_s2_points_OEO, get_sampling_points, check_job_error, \
+    OEOJobManager, read_job_ledger, subtract_time_windows, parse_s2_results, \
+    bisect_time_window, S2WindowPlanner
 
 
 class Test_S2_OpenEO(TestCase):
@@ -33,4 +42,87 @@ class Test_S2_OpenEO(TestCase):
 
     def test_check_job_error(self):
         data_available = check_job_error(self.logid)
-        print(data_available)
\ No newline at end of file
+        print(data_available)
+
+    def test_oeo_job_manager(self):
+        point_layer = get_sampling_points(self.osm_id, self.db_name, self.user, self.db_table_reservoirs, self.db_table_points)
+        slots = [('2023-04-01', '2023-04-30'), ('2023-05-01', '2023-05-31'), ('2023-06-01', '2023-06-30')]
+
+        manager = OEOJobManager(self.osm_id, point_layer, self.db_name, self.user, self.db_table, max_jobs=3)
+        results = manager.run(slots)
+        print(results)
+
+        self.assertEqual(len(results), len(slots))
+
+    def test_read_job_ledger(self):
+        ledger = read_job_ledger(get_engine(self.user, self.db_name), 's2_job_ledger', self.osm_id)
+        print(ledger)
+
+    def test_subtract_time_windows(self):
+        slots = [('2023-01-01', '2023-03-31'), ('2023-04-01', '2023-06-30')]
+        windows = [('2023-02-01', '2023-02-28'), ('2023-04-01', '2023-06-30')]
+
+        self.assertEqual(subtract_time_windows(slots, windows),
+                         [('2023-01-01', '2023-01-31'), ('2023-03-01', '2023-03-31')])
+
+    def test_parse_s2_results(self):
+        point_layer = gpd.GeoDataFrame({'PID': [0, 1, 2], 'osm_id': str(self.osm_id)},
+                                       geometry=gpd.points_from_xy([14.1, 14.2, 14.3], [49.1, 49.2, 49.3]), crs=4326)
+        band_list = ['B01', 'B02']
+        csv = (b"date,feature_index,avg(band_0),avg(band_1)\n"
+               b"2023-04-02T00:00:00.000Z,2,100.0,200.0\n"
+               b"2023-04-02T00:00:00.000Z,0,110.0,\n"
+               b"2023-04-05T00:00:00.000Z,1,120.0,220.0\n")
+
+        gdf = parse_s2_results(pd.read_csv(io.BytesIO(csv)), point_layer, band_list)
+
+        self.assertEqual(list(gdf['PID']), [2, 1])
+        self.assertEqual(list(gdf.columns[:4]), ['date', 'PID', 'B01', 'B02'])
+        np.testing.assert_allclose(gdf['lon'], gdf.geometry.x)
+        np.testing.assert_allclose(gdf['lat'], [49.3, 49.2])
+
+    def test_bisect_time_window(self):
+        self.assertEqual(bisect_time_window('2023-04-01', '2023-04-30'),
+                         [('2023-04-01', '2023-04-15'), ('2023-04-16', '2023-04-30')])
+        self.assertIsNone(bisect_time_window('2023-04-01', '2023-04-01'))
+
+    def test_s2_window_planner(self):
+        planner = S2WindowPlanner(self.osm_id, 100, get_engine(self.user, self.db_name), initial_days=60)
+        slots = planner.plan(date(2023, 1, 1), date(2024, 1, 1))
+        print(planner.model, slots)
+
+        self.assertEqual(slots[0][0], '2023-01-01')
+        self.assertEqual(slots[-1][1], '2023-12-31')
+
+    def test_s2_window_planner_update(self):
+        planner = S2WindowPlanner('test_planner', 100, get_engine(self.user, self.db_name),
+                                  model_table='test_s2_window_model', initial_days=60)
+        planner.model.update(rows_per_point_day=None, seconds_per_point_day=None, max_point_days=None, n_jobs=0)
+        window = {'start_date': '2023-01-01', 'end_date': '2023-03-01', 'job_id': None, 'rows': 0, 'duration': None}
+
+        # The errors of the submission and of the database do not limit the windows
+        planner.update([dict(window, status='failed', error='ConnectionError'),
+                        dict(window, status='ingest_failed', error='OperationalError')])
+        self.assertIsNone(planner.model['max_point_days'])
+        self.assertEqual(planner.window_days(), 60)
+
+        # The failed job limits the windows
+        planner.update([dict(window, status='split', error='error')])
+        self.assertEqual(planner.window_days(), 45)
+
+        # The processed windows raise the limit again until it is removed
+        for _ in range(30):
+            planner.update([{'start_date': '2023-01-01', 'end_date': '2023-01-10', 'job_id': None,
+                             'status': 'ingested', 'rows': 200, 'duration': 60, 'error': None}])
+        self.assertIsNone(planner.model['max_point_days'])
+        self.assertEqual(planner.window_days(), 365)
+
+    def test_get_s2_points_oeo_no_points(self):
+        point_layer = gpd.GeoDataFrame({'PID': [], 'osm_id': []}, geometry=gpd.points_from_xy([], []), crs=4326)
+
+        with patch('get_S2_points_OpenEO.get_sampling_points', return_value=point_layer), \
+                patch('get_S2_points_OpenEO.S2WindowPlanner') as planner:
+            self.assertWarns(UserWarning, get_s2_points_OEO, self.osm_id, self.db_name, self.user,
+                             self.db_table_reservoirs, self.db_table_points, self.db_table)
+
+        planner.assert_not_called()
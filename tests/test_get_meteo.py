@@ -1,5 +1,7 @@
 from unittest import TestCase
-from get_meteo import getHistoricalMeteoData, getPredictedMeteoData, getLastDateInDB, getLatLon
+from get_meteo import getHistoricalMeteoData, getPredictedMeteoData, getLastDateInDB, getLatLon, \
+    getHistoricalMeteoDataBatch, getPredictedMeteoDataBatch, getLatLonBatch, getLastDatesInDB, getMeteoCells
+from fake_backends import FakeOpenMeteoClient
 
 class Test(TestCase):
     user = 'jakub'
@@ -27,3 +29,37 @@ class Test(TestCase):
 
     def test_get_last_date_in_db(self):
         getLastDateInDB(self.osm_id, self.db_name, self.user, self.db_table)
+
+    def test_get_historical_meteo_data_batch(self):
+        osm_ids = [self.osm_id, 15444638]
+        openmeteo = FakeOpenMeteoClient()
+        getHistoricalMeteoDataBatch(osm_ids, self.meteo_features, self.user, self.db_name, self.db_table,
+                                    self.db_table_reservoirs, batch_size=1, openmeteo=openmeteo)
+        self.assertLessEqual(openmeteo.calls.get('weather_api', 0), 2)
+
+        last_dates = getLastDatesInDB(osm_ids, self.db_name, self.user, self.db_table)
+        self.assertEqual(set(last_dates), {str(osm_id) for osm_id in osm_ids})
+
+    def test_get_historical_meteo_data_cells(self):
+        osm_ids = [self.osm_id, 15444638]
+        df_cells = getMeteoCells(osm_ids, self.db_name, self.user, self.db_table_reservoirs, 'meteo_cells', 0.1)
+        self.assertEqual(set(df_cells.index), {str(osm_id) for osm_id in osm_ids})
+
+        getHistoricalMeteoDataBatch(osm_ids, self.meteo_features, self.user, self.db_name, 'meteo_history_cells',
+                                    self.db_table_reservoirs, grid_resolution=0.1, db_table_cells='meteo_cells',
+                                    openmeteo=FakeOpenMeteoClient())
+        last_dates = getLastDatesInDB(df_cells['cell_id'].unique().tolist(), self.db_name, self.user,
+                                      'meteo_history_cells', key='cell_id')
+        self.assertEqual(len(last_dates), df_cells['cell_id'].nunique())
+
+    def test_get_predicted_meteo_data_batch(self):
+        osm_ids = [self.osm_id, 15444638]
+        df = getPredictedMeteoDataBatch(osm_ids, self.meteo_features, self.user, self.db_name, self.db_table_forecast,
+                                        self.db_table_reservoirs, forecast_days=5, openmeteo=FakeOpenMeteoClient())
+        self.assertEqual(len(df), 10)
+
+    def test_get_lat_lon_batch(self):
+        df_loc = getLatLonBatch([self.osm_id], self.db_name, self.user, self.db_table_reservoirs)
+        lat, lon = getLatLon(self.osm_id, self.db_name, self.user, self.db_table_reservoirs)
+        self.assertAlmostEqual(df_loc.loc[str(self.osm_id), 'lat'], lat)
+        self.assertAlmostEqual(df_loc.loc[str(self.osm_id), 'lon'], lon)
@@ -1,5 +1,12 @@
 from unittest import TestCase
-from get_random_points import get_sampling_points
+import numpy as np
+import geopandas as gpd
+import shapely
+from scipy.spatial import Delaunay, Voronoi
+from shapely.geometry import Point, Polygon, box
+from reservoirs import reservoir_attributes
+from get_random_points import get_sampling_points, points_clip, get_vertices, delaunay_centroid_coords, \
+    voronoi_centroid_coords, point_mesh_coords, generate_points_in_polygon
 
 class Test(TestCase):
     osm_id = 1239458
@@ -9,3 +16,60 @@ class Test(TestCase):
     db_table_points = 'selected_points'
     def test_get_sampling_points(self):
         get_sampling_points(self.osm_id, self.db_name, self.user, self.db_table_reservoirs, self.db_table_points)
+
+    def test_points_clip(self):
+        rng = np.random.default_rng(0)
+        points = gpd.GeoDataFrame(geometry=[Point(xy) for xy in rng.random((5000, 2))], crs='epsg:4326')
+        points.loc[len(points)] = [Point(0.5, 0.2)]         # point on the boundary
+        polygon = Point(0.5, 0.5).buffer(0.3).difference(box(0.45, 0.45, 0.55, 0.55))
+
+        clipped = points_clip(points, polygon)
+        self.assertTrue(clipped.index.equals(points.index[points.intersects(polygon)]))
+        self.assertIn(len(points) - 1, clipped.index)
+
+    def test_centroid_coords(self):
+        polygon = Point(14.5, 49.0).buffer(0.05, quad_segs=64).difference(box(14.49, 48.99, 14.51, 49.01))
+        vertices = get_vertices(polygon)
+
+        tri = Delaunay(vertices)
+        expected = shapely.get_coordinates(shapely.centroid(shapely.polygons(vertices[tri.simplices])))
+        np.testing.assert_allclose(delaunay_centroid_coords(vertices), expected, rtol=0, atol=1e-12)
+
+        vor = Voronoi(vertices)
+        regions = [region for region in vor.regions if -1 not in region and len(region) > 0]
+        expected = np.array([Polygon(vor.vertices[region]).centroid.coords[0] for region in regions])
+        np.testing.assert_allclose(voronoi_centroid_coords(vertices), expected, rtol=0, atol=1e-9)
+
+    def test_point_mesh_coords(self):
+        polygon = Point(14.5, 49.0).buffer(0.1, quad_segs=64)
+        minx, miny, maxx, maxy = polygon.bounds
+        lon, lat = np.meshgrid(np.linspace(minx, maxx, int((maxx - minx) / 0.01)),
+                               np.linspace(miny, maxy, int((maxy - miny) / 0.01)))
+        grid = np.column_stack([lon.ravel(), lat.ravel()])
+        inside = grid[shapely.intersects_xy(polygon, grid[:, 0], grid[:, 1])]
+
+        mesh = point_mesh_coords(polygon)
+        self.assertLess(len(mesh), len(grid))
+        self.assertTrue(set(map(tuple, inside)) <= set(map(tuple, mesh)))
+
+    def test_generate_points_in_polygon(self):
+        gdf = gpd.GeoDataFrame(geometry=[Point(14.5, 49.0).buffer(0.02, quad_segs=64)], crs='epsg:4326')
+        clipped, selected, buffer = generate_points_in_polygon(gdf)
+
+        self.assertEqual(len(selected), min(100, len(clipped)))
+        self.assertTrue(selected.within(buffer.iloc[0]).all())
+        self.assertEqual(selected.crs, 'epsg:4326')
+
+    def test_generate_points_in_polygon_precomputed(self):
+        gdf = gpd.GeoDataFrame(geometry=[Point(14.5, 49.0).buffer(0.02, quad_segs=64)], crs='epsg:4326')
+        gdf = reservoir_attributes(gdf, lake_buffer=-20)
+        polygon = gpd.GeoDataFrame(gdf[['geom_buffer', 'area_ha', 'lake_buffer']],
+                                   geometry=gdf['geom_simplified'].values, crs='epsg:4326')
+
+        # The precomputed buffer is used for the same lake_buffer, otherwise it is computed again
+        buffer = generate_points_in_polygon(polygon, lake_buffer=-20)[2]
+        self.assertTrue(buffer.iloc[0].equals(gdf['geom_buffer'].iloc[0]))
+
+        buffer = generate_points_in_polygon(polygon, lake_buffer=-200)[2]
+        polygon_utm = polygon.geometry.to_crs(polygon.estimate_utm_crs())
+        self.assertTrue(buffer.iloc[0].equals_exact(polygon_utm.buffer(-200).to_crs(4326).iloc[0], 1e-9))
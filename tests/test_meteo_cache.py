@@ -0,0 +1,64 @@
+from unittest import TestCase
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+from meteo_cache import MeteoCache
+from get_meteo import fetchHistoricalMeteo
+from fake_backends import FakeOpenMeteoClient
+
+
+class Test(TestCase):
+    meteo_features = ["temperature_2m_max", "precipitation_sum"]
+
+    def test_meteo_cache(self):
+        cache = MeteoCache(max_rows=1000)
+        key = MeteoCache.key(49.1, 14.1, self.meteo_features)
+        df = pd.DataFrame({'date': pd.date_range('2024-01-01', '2024-01-31').date, 'temperature_2m_max': 1.0,
+                           'precipitation_sum': 0.0})
+        cache.put(key, df)
+
+        df_cached, missing = cache.get(key, date(2023, 12, 25), date(2024, 2, 5))
+        self.assertEqual(len(df_cached), 31)
+        self.assertEqual(missing, [(date(2023, 12, 25), date(2023, 12, 31)), (date(2024, 2, 1), date(2024, 2, 5))])
+
+        # The least recently used entries are evicted
+        for lat in range(40):
+            cache.put(MeteoCache.key(lat, 0, self.meteo_features), df)
+        self.assertLessEqual(cache.size()['rows'], 1000)
+        self.assertTrue(cache.get(key, date(2024, 1, 1), date(2024, 1, 2))[0].empty)
+
+    def test_fetch_historical_meteo(self):
+        cache = MeteoCache()
+        openmeteo = FakeOpenMeteoClient()
+        df_loc = pd.DataFrame({'lat': [49.1, 49.2], 'lon': [14.1, 14.2], 'start_date': [date(2023, 1, 1)] * 2},
+                              index=['1', '2'])
+
+        fetchHistoricalMeteo(df_loc, date(2023, 12, 31), self.meteo_features, openmeteo=openmeteo, meteo_cache=cache)
+        results = fetchHistoricalMeteo(df_loc, date(2024, 1, 31), self.meteo_features, openmeteo=openmeteo,
+                                       meteo_cache=cache)
+        fresh = fetchHistoricalMeteo(df_loc, date(2024, 1, 31), self.meteo_features, openmeteo=FakeOpenMeteoClient(),
+                                     meteo_cache=MeteoCache())
+
+        # Only the missing January 2024 is requested (both locations at once)
+        self.assertEqual(openmeteo.calls['weather_api'], 2)
+        self.assertEqual(len(results['1']), 396)
+        np.testing.assert_allclose(results['1'][self.meteo_features], fresh['1'][self.meteo_features])
+
+    def test_fetch_historical_meteo_trailing_day(self):
+        cache = MeteoCache(archive_delay=5)
+        openmeteo = FakeOpenMeteoClient()
+        end_date = date.today() - timedelta(days=1)
+        df_loc = pd.DataFrame({'lat': [49.1], 'lon': [14.1], 'start_date': [end_date - timedelta(days=30)]},
+                              index=['1'])
+
+        fetchHistoricalMeteo(df_loc, end_date, self.meteo_features, openmeteo=openmeteo, meteo_cache=cache)
+        self.assertEqual(cache.size()['rows'], 26)
+
+        # The last stored date is requested again: the incomplete recent days reach the client
+        df_loc['start_date'] = end_date
+        results = fetchHistoricalMeteo(df_loc, end_date, self.meteo_features, openmeteo=openmeteo, meteo_cache=cache)
+
+        self.assertEqual(openmeteo.calls['weather_api'], 2)
+        self.assertEqual(results['1']['date'].tolist(), [end_date])
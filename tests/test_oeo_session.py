@@ -0,0 +1,21 @@
+from unittest import TestCase
+from oeo_session import get_connection, describe_collection, get_session_stats, close_session
+
+
+class Test(TestCase):
+
+    def test_get_connection(self):
+        connection1 = get_connection()
+        connection2 = get_connection()
+        self.assertIs(connection1, connection2)
+        self.assertEqual(get_session_stats()['authentications'], 1)
+
+    def test_describe_collection(self):
+        info1 = describe_collection("SENTINEL2_L2A")
+        info2 = describe_collection("SENTINEL2_L2A")
+        self.assertIs(info1, info2)
+
+    def test_close_session(self):
+        connection = get_connection()
+        close_session()
+        self.assertIsNot(connection, get_connection())
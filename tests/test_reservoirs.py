@@ -0,0 +1,99 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely import affinity
+from shapely.geometry import Point, MultiPolygon
+
+from sqlalchemy import text
+
+from db_pool import get_engine
+from reservoirs import reservoir_attributes, load_reservoirs, utm_epsg
+from get_meteo import getLatLon
+
+
+class Test(TestCase):
+    db_name = 'postgres'
+    user = 'postgres'
+    db_table_reservoirs = 'test_water_reservoirs'
+
+    def synthetic_reservoirs(self, n=20):
+        rng = np.random.default_rng(0)
+        polygons = [Point(lon, lat).buffer(r).union(Point(lon + r, lat).buffer(r * 0.6)) for lon, lat, r in
+                    zip(rng.uniform(-120, 150, n), rng.uniform(-50, 65, n), rng.uniform(0.005, 0.05, n))]
+        return gpd.GeoDataFrame({'osm_id': [str(i) for i in range(n)]}, geometry=polygons, crs='epsg:4326')
+
+    def test_reservoir_attributes(self):
+        gdf = self.synthetic_reservoirs()
+        gdf_out = reservoir_attributes(gdf)
+
+        for i in range(len(gdf)):
+            polygon = gdf.iloc[[i]].reset_index(drop=True)
+            epsg = polygon.estimate_utm_crs().to_epsg()
+            polygon_utm = polygon.geometry.simplify(0.0001, preserve_topology=True).to_crs(epsg)
+
+            self.assertEqual(gdf_out['utm_epsg'][i], epsg)
+            self.assertAlmostEqual(gdf_out['area_ha'][i], polygon_utm.area.values[0] / 10000)
+            self.assertTrue(gdf_out['geom_buffer'][i].equals_exact(polygon_utm.buffer(-20).to_crs(4326).iloc[0], 1e-9))
+
+        self.assertEqual(utm_epsg([14.4], [50.1])[0], 32633)
+
+    def test_load_reservoirs(self):
+        gdf = self.synthetic_reservoirs()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'reservoirs.parquet')
+            gdf.to_parquet(path)
+            n_rows = load_reservoirs(path, self.db_name, self.user, self.db_table_reservoirs)
+
+        self.assertEqual(n_rows, len(gdf))
+
+        lat, lon = getLatLon('3', self.db_name, self.user, self.db_table_reservoirs)
+        self.assertAlmostEqual(lat, gdf.geometry[3].centroid.y)
+        self.assertAlmostEqual(lon, gdf.geometry[3].centroid.x)
+
+    def test_load_reservoirs_existing_table(self):
+        db_table = 'test_water_reservoirs_baseline'
+        engine = get_engine(self.user, self.db_name)
+        gdf = self.synthetic_reservoirs()
+        for i in [3, 5]:
+            gdf.loc[i, 'geometry'] = MultiPolygon([gdf.geometry[i], affinity.translate(gdf.geometry[i], 0.2)])
+
+        # Table of the original shape (osm_id, geometry) with the reservoir 3 stored in two rows (parts)
+        gdf_table = pd.concat([gdf.drop(index=3), gdf.iloc[[3]].explode(index_parts=False)])
+        gdf_table.to_postgis(db_table, engine, if_exists='replace', index=False)
+
+        # The reservoir 5 is stored in two rows in the file
+        gdf_file = pd.concat([gdf.drop(index=5), gdf.iloc[[5]].explode(index_parts=False)])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'reservoirs.parquet')
+            gdf_file.to_parquet(path)
+            n_rows = load_reservoirs(path, self.db_name, self.user, db_table)
+
+            with engine.connect() as connection:
+                rows = connection.execute(text("SELECT osm_id, count(*), max(area_ha) FROM {db_table} "
+                                               "GROUP BY osm_id".format(db_table=db_table))).all()
+
+            self.assertEqual(n_rows, len(gdf))
+            self.assertEqual(sorted(osm_id for osm_id, _, _ in rows), sorted(gdf['osm_id']))
+            self.assertTrue(all(count == 1 and area > 0 for _, count, area in rows))
+
+            lat, lon = getLatLon('5', self.db_name, self.user, db_table)
+            self.assertAlmostEqual(lat, gdf.geometry[5].centroid.y)
+            self.assertAlmostEqual(lon, gdf.geometry[5].centroid.x)
+
+            # The parts of the reservoir which is not loaded are not deleted
+            with engine.begin() as connection:
+                connection.execute(text("INSERT INTO {db_table} (osm_id, geometry) SELECT 'x', geometry FROM "
+                                        "{db_table} WHERE osm_id IN ('1', '2')".format(db_table=db_table)))
+
+            self.assertRaises(ValueError, load_reservoirs, path, self.db_name, self.user, db_table)
+
+            with engine.connect() as connection:
+                n_parts = connection.execute(text("SELECT count(*) FROM {db_table} WHERE osm_id = 'x'".format(
+                    db_table=db_table))).scalar()
+            self.assertEqual(n_parts, 2)